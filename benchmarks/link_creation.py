@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+link_creation.py
+
+Per-recipient cost of creating links for a send, before and after
+batching: one put_async, uuid4() and url_for() per contact, against
+create_links() and link_url_template() from resources/mail.py run a shard
+of MAIL_SHARD_SIZE contacts at a time.
+
+$ benchmarks/link_creation.py path/to/your/appengine/installation [contacts]
+
+Runs against the testbed datastore stub, so the times are CPU and stub
+overhead on this machine, not production datastore latency. The count of
+datastore RPCs is what batching changes in production. Batched runs also
+look up existing links first, so a retried shard keeps them.
+"""
+
+import os
+import sys
+import time
+from datetime import datetime
+
+USAGE = """
+Path to your sdk must be the first argument. To run type:
+
+$ benchmarks/link_creation.py path/to/your/appengine/installation [contacts]
+"""
+
+def setup(sdk_path):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sys.path.insert(1, root)
+    sys.path.insert(1, os.path.join(root, 'gaenv_lib'))
+    os.environ["FLASK_CONF"] = "TEST"
+
+def per_contact(contacts, doc_key):
+    from uuid import uuid4
+    from flask import url_for
+    from mail_safe_test.resources.link import LinkModel
+    futures = []
+    urls = []
+    for contact in contacts:
+        link = LinkModel(id=uuid4().get_hex(), contact=contact.key, doc=doc_key)
+        futures.append(link.put_async())
+        urls.append(url_for('/link/', key_id=link.key.id()))
+    for future in futures:
+        future.get_result()
+    return urls
+
+def batched(contacts, doc_key):
+    """Creates the links a shard at a time, as send_shard does."""
+    from mail_safe_test import app
+    from mail_safe_test.resources.job import JobModel
+    from mail_safe_test.resources.mail import create_links, link_url_template
+    job = JobModel(parent=doc_key.parent(), id=1, job_type='send',
+                   doc=doc_key, created=datetime.utcnow())
+    shard_size = app.config['MAIL_SHARD_SIZE']
+    urls = []
+    for i in range(0, len(contacts), shard_size):
+        links, futures = create_links(contacts[i:i + shard_size], job)
+        prefix, suffix = link_url_template()
+        urls += [prefix + link.key.id() + suffix for link in links]
+        for future in futures:
+            future.get_result()
+    return urls
+
+def main(count):
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.ext import ndb, testbed
+    from mail_safe_test import app
+    from mail_safe_test.auth import UserModel
+    from mail_safe_test.resources.contact import ContactModel
+
+    runs = [('per contact', per_contact), ('batched', batched)]
+    for name, create in runs:
+        # A fresh datastore for each run, since the stub slows as it fills.
+        bed = testbed.Testbed()
+        bed.activate()
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        try:
+            user_key = UserModel(id='bench').put()
+            contacts = [ContactModel(parent=user_key, email='c%d@example.com' % i,
+                                     phone='5550000000') for i in range(count)]
+            ndb.put_multi(contacts)
+            doc_key = ndb.Key('DocModel', 1, parent=user_key)
+            ndb.get_context().clear_cache()
+            # Datastore round trips, which the stub's timings don't show.
+            rpcs = []
+            apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+                'bench', lambda service, call, request, response: rpcs.append(call),
+                'datastore_v3')
+            with app.test_request_context('/user/mail/'):
+                start = time.time()
+                create(contacts, doc_key)
+                elapsed = time.time() - start
+            print '%-12s %8.1f us/recipient  %5d datastore RPCs  (%d recipients, %.2f s)' % (
+                name, elapsed / count * 1e6, len(rpcs), count, elapsed)
+        finally:
+            bed.deactivate()
+
+if __name__ == '__main__':
+    try:
+        setup(sys.argv[1])
+    except IndexError:
+        print USAGE
+        sys.exit(1)
+    main(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
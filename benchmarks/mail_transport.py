@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+mail_transport.py
+
+Messages per second through the mail transports (see
+mail_safe_test/mail_transport.py): the memory transport, and the smtp
+transport against a local stand-in relay, with a new connection per
+message and with pooled connections.
+
+$ benchmarks/mail_transport.py path/to/your/appengine/installation [messages]
+
+The relay accepts and drops everything, so the numbers are the client
+and protocol overhead on this machine, not a real relay's latency.
+"""
+
+import asyncore
+import os
+import smtpd
+import sys
+import threading
+import time
+
+USAGE = """
+Path to your sdk must be the first argument. To run type:
+
+$ benchmarks/mail_transport.py path/to/your/appengine/installation [messages]
+"""
+
+def setup(sdk_path):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    sys.path.insert(1, root)
+    sys.path.insert(1, os.path.join(root, 'gaenv_lib'))
+    os.environ["FLASK_CONF"] = "TEST"
+
+class SinkServer(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        pass
+
+def main(count):
+    from mail_safe_test import app
+    from mail_safe_test.email_templates import PreparedEmail
+    from mail_safe_test.mail_transport import MemoryTransport, SMTPTransport
+
+    server = SinkServer()
+    thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+    thread.daemon = True
+    thread.start()
+    with app.test_request_context('/user/mail/'):
+        email = PreparedEmail(from_name=u'Bench')
+    messages = [email.message('bench@example.com', 'c%d@example.com' % i,
+                              to_name=u'Contact', link_url=u'/link/%032x' % i)
+                for i in range(count)]
+    transports = (
+        ('memory', MemoryTransport()),
+        ('smtp 1/conn', SMTPTransport('127.0.0.1', server.port,
+                                      messages_per_connection=1)),
+        ('smtp pooled', SMTPTransport('127.0.0.1', server.port,
+                                      messages_per_connection=count)),
+    )
+    try:
+        for name, transport in transports:
+            start = time.time()
+            with transport.session() as session:
+                for message in messages:
+                    session.send(message)
+            elapsed = time.time() - start
+            print '%-12s %8.1f messages/s  (%d messages, %.2f s)' % (
+                name, count / elapsed, count, elapsed)
+            if hasattr(transport, 'close'):
+                transport.close()
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    try:
+        setup(sys.argv[1])
+    except IndexError:
+        print USAGE
+        sys.exit(1)
+    main(int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
@@ -16,7 +16,8 @@ from google.appengine.ext.ndb import query
 
 
 __all__ = ['to_epoch', 'from_epoch', 'NDBJSONEncoder', 'entity_to_dict',
-'entity_from_dict', 'entity_from_json', 'ndbpprint', 'ndbdumps']
+'entity_from_dict', 'entity_from_json', 'ndbpprint', 'ndbdumps',
+'projection_for']
 
 
 class NDBJSONEncoder(JSONEncoder):
@@ -104,7 +105,8 @@ def entity_to_dict(self, includes=None, excludes=None):
     :raises: `ValueError` if any key in the `include` param doesn't exist.
   """
   self._fix_up_properties() # without this we're fucked..
-  value = ndb.Model.to_dict(self)
+  # an entity from a projection query only has the projected properties..
+  value = ndb.Model.to_dict(self, include=self._projection or None)
   # set the `id` of the entity's key by default..
   if self.key and (not excludes or 'key' not in excludes):
     value['key'] = self.key.urlsafe()
@@ -122,6 +124,11 @@ def entity_to_dict(self, includes=None, excludes=None):
 
   if includes:
     for inc in includes:
+      if self._projection and inc in self._properties and \
+          inc not in self._projection:
+        logging.warn('entity_to_dict cannot encode `%s`. Property is '
+          'not projected.', inc)
+        continue
       attr = self._properties.get(inc)
       if attr is not None:
         value[inc] = attr._get_value(self)
@@ -141,10 +148,39 @@ def entity_to_dict(self, includes=None, excludes=None):
   if excludes:
     # exclude items from the result dict, by popping the keys
     # from the dict..
-    (value.pop(exc) for exc in excludes if exc in value)
+    for exc in excludes:
+      value.pop(exc, None)
   return value
 
 
+def projection_for(cls, includes=None, excludes=None):
+  """
+  Returns the names of the properties to project a query of `cls` on, so
+  that `entity_to_dict` with the same `includes` and `excludes` can encode
+  its results without loading the entities.
+
+    :param cls: `ndb.Model` subclass.
+    :param include:
+      List of string keys of class attributes, as for `entity_to_dict`.
+    :param exclude:
+      List of string keys to omit, as for `entity_to_dict`.
+    :returns: `list` of property names, or None if the query cannot be a
+      projection: an include is not a property, or a property is
+      unindexed or repeated.
+  """
+  cls._fix_up_properties()
+  excludes = set(excludes or ())
+  if any(inc not in cls._properties for inc in includes or ()):
+    return None
+  names = [name for name in cls._properties if name not in excludes]
+  for name in names:
+    prop = cls._properties[name]
+    if not prop._indexed or prop._repeated or \
+        isinstance(prop, ndb.StructuredProperty):
+      return None
+  return names or None
+
+
 def entity_from_dict(cls, value):
     """
       :param cls: `ndb.Model` subclass.
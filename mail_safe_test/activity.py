@@ -0,0 +1,106 @@
+"""
+activity.py
+
+Write-behind tracking of UserModel.last_active.
+
+Writing the user entity on every request would put one write per request
+on the user's entity group. Instead each instance records activity in
+process and periodically hands the coalesced timestamps to tasks on the
+default queue, so no request waits for the writes; a request that finds
+the interval passed only enqueues the tasks, with one call. The task
+(see ACTIVITY_URL) updates each user in its own transaction, so it never
+overwrites an edit made to the user since it was read; the transactions
+run concurrently.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+from google.appengine.api import datastore_errors, taskqueue
+from google.appengine.ext import ndb
+
+ACTIVITY_URL = '/tasks/activity/'
+# Users per task, which keeps a task well under the payload limit.
+USERS_PER_TASK = 500
+# Tasks per call to Queue.add.
+TASKS_PER_ADD = 100
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+@ndb.transactional_tasklet
+def _update(user_key, last_active):
+    user = yield user_key.get_async()
+    # Users deleted since their last request are not recreated.
+    if user is None or (user.last_active is not None and
+                        user.last_active >= last_active):
+        raise ndb.Return(False)
+    user.last_active = last_active
+    yield user.put_async()
+    raise ndb.Return(True)
+
+def encode_activity(pending):
+    """Returns the task payload of {user key: last_active}."""
+    return '\n'.join('%s %s' % (key.urlsafe(), when.strftime(TIME_FORMAT))
+                     for key, when in pending.items())
+
+def decode_activity(payload):
+    pending = {}
+    for line in payload.splitlines():
+        urlsafe, _, when = line.partition(' ')
+        pending[ndb.Key(urlsafe=urlsafe)] = datetime.strptime(when, TIME_FORMAT)
+    return pending
+
+def write_activity(pending):
+    """Writes {user key: last_active}. Returns the number of users written."""
+    futures = [_update(key, when) for key, when in pending.items()]
+    written = 0
+    for future in futures:
+        try:
+            written += future.get_result()
+        except (datastore_errors.TransactionFailedError,
+                datastore_errors.Timeout) as e:
+            # Only a timestamp is lost, the next request records another.
+            logging.warn('Writing last_active failed: %s', e)
+    return written
+
+class ActivityTracker(object):
+    def __init__(self, flush_interval=60):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    def touch(self, user_key, when=None):
+        """Records activity for user_key, handing the buffer to tasks if the
+        interval has passed."""
+        with self._lock:
+            self._pending[user_key] = when or datetime.utcnow()
+            due = time.time() - self._last_flush >= self.flush_interval
+        if due:
+            self.enqueue()
+
+    def _take(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        return pending
+
+    def enqueue(self):
+        """Enqueues tasks that write the buffered last_active values.
+        Returns the number of users handed off."""
+        items = self._take().items()
+        tasks = [taskqueue.Task(payload=encode_activity(dict(items[i:i + USERS_PER_TASK])),
+                                method='POST', url=ACTIVITY_URL)
+                 for i in range(0, len(items), USERS_PER_TASK)]
+        try:
+            for i in range(0, len(tasks), TASKS_PER_ADD):
+                taskqueue.Queue().add(tasks[i:i + TASKS_PER_ADD])
+        except taskqueue.Error as e:
+            # As with a failed write, only timestamps are lost.
+            logging.warn('Enqueueing last_active failed: %s', e)
+        return len(items)
+
+    def flush(self):
+        """Writes the buffered last_active values now. Returns the number of
+        users written."""
+        return write_activity(self._take())
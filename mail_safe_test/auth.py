@@ -5,12 +5,15 @@ Common code for retreiving and validating the user from the
 Authorization header.
 """
 
-from flask import request, abort, redirect, url_for
+from flask import g, request, abort, redirect, url_for
 from functools import wraps
 from google.appengine.ext import ndb
 from mail_safe_test import app
-from oauth2client.client import verify_id_token
+from mail_safe_test.activity import ActivityTracker, decode_activity, write_activity
+from oauth2client import crypt
 from oauth2client.crypt import AppIdentityError
+from mail_safe_test.certs import CertStore, CertFetchError, HttpCertSource
+from mail_safe_test.token_cache import TokenCache
 
 if app.config['TESTING']:
     fake_user = {
@@ -40,6 +43,26 @@ if app.config['TESTING']:
         "valid_admin": fake_admin,
     }
 
+# Verified ID tokens, shared by all requests served by this instance.
+token_cache = TokenCache(app.config.get('TOKEN_CACHE_SIZE', 1024))
+
+# Google's signing certs, shared by all requests served by this instance.
+cert_store = CertStore(HttpCertSource(),
+                       refresh_margin=app.config.get('CERT_REFRESH_MARGIN', 300))
+
+# Buffered UserModel.last_active updates, written in batches by
+# activity_task.
+activity_tracker = ActivityTracker(app.config.get('ACTIVITY_FLUSH_INTERVAL', 60))
+
+def verify_id_token(id_token):
+    """Returns the token info of a signed id_token.
+
+    Raises AppIdentityError if the token is invalid, and CertFetchError if
+    Google's certs are unavailable.
+    """
+    return crypt.verify_signed_jwt_with_certs(
+        id_token, cert_store.get_certs(), app.config.get('GOOGLE_ID'))
+
 class UserModel(ndb.Model):
     first_name = ndb.StringProperty()
     last_name = ndb.StringProperty()
@@ -48,29 +71,60 @@ class UserModel(ndb.Model):
     created = ndb.DateTimeProperty(auto_now_add=True)
     last_active = ndb.DateTimeProperty(auto_now_add=True)
 
+# Marks a request-scoped value that has not been computed yet.
+_UNSET = object()
+
 def current_user():
-    """Returns None if the user is not found."""
+    """Returns None if the user is not found.
+
+    The user is loaded at most once per request and kept on flask.g, so the
+    decorators and the handlers share a single datastore get.
+    """
+    user = getattr(g, 'auth_user', _UNSET)
+    if user is _UNSET:
+        user_key = current_user_key()
+        user = user_key.get() if user_key else None
+        g.auth_user = user
+    return user
+
+def current_user_key():
+    """Returns the key of the authenticated user without loading the entity.
+
+    Returns None if there is no valid id_token. The key is not checked for
+    existence; use user_required or current_user() for that.
+    """
     jwt = current_user_token_info()
     if not jwt:
         return None
-    user_id = jwt['sub']
-    return ndb.Key(UserModel, user_id).get()
+    return ndb.Key(UserModel, jwt['sub'])
 
 def current_user_token_info():
     """Returns the user info object if a valid id_token is in the Authorization header."""
+    jwt = getattr(g, 'auth_token_info', _UNSET)
+    if jwt is _UNSET:
+        jwt = _verify_token_info()
+        g.auth_token_info = jwt
+    return jwt
+
+def _verify_token_info():
     id_token = request.headers.get('Authorization')
     if not id_token:
         return None
     if app.config['TESTING']:
         return fake_users.get(id_token)
+    jwt = token_cache.get(id_token)
+    if jwt:
+        return jwt
     try:
-        return verify_id_token(id_token, app.config.get('GOOGLE_ID'))
-        user_id = jwt['sub']
-        return ndb.Key(UserModel, user_id).get()
+        jwt = verify_id_token(id_token)
     except AppIdentityError as e:
-        if not (app.config['TESTING'] and id_token == "invalid"):
-            print "error", e
+        print "error", e
         return None
+    except CertFetchError as e:
+        print "error", e
+        abort(503)
+    token_cache.set(id_token, jwt)
+    return jwt
 
 def user_required(func):
     @wraps(func)
@@ -78,6 +132,7 @@ def user_required(func):
         auth_user = current_user()
         if not auth_user:
             abort(403)
+        activity_tracker.touch(auth_user.key)
         return func(*args, **kwargs)
     return wrapper
 
@@ -87,5 +142,24 @@ def admin_required(func):
         auth_user = current_user()
         if not auth_user or not auth_user.admin:
             abort(403)
+        activity_tracker.touch(auth_user.key)
         return func(*args, **kwargs)
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+def task_required(func):
+    """Only allows requests made by the task queue or by cron.
+
+    App Engine strips these headers from external requests.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not (request.headers.get('X-AppEngine-QueueName') or
+                request.headers.get('X-AppEngine-Cron')):
+            abort(403)
+        return func(*args, **kwargs)
+    return wrapper
+
+@task_required
+def activity_task():
+    write_activity(decode_activity(request.get_data()))
+    return ('', 200)
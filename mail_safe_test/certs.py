@@ -0,0 +1,137 @@
+"""
+certs.py
+
+Store for the public certificates Google signs ID tokens with.
+
+The certs are kept in process and in memcache for as long as the
+Cache-Control max-age of the response allows. Once they are within
+refresh_margin of expiring, one request, across all instances, refreshes
+them inline while the others keep using the current certs, so at most one
+request waits on the outbound fetch. Requests can't start threads that
+outlive them on App Engine, so there is no background refresh.
+"""
+
+import httplib2
+import logging
+import re
+import threading
+import time
+from json import loads
+from google.appengine.api import memcache
+
+GOOGLE_CERTS_URI = 'https://www.googleapis.com/oauth2/v1/certs'
+DEFAULT_MAX_AGE = 3600
+
+_max_age_re = re.compile(r'max-age=(\d+)')
+
+class CertFetchError(Exception):
+    pass
+
+def parse_max_age(cache_control, default=DEFAULT_MAX_AGE):
+    """Returns the max-age of a Cache-Control header value, in seconds."""
+    match = _max_age_re.search(cache_control or '')
+    if not match:
+        return default
+    return int(match.group(1))
+
+class HttpCertSource(object):
+    '''Fetches the certs from Google.'''
+    def __init__(self, uri=GOOGLE_CERTS_URI, timeout=10):
+        self.uri = uri
+        self.timeout = timeout
+
+    def fetch(self):
+        """Returns a (certs, max_age) tuple."""
+        try:
+            resp, content = httplib2.Http(timeout=self.timeout).request(self.uri)
+        except Exception as e:
+            raise CertFetchError(str(e))
+        if resp.status != 200:
+            raise CertFetchError('Fetching %s returned %d' % (self.uri, resp.status))
+        return loads(content), parse_max_age(resp.get('cache-control'))
+
+class StaticCertSource(object):
+    '''Local stand-in for HttpCertSource, for tests and offline development.'''
+    def __init__(self, certs, max_age=DEFAULT_MAX_AGE):
+        self.certs = certs
+        self.max_age = max_age
+        self.fetch_count = 0
+
+    def fetch(self):
+        self.fetch_count += 1
+        return dict(self.certs), self.max_age
+
+class CertStore(object):
+    def __init__(self, source, refresh_margin=300, memcache_key='google_certs'):
+        self.source = source
+        self.refresh_margin = refresh_margin
+        self.memcache_key = memcache_key
+        self._certs = None
+        self._expires = 0
+        self._lock = threading.Lock()
+        # Held while this instance fetches, so concurrent requests on a
+        # cold cache wait for one fetch instead of each making their own.
+        self._fetch_lock = threading.Lock()
+
+    def get_certs(self):
+        """Returns a dict of key id to PEM encoded certificate.
+
+        Raises CertFetchError if there are no unexpired certs and they could
+        not be fetched.
+        """
+        now = time.time()
+        certs, expires = self._certs, self._expires
+        if not certs or now >= expires:
+            with self._fetch_lock:
+                if not self._adopt_cached(now):
+                    return self.refresh()
+                certs, expires = self._certs, self._expires
+        if now >= expires - self.refresh_margin:
+            certs = self._refresh_ahead(now) or certs
+        return certs
+
+    def refresh(self):
+        """Fetches the certs from the source and stores them in both tiers."""
+        certs, max_age = self.source.fetch()
+        expires = time.time() + max_age
+        self._set(certs, expires)
+        memcache.set(self.memcache_key, {'certs': certs, 'expires': expires},
+                     time=max_age)
+        return certs
+
+    def _set(self, certs, expires):
+        with self._lock:
+            self._certs = certs
+            self._expires = expires
+
+    def _adopt_cached(self, now):
+        """Uses the certs in memcache if they are newer than ours. Returns
+        whether this process has unexpired certs afterwards."""
+        cached = memcache.get(self.memcache_key)
+        if cached and now < cached['expires'] and cached['expires'] > self._expires:
+            self._set(cached['certs'], cached['expires'])
+        return bool(self._certs) and now < self._expires
+
+    def _refresh_ahead(self, now):
+        """Refreshes certs that are about to expire, unless another request
+        is already doing so. Returns the new certs, or None."""
+        expires = self._expires
+        if not self._fetch_lock.acquire(False):
+            return None
+        try:
+            # Another instance may have refreshed them already.
+            self._adopt_cached(now)
+            if self._expires > expires:
+                return self._certs
+            lock_key = self.memcache_key + ':refreshing'
+            if not memcache.add(lock_key, 1, time=max(1, self.refresh_margin)):
+                return None
+            try:
+                return self.refresh()
+            except CertFetchError as e:
+                # The current certs are still valid, try again on the next request.
+                logging.warn('Refreshing certs failed: %s', e)
+                memcache.delete(lock_key)
+                return None
+        finally:
+            self._fetch_lock.release()
@@ -0,0 +1,189 @@
+"""
+contact_import.py
+
+Streaming CSV and vCard parsers and a batched writer for bulk contact
+imports.
+
+The parsers are generators over the lines of the upload and yield one
+(row, values) pair per contact, so an import never holds more than one
+batch of contacts in memory.
+"""
+
+import csv
+from google.appengine.ext import ndb
+
+FIELDS = ('first_name', 'last_name', 'email', 'phone')
+MAX_FIELD_LENGTH = 500
+
+# CSV header names, lower cased, mapped to ContactModel properties.
+CSV_COLUMNS = {
+    'first_name': 'first_name',
+    'first name': 'first_name',
+    'given name': 'first_name',
+    'last_name': 'last_name',
+    'last name': 'last_name',
+    'family name': 'last_name',
+    'email': 'email',
+    'e-mail': 'email',
+    'email address': 'email',
+    'e-mail address': 'email',
+    'phone': 'phone',
+    'phone number': 'phone',
+    'mobile': 'phone',
+    'mobile phone': 'phone',
+}
+
+def _decode(value):
+    return value.strip().decode('utf-8', 'replace')
+
+def iter_csv(lines):
+    """Yields (row, values) for each row of a CSV file with a header row."""
+    reader = csv.reader(lines)
+    try:
+        header = reader.next()
+    except StopIteration:
+        return
+    columns = [CSV_COLUMNS.get(name.strip().lower()) for name in header]
+    for cells in reader:
+        if not any(cell.strip() for cell in cells):
+            continue
+        values = {}
+        for column, cell in zip(columns, cells):
+            if column and cell.strip() and column not in values:
+                values[column] = _decode(cell)
+        yield reader.line_num, values
+
+def _unfold(lines):
+    """Yields (line number, line) for vCard lines, joining folded lines."""
+    current = None
+    start = 0
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield start, current
+        current, start = line, number
+    if current is not None:
+        yield start, current
+
+def iter_vcards(lines):
+    """Yields (row, values) for each vCard, where row is the line of its BEGIN."""
+    values = None
+    row = 0
+    full_name = None
+    for number, line in _unfold(lines):
+        name, _, value = line.partition(':')
+        # Drop parameters (EMAIL;TYPE=work) and groups (item1.EMAIL).
+        name = name.split(';')[0].split('.')[-1].upper()
+        if name == 'BEGIN' and value.strip().upper() == 'VCARD':
+            values, row, full_name = {}, number, None
+        elif values is None:
+            continue
+        elif name == 'END':
+            if full_name and 'first_name' not in values and 'last_name' not in values:
+                parts = full_name.split(None, 1)
+                values['first_name'] = parts[0]
+                if len(parts) > 1:
+                    values['last_name'] = parts[1]
+            yield row, values
+            values = None
+        elif name == 'N':
+            parts = value.split(';')
+            if parts[0].strip():
+                values['last_name'] = _decode(parts[0])
+            if len(parts) > 1 and parts[1].strip():
+                values['first_name'] = _decode(parts[1])
+        elif name == 'FN' and value.strip():
+            full_name = _decode(value)
+        elif name == 'EMAIL' and value.strip() and 'email' not in values:
+            values['email'] = _decode(value)
+        elif name == 'TEL' and value.strip() and 'phone' not in values:
+            values['phone'] = _decode(value)
+
+def validate(values):
+    """Returns an error message for an invalid contact, None if it is valid."""
+    if not values.get('email'):
+        return 'missing email'
+    if values['email'].count('@') != 1:
+        return 'invalid email'
+    if not values.get('phone'):
+        return 'missing phone'
+    for field in FIELDS:
+        if len(values.get(field) or '') > MAX_FIELD_LENGTH:
+            return '%s is too long' % field
+    return None
+
+class ContactImporter(object):
+    '''Writes parsed contacts in batches of put_multi_async.
+
+    Ids for each batch are allocated in one call, and at most one batch is
+    in flight while the next one is parsed. If key_id is given, it maps
+    each row's values to a deterministic key id instead. Rows with the same
+    key id are merged, later rows winning, and merged into the existing
+    contact like ContactModel.upsert, in one transaction per batch. Only
+    the current batch's key ids are held, so a contact with rows in
+    several batches is counted as imported once per batch.
+    '''
+    def __init__(self, model, user_key, batch_size=500, key_id=None):
+        self.model = model
+        self.user_key = user_key
+        self.batch_size = batch_size
+        self.key_id = key_id
+        self.imported = 0
+        self.errors = []
+
+    def run(self, rows):
+        batch = []
+        pending = []
+        for row, values in rows:
+            error = validate(values)
+            if error:
+                self.errors.append({'row': row, 'error': error})
+                continue
+            batch.append(values)
+            if len(batch) >= self.batch_size:
+                pending = self._write(batch, pending)
+                batch = []
+        pending = self._write(batch, pending)
+        for future in pending:
+            future.check_success()
+        return {'imported': self.imported, 'errors': self.errors}
+
+    def _write(self, batch, pending):
+        if not batch:
+            return pending
+        if self.key_id:
+            return self._merge(batch, pending)
+        first, _ = self.model.allocate_ids(size=len(batch), parent=self.user_key)
+        ids = range(first, first + len(batch))
+        entities = [self.model(id=key_id, parent=self.user_key, **values)
+                    for key_id, values in zip(ids, batch)]
+        # Wait for the previous batch so only one is held in memory.
+        for future in pending:
+            future.check_success()
+        self.imported += len(entities)
+        return ndb.put_multi_async(entities)
+
+    def _merge(self, batch, pending):
+        merged = {}
+        for values in batch:
+            key_id = self.key_id(values)
+            merged.setdefault(key_id, {}).update(values)
+        keys = [ndb.Key(self.model, key_id, parent=self.user_key) for key_id in merged]
+
+        def txn():
+            contacts = ndb.get_multi(keys)
+            for i, (key, contact) in enumerate(zip(keys, contacts)):
+                values = merged[key.id()]
+                if contact is None:
+                    contacts[i] = self.model(key=key, **values)
+                else:
+                    contacts[i].populate(**values)
+            ndb.put_multi(contacts)
+        # The batches share the user's entity group, so commit one at a time.
+        for future in pending:
+            future.check_success()
+        self.imported += len(merged)
+        return [ndb.transaction_async(txn)]
@@ -1,6 +1,7 @@
 #custom_fields.py
 from flask import url_for
 from flask.ext.restful import fields
+from flask.ext.restful.fields import MarshallingException
 from urlparse import urlparse, urlunparse
 
 class NDBUrl(fields.Url):
@@ -9,9 +10,10 @@ class NDBUrl(fields.Url):
     functions that accept key or key_id as arguments'''
     def output(self, key, obj):
         try:
-            data = obj.to_dict()
-            data['key'] = obj.key.urlsafe()
-            data['key_id'] = obj.key.id()
+            # Only the key is needed, so entities from projection queries,
+            # and dicts with a key, can be marshalled too.
+            key = fields.get_value('key', obj)
+            data = {'key': key.urlsafe(), 'key_id': key.id()}
             o = urlparse(url_for(self.endpoint, _external=self.absolute, **data))
             if self.absolute:
                 scheme = self.scheme if self.scheme is not None else o.scheme
@@ -0,0 +1,160 @@
+"""
+doc_storage.py
+
+Storage for document bodies.
+
+A body is zlib compressed and split into chunks of at most DOC_CHUNK_SIZE
+bytes, each stored unindexed in a DocChunkModel child of the document, so
+a body is not capped by the entity size limit and its writes add no index
+rows. The document only records which generation of chunks is current and
+how many there are, so loading documents never loads their bodies.
+
+Each write uses a new generation. Outside a transaction its chunks are
+written before the document that points to them, so a reader never sees a
+partial body, and deleted again if the document is not written. In a
+transaction they commit together. The previous generation is deleted
+afterwards unless a revision keeps it.
+
+Every generation is also a DocRevisionModel. Most revisions only store a
+compressed line delta from the previous one. Every DOC_SNAPSHOT_INTERVAL
+revisions (or when a delta would be too large) the revision is a snapshot
+instead, which keeps its generation of chunks. Reading a revision is one
+get of the revision and one get_multi of its snapshot's chunks and the
+deltas after it.
+"""
+
+import difflib
+import zlib
+from json import dumps, loads
+from google.appengine.ext import ndb
+
+class DocChunkModel(ndb.Model):
+    data = ndb.BlobProperty()
+
+class DocRevisionModel(ndb.Model):
+    number = ndb.IntegerProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    size = ndb.IntegerProperty()
+    # The snapshot this revision is rebuilt from, and its number of chunks.
+    # A snapshot is its own base.
+    base = ndb.IntegerProperty(indexed=False)
+    base_chunks = ndb.IntegerProperty(indexed=False)
+    # Compressed delta from the previous revision, None for a snapshot.
+    delta = ndb.BlobProperty()
+
+def revision_key(doc_key, number):
+    return ndb.Key(DocRevisionModel, number, parent=doc_key)
+
+def chunk_keys(doc_key, generation, count):
+    return [ndb.Key(DocChunkModel, '%d:%d' % (generation, i), parent=doc_key)
+            for i in range(count)]
+
+def _unicode(text):
+    if isinstance(text, str):
+        return text.decode('utf-8')
+    return text or u''
+
+def compress(text, chunk_size):
+    """Returns the compressed chunks of text, [] for an empty body."""
+    if not text:
+        return []
+    data = zlib.compress(_unicode(text).encode('utf-8'))
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+def _decompress(chunks):
+    if not chunks:
+        return None
+    return zlib.decompress(''.join(c.data for c in chunks)).decode('utf-8')
+
+def make_delta(old, new):
+    """Returns the compressed line delta that turns old into new."""
+    old_lines = _unicode(old).splitlines(True)
+    new_lines = _unicode(new).splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(['c', i1, i2])  # Copy old lines i1:i2.
+        elif j2 > j1:
+            ops.append(['i', new_lines[j1:j2]])  # Insert new lines.
+    return zlib.compress(dumps(ops))
+
+def apply_delta(old, delta):
+    old_lines = _unicode(old).splitlines(True)
+    lines = []
+    for op in loads(zlib.decompress(delta)):
+        if op[0] == 'c':
+            lines.extend(old_lines[op[1]:op[2]])
+        else:
+            lines.extend(op[1])
+    return u''.join(lines)
+
+@ndb.tasklet
+def prepare_content_async(doc_key, generation, chunks, text, snapshot_interval,
+                          chunk_size):
+    """Prepares text as the revision after `generation` of doc_key's body,
+    where the current generation has `chunks` chunks. Nothing is written.
+
+    Returns (generation, chunks, entities, stale) for the new revision,
+    where entities are the revision and chunks to put before the document
+    points to them, and stale are the chunk keys of the previous
+    generation that are no longer needed once it does.
+    """
+    text = _unicode(text)
+    number = generation + 1
+    data = compress(text, chunk_size)
+    previous = None
+    if generation:
+        previous = yield revision_key(doc_key, generation).get_async()
+    revision = DocRevisionModel(key=revision_key(doc_key, number),
+                                number=number, size=len(text))
+    if previous is not None and number - previous.base < snapshot_interval:
+        old = yield read_content_async(doc_key, generation, chunks)
+        delta = make_delta(old, text)
+        if len(delta) <= chunk_size:
+            revision.populate(base=previous.base, base_chunks=previous.base_chunks,
+                              delta=delta)
+    if revision.delta is None:
+        revision.populate(base=number, base_chunks=len(data))
+    entities = [revision] + [DocChunkModel(key=key, data=d) for key, d in
+                             zip(chunk_keys(doc_key, number, len(data)), data)]
+    if previous is not None and previous.base == generation:
+        stale = []  # A snapshot keeps its chunks.
+    else:
+        stale = chunk_keys(doc_key, generation, chunks)
+    raise ndb.Return((number, len(data), entities, stale))
+
+@ndb.tasklet
+def read_content_async(doc_key, generation, count):
+    """Returns the body of a generation, in one batch get."""
+    if not count:
+        raise ndb.Return(None)
+    chunks = yield ndb.get_multi_async(chunk_keys(doc_key, generation, count))
+    if None in chunks:
+        raise ValueError('missing chunks of %s generation %d' % (doc_key, generation))
+    raise ndb.Return(_decompress(chunks))
+
+def read_content(doc_key, generation, count):
+    return read_content_async(doc_key, generation, count).get_result()
+
+def read_revision(doc_key, number):
+    """Returns (revision, body) of a revision, or (None, None) if there is none."""
+    revision = revision_key(doc_key, number).get()
+    if revision is None:
+        return None, None
+    delta_keys = [revision_key(doc_key, n) for n in range(revision.base + 1, number)]
+    base_keys = chunk_keys(doc_key, revision.base, revision.base_chunks)
+    entities = ndb.get_multi(delta_keys + base_keys)
+    if None in entities:
+        raise ValueError('missing history of %s revision %d' % (doc_key, number))
+    text = _decompress(entities[len(delta_keys):]) or u''
+    for r in entities[:len(delta_keys)] + [revision]:
+        if r.delta is not None:
+            text = apply_delta(text, r.delta)
+    return revision, text
+
+def delete_content(doc_key):
+    """Deletes every generation and revision of doc_key's body. Deleting
+    all of a user's docs deletes their bodies by kind instead, see
+    DocModel."""
+    ndb.delete_multi(ndb.Query(ancestor=doc_key).fetch(keys_only=True))
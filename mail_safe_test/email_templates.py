@@ -0,0 +1,81 @@
+"""
+email_templates.py
+
+Compiled templates for outgoing mail, see templates/email/.
+
+The templates are compiled once per instance by the app's Jinja
+environment. For a send, each one is rendered once with the values that
+are the same for every recipient, with a marker where each per-recipient
+value goes, and split into literal segments at the markers. A recipient's
+message is then just the segments joined with that recipient's values.
+
+Per-recipient values must appear in the templates as plain {{ name }}
+expressions, without filters.
+"""
+
+import threading
+from collections import OrderedDict
+from markupsafe import escape
+from mail_safe_test import app
+
+# Message part -> template. The html part is autoescaped.
+TEMPLATES = {
+    'subject': 'email/message_subject.txt',
+    'body': 'email/message.txt',
+    'html': 'email/message.html',
+}
+RECIPIENT_FIELDS = ('to_name', 'link_url', 'unsubscribe_url')
+PREVIEW_CACHE_SIZE = 256
+
+_MARK = u'\x00'
+
+class PreparedEmail(object):
+    '''The message templates rendered for one sender, ready for recipients.'''
+    def __init__(self, **context):
+        markers = dict((name, _MARK + name + _MARK) for name in RECIPIENT_FIELDS)
+        context.update(markers)
+        # Odd segments are the names of recipient fields.
+        self.parts = {}
+        for part, name in TEMPLATES.items():
+            rendered = app.jinja_env.get_template(name).render(context)
+            if part == 'subject':
+                rendered = rendered.strip()
+            self.parts[part] = rendered.split(_MARK)
+
+    def render(self, **values):
+        """Returns the subject, body and html of a recipient's message."""
+        result = {}
+        for part, segments in self.parts.items():
+            pieces = segments[:]
+            for i in range(1, len(pieces), 2):
+                value = values.get(pieces[i]) or u''
+                pieces[i] = escape(value) if part == 'html' else value
+            result[part] = u''.join(pieces)
+        return result
+
+    def message(self, sender, to, **values):
+        """Returns the keyword arguments of mail.send_mail for a recipient."""
+        message = self.render(**values)
+        message.update(sender=sender, to=to)
+        return message
+
+_previews = OrderedDict()
+_previews_lock = threading.Lock()
+
+def preview(from_name):
+    """Returns the message a recipient of a doc from from_name would get,
+    with a sample name and link. The message does not depend on the doc,
+    so it is memoized per sender name."""
+    with _previews_lock:
+        if from_name in _previews:
+            result = _previews.pop(from_name)
+            _previews[from_name] = result
+            return result
+    result = PreparedEmail(from_name=from_name).render(
+        to_name=u'Recipient', link_url=u'/link/preview',
+        unsubscribe_url=u'/unsubscribe/preview')
+    with _previews_lock:
+        _previews[from_name] = result
+        while len(_previews) > PREVIEW_CACHE_SIZE:
+            _previews.popitem(last=False)
+    return result
@@ -0,0 +1,81 @@
+"""
+fieldsets.py
+
+Sparse fieldsets for the GET endpoints.
+
+`?fields=first_name,email` limits each marshalled item to the named fields.
+When a list endpoint is asked only for properties that an index in
+index.yaml covers, its query runs as a projection, so the properties are
+read from the index and the entities themselves are never loaded.
+"""
+
+from functools import wraps
+from flask import abort, request
+from flask.ext.restful import fields, marshal
+from flask_ndb_api import projection_for
+from mail_safe_test.pagination import list_fields
+
+# Fields computed from the entity's key, which every projection has.
+KEY_FIELDS = frozenset(['uri'])
+
+def requested_fields(item_fields):
+    """Returns the names of item_fields selected by ?fields=, or None for all.
+
+    Aborts with 400 on an unknown name.
+    """
+    value = request.args.get('fields')
+    if value is None:
+        return None
+    names = frozenset(name.strip() for name in value.split(',') if name.strip())
+    if not names or not names.issubset(item_fields):
+        abort(400)
+    return names
+
+def select_fields(item_fields, names):
+    if names is None:
+        return item_fields
+    return {k: v for (k, v) in item_fields.items() if k in names}
+
+def projection(model, names, indexed):
+    """Returns the properties to project a query of model on for the fields
+    in names, or None if it has to load the entities.
+
+    indexed lists the property names of each index for the query, in the
+    order of index.yaml. The projection is in the same order, so it is the
+    same for every request with the same fields.
+    """
+    if names is None:
+        return None
+    props = names - KEY_FIELDS
+    excludes = [name for name in model._properties if name not in props]
+    projected = projection_for(model, includes=props, excludes=excludes)
+    if projected is None:
+        return None
+    for index in indexed:
+        if frozenset(index) == frozenset(projected):
+            return list(index)
+    return None
+
+def marshal_with_fieldset(item_fields, list_name=None, paged=True, extra_fields=None):
+    """Like marshal_with(item_fields), for only the fields selected by ?fields=.
+
+    With list_name, the response is a page of items under list_name, see
+    pagination.list_fields, or just the items if not paged. extra_fields
+    are marshalled next to them in full.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            out_fields = select_fields(item_fields, requested_fields(item_fields))
+            if list_name and paged:
+                out_fields = list_fields(list_name, out_fields)
+            elif list_name:
+                out_fields = {list_name: fields.List(fields.Nested(out_fields))}
+            if extra_fields:
+                out_fields = dict(extra_fields, **out_fields)
+            rv = func(*args, **kwargs)
+            if isinstance(rv, tuple):
+                return (marshal(rv[0], out_fields),) + rv[1:]
+            return marshal(rv, out_fields)
+        return wrapper
+    return decorator
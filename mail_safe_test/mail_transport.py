@@ -0,0 +1,184 @@
+"""
+mail_transport.py
+
+Ways of delivering the messages built by email_templates.py. A message is
+the keyword arguments of mail.send_mail: sender, to, subject, body and
+html.
+
+MAIL_TRANSPORT picks the backend:
+  appengine  the App Engine mail API, one call per message.
+  smtp       an SMTP relay. Connections are kept in a per-instance pool
+             and each one carries many messages before it is replaced.
+  memory     keeps the messages in a list, for tests and benchmarks.
+
+Messages are sent through a session, e.g.
+
+    with get_transport().session() as session:
+        for message in messages:
+            session.send(message)
+
+which for smtp holds one pooled connection for the whole batch. A message
+whose recipient is rejected raises RecipientError, and the session can
+go on with the next one.
+"""
+
+import smtplib
+import threading
+from contextlib import contextmanager
+from email.header import Header
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from Queue import Empty, Full, LifoQueue
+from google.appengine.api import mail
+from mail_safe_test import app
+
+class RecipientError(Exception):
+    '''A message was not accepted for its recipient.'''
+
+class Transport(object):
+    def send(self, message):
+        raise NotImplementedError
+
+    @contextmanager
+    def session(self):
+        """Yields an object with send(message) for sending a batch."""
+        yield self
+
+class AppEngineTransport(Transport):
+    def send(self, message):
+        try:
+            mail.send_mail(**message)
+        except mail.InvalidEmailError as e:
+            raise RecipientError(str(e))
+
+class MemoryTransport(Transport):
+    def __init__(self):
+        self.outbox = []
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            self.outbox.append(dict(message))
+
+def mime_message(message):
+    """Returns the multipart/alternative MIME message of a message."""
+    mime = MIMEMultipart('alternative')
+    mime['From'] = message['sender']
+    mime['To'] = message['to']
+    mime['Subject'] = Header(message['subject'], 'utf-8')
+    mime.attach(MIMEText(message['body'], 'plain', 'utf-8'))
+    if message.get('html'):
+        mime.attach(MIMEText(message['html'], 'html', 'utf-8'))
+    return mime
+
+class _SMTPSession(object):
+    def __init__(self, transport, connection):
+        self.transport = transport
+        self.connection = connection
+        self.count = 0
+
+    def send(self, message):
+        if self.count >= self.transport.messages_per_connection:
+            self.transport._close(self.connection)
+            self.connection = self.transport._connect()
+            self.count = 0
+        data = mime_message(message).as_string()
+        try:
+            try:
+                self.connection.sendmail(message['sender'], [message['to']], data)
+            except smtplib.SMTPServerDisconnected:
+                # The relay dropped an idle pooled connection. Nothing was
+                # accepted on it, so send again on a new one.
+                self.connection = self.transport._connect()
+                self.count = 0
+                self.connection.sendmail(message['sender'], [message['to']], data)
+        except smtplib.SMTPRecipientsRefused as e:
+            # The relay reset the transaction, so the connection is reusable.
+            raise RecipientError(str(e.recipients))
+        self.count += 1
+
+class SMTPTransport(Transport):
+    def __init__(self, host, port, username=None, password=None, use_tls=False,
+                 pool_size=4, messages_per_connection=100, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.messages_per_connection = messages_per_connection
+        self.timeout = timeout
+        self._pool = LifoQueue(pool_size)
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            connection.starttls()
+        if self.username:
+            connection.login(self.username, self.password)
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.quit()
+        except smtplib.SMTPException:
+            connection.close()
+
+    @contextmanager
+    def session(self):
+        try:
+            connection = self._pool.get_nowait()
+        except Empty:
+            connection = self._connect()
+        session = _SMTPSession(self, connection)
+        try:
+            yield session
+        except Exception:
+            # The connection may be mid-transaction, so don't reuse it.
+            session.connection.close()
+            raise
+        if session.count >= self.messages_per_connection:
+            self._close(session.connection)
+            return
+        try:
+            self._pool.put_nowait(session.connection)
+        except Full:
+            self._close(session.connection)
+
+    def send(self, message):
+        with self.session() as session:
+            session.send(message)
+
+    def close(self):
+        """Closes the pooled connections."""
+        while True:
+            try:
+                self._close(self._pool.get_nowait())
+            except Empty:
+                return
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+def _create(name):
+    if name == 'appengine':
+        return AppEngineTransport()
+    if name == 'memory':
+        return MemoryTransport()
+    if name == 'smtp':
+        return SMTPTransport(
+            app.config['SMTP_HOST'], app.config['SMTP_PORT'],
+            username=app.config.get('SMTP_USERNAME'),
+            password=app.config.get('SMTP_PASSWORD'),
+            use_tls=app.config.get('SMTP_USE_TLS', False),
+            pool_size=app.config['SMTP_POOL_SIZE'],
+            messages_per_connection=app.config['SMTP_MESSAGES_PER_CONNECTION'])
+    raise ValueError('unknown mail transport %r' % name)
+
+def get_transport():
+    """Returns this instance's transport for MAIL_TRANSPORT, created once so
+    that its connection pool outlives requests."""
+    name = app.config.get('MAIL_TRANSPORT', 'appengine')
+    with _transports_lock:
+        if name not in _transports:
+            _transports[name] = _create(name)
+        return _transports[name]
@@ -0,0 +1,107 @@
+"""
+otp.py
+
+One time passwords that unlock a link for its recipient, see link.py.
+
+Issuing a code texts it to the contact (see sms.py), then writes its HMAC
+and expiry to the LinkModel in a transaction that re-reads the link, so
+fields written meanwhile by sends or sweeps are kept. That is the only
+datastore write. If the text fails, nothing is written, the previous code
+still works and the issue is not counted.
+Attempts, lockouts, issue limits and used codes are all counted in
+memcache, so a burst of guesses costs no entity group writes. Each
+attempt is counted before its code is checked, so parallel guesses can't
+all get in under the limit, and a correct code clears the count. If
+memcache loses a counter it starts again from zero, which at worst grants
+another OTP_MAX_ATTEMPTS guesses.
+"""
+
+import hashlib
+import hmac
+import random
+from datetime import datetime, timedelta
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from mail_safe_test import app
+from mail_safe_test.sms import SMSError, get_sms_backend
+
+ATTEMPTS_PREFIX = 'otp_attempts:'
+ISSUES_PREFIX = 'otp_issues:'
+USED_PREFIX = 'otp_used:'
+
+_random = random.SystemRandom()
+
+class OTPResult:
+    OK = 'ok'
+    INVALID = 'invalid'
+    EXPIRED = 'expired'
+    LOCKED = 'locked'
+
+def _equal(a, b):
+    """Compares two strings in time that only depends on their length."""
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+def _hash(link_id, code):
+    message = '%s:%s' % (link_id, code)
+    return hmac.new(app.config['SECRET_KEY'], message, hashlib.sha256).hexdigest()
+
+def _count(key, window):
+    """Adds one to the counter at key, which expires window seconds after
+    it was created, and returns its new value."""
+    memcache.add(key, 0, time=window)
+    return memcache.incr(key) or 0
+
+@ndb.transactional
+def _save_otp(link_key, otp, otp_expire):
+    link = link_key.get()
+    if link is not None:
+        link.populate(otp=otp, otp_expire=otp_expire)
+        link.put()
+
+def issue_otp(link, phone):
+    """Texts a new code for link to phone and saves it on the link.
+    Returns False without sending if the link had too many codes lately.
+    Raises SMSError, having saved nothing, if the text can't be sent."""
+    sms = get_sms_backend()
+    link_id = link.key.id()
+    issues = _count(ISSUES_PREFIX + link_id, app.config['OTP_ISSUE_WINDOW'])
+    if issues > app.config['OTP_MAX_ISSUES']:
+        return False
+    digits = app.config['OTP_DIGITS']
+    code = str(_random.randrange(10 ** digits)).zfill(digits)
+    otp = _hash(link_id, code)
+    otp_expire = datetime.utcnow() + timedelta(seconds=app.config['OTP_TTL'])
+    try:
+        sms.send(phone, 'Your MailSafe code is %s' % code)
+    except SMSError:
+        memcache.decr(ISSUES_PREFIX + link_id)
+        raise
+    _save_otp(link.key, otp, otp_expire)
+    link.populate(otp=otp, otp_expire=otp_expire)
+    return True
+
+def verify_otp(link, code):
+    """Checks code against link's current code. Returns an OTPResult."""
+    link_id = link.key.id()
+    attempts = _count(ATTEMPTS_PREFIX + link_id, app.config['OTP_LOCKOUT_TIME'])
+    if attempts > app.config['OTP_MAX_ATTEMPTS']:
+        return OTPResult.LOCKED
+    if not link.otp or link.otp_expire is None:
+        return OTPResult.INVALID
+    if link.otp_expire <= datetime.utcnow():
+        return OTPResult.EXPIRED
+    # The datastore returns the hash as unicode.
+    if not _equal(_hash(link_id, code or ''), str(link.otp)):
+        return OTPResult.INVALID
+    # Each code works once.
+    if not memcache.add(USED_PREFIX + link.otp, 1, time=app.config['OTP_TTL']):
+        return OTPResult.EXPIRED
+    memcache.delete(ATTEMPTS_PREFIX + link_id)
+    return OTPResult.OK
@@ -0,0 +1,90 @@
+"""
+pagination.py
+
+Cursor based paging for the list endpoints.
+
+List endpoints accept `limit` and `cursor` query arguments and return a
+page of results together with an opaque `next_cursor`, which is null on
+the last page. The page size is capped at MAX_PAGE_SIZE.
+
+Lists held in an entity, such as the members of a contact list, are
+paged the same way, with offsets as cursors.
+
+A cursor only continues the query it came from. The cursor of a
+projection (see fieldsets.py) is prefixed with the projected properties,
+so one passed with a different ?fields= is rejected with 400 instead of
+silently skipping or repeating results.
+"""
+
+from flask import abort
+from flask.ext.restful import fields, reqparse
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from mail_safe_test import app
+
+def page_parser():
+    parser = reqparse.RequestParser()
+    parser.add_argument('limit', type = int, location = 'args')
+    parser.add_argument('cursor', type = str, location = 'args')
+    return parser
+
+def list_fields(name, item_fields):
+    """Returns the marshal fields for a page of items stored under `name`."""
+    return {name: fields.List(fields.Nested(item_fields)),
+            'next_cursor': fields.String}
+
+def page_size(limit):
+    """Returns the page size to use for a requested limit."""
+    if limit is None:
+        return app.config['DEFAULT_PAGE_SIZE']
+    if limit < 1:
+        abort(400)
+    return min(limit, app.config['MAX_PAGE_SIZE'])
+
+def _projected(projection):
+    # A projection lists property names or properties.
+    return ','.join(getattr(p, '_name', p) for p in projection or ())
+
+def parse_cursor(urlsafe, projection=None):
+    if not urlsafe:
+        return None
+    names, _, cursor = urlsafe.rpartition(':')
+    if names != _projected(projection):
+        abort(400)
+    urlsafe = cursor
+    try:
+        return ndb.Cursor(urlsafe=urlsafe)
+    except datastore_errors.BadValueError:
+        abort(400)
+
+def fetch_page(query, args, **options):
+    """Returns (results, next_cursor) for the page of query selected by args.
+
+    args is the result of page_parser().parse_args(). Extra keyword
+    arguments are passed to Query.fetch_page.
+    """
+    projection = options.get('projection')
+    results, cursor, more = query.fetch_page(page_size(args.limit),
+                                             start_cursor=parse_cursor(args.cursor,
+                                                                       projection),
+                                             **options)
+    next_cursor = None
+    if more and cursor:
+        next_cursor = cursor.urlsafe()
+        if projection:
+            next_cursor = _projected(projection) + ':' + next_cursor
+    return results, next_cursor
+
+def slice_page(items, args):
+    """Returns (items, next_cursor) for the page of a list selected by
+    args, see fetch_page."""
+    start = 0
+    if args.cursor:
+        try:
+            start = int(args.cursor)
+        except ValueError:
+            abort(400)
+        if start < 0:
+            abort(400)
+    end = start + page_size(args.limit)
+    return items[start:end], str(end) if end < len(items) else None
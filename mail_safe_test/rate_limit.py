@@ -0,0 +1,107 @@
+"""
+rate_limit.py
+
+Token buckets in memcache, shared by all instances.
+
+A bucket holds up to `capacity` tokens and refills at `rate` tokens per
+second. Its state is a (tokens, timestamp) pair updated with memcache
+compare-and-set, so concurrent takers never hand out the same token. If
+the bucket is evicted it comes back full, which at worst allows one extra
+burst.
+"""
+
+import time
+from google.appengine.api import memcache
+
+MEMCACHE_PREFIX = 'token_bucket:'
+STATS_PREFIX = 'rate_limit_stats:'
+CAS_RETRIES = 5
+
+class TokenBucket(object):
+    def __init__(self, name, rate, capacity):
+        self.key = MEMCACHE_PREFIX + name
+        self.rate = float(rate)
+        self.capacity = capacity
+
+    def _update(self, change):
+        """Applies change(tokens) -> (new tokens, result) to the refilled
+        bucket and returns result, or None if memcache kept conflicting."""
+        client = memcache.Client()
+        for _ in range(CAS_RETRIES):
+            state = client.gets(self.key)
+            now = time.time()
+            if state is None:
+                tokens = self.capacity
+            else:
+                tokens, stamp = state
+                tokens = min(self.capacity, tokens + max(0, now - stamp) * self.rate)
+            tokens, result = change(tokens)
+            if state is None:
+                saved = client.add(self.key, (tokens, now))
+            else:
+                saved = client.cas(self.key, (tokens, now))
+            if saved:
+                return result
+        return None
+
+    def take(self, count):
+        """Takes up to count tokens. Returns (tokens taken, seconds until
+        the rest, or a full bucket's worth of them, are available)."""
+        def change(tokens):
+            taken = min(count, int(tokens))
+            left = tokens - taken
+            need = min(count - taken, self.capacity)
+            return left, (taken, max(0.0, need - left) / self.rate)
+        result = self._update(change)
+        if result is None:
+            return 0, 1 / self.rate
+        return result
+
+    def give_back(self, count):
+        """Returns tokens taken but not used."""
+        if count > 0:
+            self._update(lambda tokens: (min(self.capacity, tokens + count), None))
+
+    def tokens(self):
+        """Returns the tokens available now."""
+        state = memcache.get(self.key)
+        if state is None:
+            return self.capacity
+        tokens, stamp = state
+        return min(self.capacity, tokens + max(0, time.time() - stamp) * self.rate)
+
+class RateLimiter(object):
+    '''Takes tokens from several buckets at once, e.g. an app wide bucket
+    and a bucket per recipient domain.'''
+    def __init__(self, name, buckets):
+        self.name = name
+        self.buckets = buckets
+
+    def acquire(self, count):
+        """Returns (n, wait): n <= count sends are allowed now, and the rest
+        should be retried in wait seconds."""
+        granted = count
+        wait = 0.0
+        taken = []
+        for bucket in self.buckets:
+            got, bucket_wait = bucket.take(granted)
+            taken.append((bucket, got))
+            granted = got
+            wait = max(wait, bucket_wait)
+        # Earlier buckets may have given more than a later one allowed.
+        for bucket, got in taken:
+            bucket.give_back(got - granted)
+        if granted < count:
+            memcache.incr(STATS_PREFIX + self.name + ':throttled', initial_value=0)
+            memcache.incr(STATS_PREFIX + self.name + ':wait_ms',
+                          delta=int(wait * 1000), initial_value=0)
+        return granted, wait
+
+    def stats(self):
+        """Returns the throttling counters and the tokens left in each bucket."""
+        counters = memcache.get_multi(['throttled', 'wait_ms'],
+                                      key_prefix=STATS_PREFIX + self.name + ':')
+        return {'throttled': counters.get('throttled', 0),
+                'wait_seconds': counters.get('wait_ms', 0) / 1000.0,
+                'tokens': dict((b.key[len(MEMCACHE_PREFIX):], b.tokens())
+                               for b in self.buckets)}
@@ -1,13 +1,33 @@
 """
 contact.py
 
+Contacts are found by prefix search on normalized copies of their names
+and email, which are computed properties written with the contact.
+Contacts saved before those properties existed lack them until they are
+saved again. An admin POST to /admin/contacts/backfill/ starts a job on
+the maintenance queue that re-saves every contact, CONTACT_BACKFILL_BATCH_SIZE
+per task, each in a transaction that re-reads it so concurrent edits are
+kept.
 """
 
+import hashlib
+import re
 from flask import request, Response, abort, make_response
 from flask.ext.restful import Resource, fields, marshal_with, reqparse
 from google.appengine.ext import ndb
+from mail_safe_test import app
+from mail_safe_test.contact_import import ContactImporter, iter_csv, iter_vcards
 from mail_safe_test.custom_fields import NDBUrl
-from mail_safe_test.auth import current_user, user_required, admin_required, UserModel
+from mail_safe_test.fieldsets import marshal_with_fieldset, projection, requested_fields
+from mail_safe_test.pagination import fetch_page, page_parser
+from mail_safe_test.resources.job import (JobModel, JobStatus, job_fields, run_delete_hooks,
+                                         save_and_continue, start_delete_job)
+from mail_safe_test.versioning import bump_version, versioned
+from mail_safe_test.auth import (current_user_key, user_required, admin_required, task_required,
+                                 UserModel)
+
+BACKFILL_URL = '/tasks/contacts/backfill/'
+BACKFILL_QUEUE = 'maintenance'
 
 # Public exports
 contact_fields = {
@@ -27,12 +47,61 @@ def parser(required_email, required_phone):
     parser.add_argument('phone', type = str, required = required_phone, location = 'json')
     return parser
 
+def dedup_parser():
+    parser = reqparse.RequestParser()
+    parser.add_argument('dedup', type = str, location = 'args', choices = ('email', 'phone'))
+    return parser
+
+def normalize(value):
+    """Returns the form of a name or email that prefix searches match on."""
+    if not value:
+        return None
+    return value.strip().lower()
+
+def normalize_phone(value):
+    """Returns the digits of a phone number, keeping a leading +."""
+    if not value:
+        return None
+    value = value.strip()
+    digits = re.sub(r'\D', '', value)
+    if not digits:
+        return None
+    return '+' + digits if value.startswith('+') else digits
+
+def dedup_key_id(dedup, values):
+    """Returns the key id a contact gets when deduplicating on `dedup`.
+
+    The id is a hash of the normalized email or phone, so a duplicate
+    costs one key lookup to find. Returns None if the field is missing.
+    """
+    if dedup == 'email':
+        value = normalize(values.get('email'))
+    else:
+        value = normalize_phone(values.get('phone'))
+    if not value:
+        return None
+    return '%s-%s' % (dedup, hashlib.sha1(value.encode('utf-8')).hexdigest())
+
+def dedup_field(key):
+    """Returns the field a contact's key id was derived from by
+    dedup_key_id, or None if it has an allocated id."""
+    key_id = key.id()
+    if isinstance(key_id, basestring):
+        field = key_id.partition('-')[0]
+        if field in ('email', 'phone'):
+            return field
+    return None
+
 class ContactModel(ndb.Model):
     first_name = ndb.StringProperty()
     last_name = ndb.StringProperty()
     email = ndb.StringProperty()
     phone = ndb.StringProperty()
     created = ndb.DateTimeProperty(auto_now_add=True)
+    # Normalized copies for prefix search, see index.yaml.
+    first_name_lower = ndb.ComputedProperty(lambda self: normalize(self.first_name))
+    last_name_lower = ndb.ComputedProperty(lambda self: normalize(self.last_name))
+    email_lower = ndb.ComputedProperty(lambda self: normalize(self.email))
 
     @classmethod
     def query_by_id(cls, user_id, key_id):
@@ -40,38 +109,196 @@ class ContactModel(ndb.Model):
         return contact_key.get()
 
     @classmethod
-    def query_by_owner(cls, user):
-        return ContactModel.query(ancestor=user.key).fetch()
+    def query_by_owner(cls, user_key):
+        return ContactModel.query(ancestor=user_key).fetch()
+
+    @classmethod
+    @ndb.transactional
+    def upsert(cls, user_key, key_id, values):
+        """Creates the contact key_id, or updates it with the non-None values."""
+        key = ndb.Key(cls, key_id, parent=user_key)
+        contact = key.get()
+        if contact is None:
+            contact = cls(key=key, **values)
+        else:
+            contact.populate(**{k: v for (k, v) in values.items() if v is not None})
+        contact.put()
+        return contact
+
+    @classmethod
+    def search_by_prefix(cls, user_key, prefix, limit):
+        """Returns up to limit of the user's contacts whose first name, last
+        name or email starts with prefix, ignoring case."""
+        start = normalize(prefix)
+        end = start + u'\ufffd'
+        # One ancestor-scoped range scan per property, run in parallel.
+        futures = [cls.query(prop >= start, prop < end, ancestor=user_key)
+                      .fetch_async(limit, keys_only=True)
+                   for prop in (cls.first_name_lower, cls.last_name_lower,
+                                cls.email_lower)]
+        keys = []
+        for future in futures:
+            for key in future.get_result():
+                if key not in keys:
+                    keys.append(key)
+        return [c for c in ndb.get_multi(keys[:limit]) if c is not None]
+
+def backfill_key():
+    # Built when used, so it has the app id of the running app.
+    return ndb.Key(JobModel, 'backfill-contacts')
+
+def start_contact_backfill():
+    """Starts re-saving every contact, unless a backfill is running.
+    Returns the backfill's job."""
+    job = backfill_key().get()
+    if job is None or job.status != JobStatus.RUNNING:
+        job = JobModel(key=backfill_key(), job_type='backfill',
+                       target_kind=ContactModel._get_kind())
+        save_and_continue(job, BACKFILL_URL, BACKFILL_QUEUE)
+    return job
+
+@ndb.transactional_tasklet
+def _resave(key):
+    # Re-read, so an edit made since the batch was fetched is kept.
+    contact = yield key.get_async()
+    if contact is not None:
+        yield contact.put_async()
+
+def run_backfill_batch(job):
+    """Re-saves the next batch of contacts, which writes their computed
+    properties."""
+    start_cursor = ndb.Cursor(urlsafe=job.cursor) if job.cursor else None
+    keys, cursor, more = ContactModel.query().fetch_page(
+        app.config['CONTACT_BACKFILL_BATCH_SIZE'], start_cursor=start_cursor,
+        keys_only=True)
+    futures = [_resave(key) for key in keys]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+    job.processed += len(keys)
+    if more and cursor:
+        job.cursor = cursor.urlsafe()
+    else:
+        job.cursor = None
+        job.status = JobStatus.DONE
+    save_and_continue(job, BACKFILL_URL, BACKFILL_QUEUE)
+
+@task_required
+def backfill_task():
+    job = ndb.Key(urlsafe=request.form['job']).get()
+    # Nothing to do if a duplicate task already ran this batch.
+    if (job and job.status == JobStatus.RUNNING and
+            (job.cursor or '') == request.form.get('cursor', '')):
+        run_backfill_batch(job)
+    return ('', 200)
+
+def backfill_stats():
+    """Returns the progress of the last contact backfill."""
+    job = backfill_key().get()
+    if job is None:
+        return None
+    return {'status': job.status, 'processed': job.processed,
+            'updated': job.updated.isoformat()}
 
 class ContactListAPI(Resource):
     method_decorators = [user_required]
-    contact_list_fields = {'contacts': fields.List(fields.Nested(contact_fields))}
+    # Fieldsets served by a projection, see index.yaml.
+    projections = (('email',), ('first_name', 'last_name', 'email'))
 
     def __init__(self):
         self.post_parser = parser(True, True)
+        self.dedup_parser = dedup_parser()
+        self.get_parser = page_parser()
         super(ContactListAPI, self).__init__()
 
-    @marshal_with(contact_list_fields)
+    @versioned('ContactModel')
+    @marshal_with_fieldset(contact_fields, 'contacts')
     def get(self):
-        user = current_user()
-        contacts = ContactModel.query_by_owner(user)
-        return {'contacts': contacts}
+        query = ContactModel.query(ancestor=current_user_key())
+        fields = requested_fields(contact_fields)
+        contacts, next_cursor = fetch_page(query, self.get_parser.parse_args(),
+                projection=projection(ContactModel, fields, self.projections))
+        return {'contacts': contacts, 'next_cursor': next_cursor}
 
     @marshal_with(contact_fields)
     def post(self):
-        user = current_user()
+        """Creates a contact. With ?dedup=email or ?dedup=phone, a contact
+        with the same normalized email or phone is updated instead."""
         args = self.post_parser.parse_args()
-        contact = ContactModel(parent=ndb.Key(UserModel, user.key.id()), **args)
-        contact.put()
+        dedup = self.dedup_parser.parse_args().dedup
+        if dedup:
+            key_id = dedup_key_id(dedup, args)
+            if not key_id:
+                abort(400)
+            contact = ContactModel.upsert(current_user_key(), key_id, args)
+        else:
+            contact = ContactModel(parent=current_user_key(), **args)
+            contact.put()
+        bump_version(current_user_key(), 'ContactModel')
         return contact
 
-    @marshal_with(contact_list_fields)
+    @marshal_with(job_fields)
     def delete(self):
-        user = current_user()
-        ndb.delete_multi(ContactModel.query(ancestor=user.key).fetch(keys_only=True))
-        contacts = ContactModel.query_by_owner(user)
+        # Deleting runs in the background, see job.py.
+        return start_delete_job(current_user_key(), ContactModel), 202
+
+class ContactSearchAPI(Resource):
+    '''Prefix search over first name, last name and email.'''
+    method_decorators = [user_required]
+
+    def __init__(self):
+        self.get_parser = reqparse.RequestParser()
+        self.get_parser.add_argument('q', type = unicode, required = True, location = 'args')
+        self.get_parser.add_argument('limit', type = int, location = 'args')
+        super(ContactSearchAPI, self).__init__()
+
+    @marshal_with_fieldset(contact_fields, 'contacts', paged=False)
+    def get(self):
+        args = self.get_parser.parse_args()
+        if not args.q.strip() or (args.limit is not None and args.limit < 1):
+            abort(400)
+        max_results = app.config['SEARCH_MAX_RESULTS']
+        limit = min(args.limit or max_results, max_results)
+        contacts = ContactModel.search_by_prefix(current_user_key(), args.q, limit)
         return {'contacts': contacts}
 
+class ContactImportAPI(Resource):
+    '''Bulk import of a CSV file (with a header row) or of vCards.
+
+    The upload is the request body, or the `file` field of a multipart form.
+    With ?dedup=email or ?dedup=phone, rows replace the existing contact
+    with the same normalized email or phone.
+    '''
+    method_decorators = [user_required]
+    vcard_types = ('text/vcard', 'text/x-vcard', 'text/directory')
+
+    def __init__(self):
+        self.post_parser = reqparse.RequestParser()
+        self.post_parser.add_argument('format', type = str, location = 'args',
+                                      choices = ('csv', 'vcard'))
+        self.dedup_parser = dedup_parser()
+        super(ContactImportAPI, self).__init__()
+
+    def post(self):
+        args = self.post_parser.parse_args()
+        upload = request.files.get('file')
+        stream = upload.stream if upload else request.stream
+        content_type = upload.mimetype if upload else request.mimetype
+        if args.format == 'vcard' or (not args.format and content_type in self.vcard_types):
+            rows = iter_vcards(stream)
+        else:
+            rows = iter_csv(stream)
+        dedup = self.dedup_parser.parse_args().dedup
+        key_id = (lambda values: dedup_key_id(dedup, values)) if dedup else None
+        importer = ContactImporter(ContactModel, current_user_key(),
+                                   app.config['CONTACT_IMPORT_BATCH_SIZE'],
+                                   key_id)
+        try:
+            return importer.run(rows)
+        finally:
+            # Rows written before a failure still change the collection.
+            bump_version(current_user_key(), 'ContactModel')
+
 class ContactAPI(Resource):
     method_decorators = [user_required]
 
@@ -79,30 +306,44 @@ class ContactAPI(Resource):
         self.put_parser = parser(False, False)
         super(ContactAPI, self).__init__()
 
-    @marshal_with(contact_fields)
+    @versioned('ContactModel')
+    @marshal_with_fieldset(contact_fields)
     def get(self, key_id):
-        user = current_user()
-        contact = ContactModel.query_by_id(user.key.id(), key_id)
+        contact = ContactModel.query_by_id(current_user_key().id(), key_id)
         if contact is None:
             abort(404)
         return contact
 
     @marshal_with(contact_fields)
     def put(self, key_id):
-        user = current_user()
-        contact = ContactModel.query_by_id(user.key.id(), key_id)
+        contact = ContactModel.query_by_id(current_user_key().id(), key_id)
         if contact is None:
             abort(404)
         args = self.put_parser.parse_args()
         args = {k:v for (k, v) in args.items() if v is not None}  # Remove empty arguments
         contact.populate(**args)
+        # A deduplicated contact keeps the email or phone its key came from,
+        # so later dedup requests still find it.
+        dedup = dedup_field(contact.key)
+        if dedup and dedup_key_id(dedup, contact.to_dict()) != contact.key.id():
+            abort(409)
         contact.put()
+        bump_version(contact.key.parent(), 'ContactModel')
         return contact
 
     def delete(self, key_id):
-        user = current_user()
-        contact = ContactModel.query_by_id(user.key.id(), key_id)
+        contact = ContactModel.query_by_id(current_user_key().id(), key_id)
         if contact is None:
             abort(404)
         contact.key.delete()
+        run_delete_hooks(contact.key.parent(), [contact.key])
+        bump_version(contact.key.parent(), 'ContactModel')
         return make_response("", 204)
+
+class AdminContactBackfillAPI(Resource):
+    '''Starts the backfill of the contacts' search properties.'''
+    method_decorators = [admin_required]
+
+    def post(self):
+        start_contact_backfill()
+        return backfill_stats(), 202
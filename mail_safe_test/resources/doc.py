@@ -3,25 +3,125 @@ doc.py
 
 """
 
+import aniso8601
+import pytz
+import time
+from datetime import datetime
 from flask import request, Response, abort, make_response
-from flask.ext.restful import Resource, fields, marshal_with, reqparse
+from flask.ext.restful import Resource, fields, marshal, marshal_with, reqparse
+from google.appengine.api import memcache
 from google.appengine.ext import ndb, blobstore
+from mail_safe_test import app
 from mail_safe_test.custom_fields import NDBUrl
-from mail_safe_test.auth import current_user, user_required, admin_required, UserModel
+from mail_safe_test.fieldsets import marshal_with_fieldset, projection, requested_fields
+from mail_safe_test.doc_storage import (DocChunkModel, DocRevisionModel, delete_content,
+                                        prepare_content_async, read_content,
+                                        read_revision)
+from mail_safe_test.pagination import fetch_page, list_fields, page_parser
+from mail_safe_test.resources.job import delete_children, job_fields, start_delete_job
+from mail_safe_test.versioning import bump_version, versioned
+from mail_safe_test.auth import current_user_key, user_required, admin_required, UserModel
 
 #   public exports
-doc_fields = {
+doc_summary_fields = {
     'title': fields.String,
-    'content': fields.String,
     'date': fields.DateTime,
     'status': fields.Integer,
     'uri': NDBUrl('/user/doc/')
 }
 
+doc_fields = dict(doc_summary_fields, content=fields.String,
+                  revision=fields.Integer(attribute='content_generation'))
+
+# What a recipient sees, see doc_view().
+doc_view_fields = {
+    'title': fields.String,
+    'date': fields.DateTime,
+    'content': fields.String,
+}
+
+DOC_VIEW_PREFIX = 'doc_view:'
+DOC_VIEW_POLL_INTERVAL = 0.05
+
+revision_fields = {
+    'number': fields.Integer,
+    'created': fields.DateTime,
+    'size': fields.Integer
+}
+
 class DocStatus:
     DRAFT = 0
     SENT = 1
 
+def _forget_view(doc_key):
+    # After the commit, or a request could cache the view it read before.
+    cache_key = DOC_VIEW_PREFIX + doc_key.urlsafe()
+    ndb.get_context().call_on_commit(lambda: memcache.delete(cache_key))
+
+def doc_view(doc_key, doc=None):
+    """Returns doc_key's doc marshalled with doc_view_fields, or None if
+    there is no such doc. doc is the doc if the caller already has it.
+
+    The view is cached in memcache until the doc changes. Only one request
+    at a time renders a missing view; the others wait up to
+    DOC_VIEW_WAIT_TIME seconds for it before rendering it themselves.
+    """
+    cache_key = DOC_VIEW_PREFIX + doc_key.urlsafe()
+    view = memcache.get(cache_key)
+    if view is not None:
+        return view
+    lock_key = cache_key + ':lock'
+    locked = memcache.add(lock_key, 1, time=app.config['DOC_VIEW_LOCK_TIME'])
+    if not locked:
+        waited = 0.0
+        while waited < app.config['DOC_VIEW_WAIT_TIME']:
+            time.sleep(DOC_VIEW_POLL_INTERVAL)
+            waited += DOC_VIEW_POLL_INTERVAL
+            view = memcache.get(cache_key)
+            if view is not None:
+                return view
+    try:
+        if doc is None:
+            doc = doc_key.get()
+        if doc is None:
+            return None
+        view = marshal(doc, doc_view_fields)
+        try:
+            memcache.set(cache_key, view, time=app.config['DOC_VIEW_CACHE_TIME'])
+        except ValueError:
+            pass  # Larger than a memcache value, so served uncached.
+        return view
+    finally:
+        if locked:
+            memcache.delete(lock_key)
+
+def status_type(value):
+    """Parses a DocStatus name, e.g. 'draft', or its number."""
+    if value.isdigit() and int(value) in DocStatus.__dict__.values():
+        return int(value)
+    status = getattr(DocStatus, value.upper(), None)
+    if not isinstance(status, int):
+        raise ValueError('unknown status %s' % value)
+    return status
+
+def datetime_type(value):
+    """Parses an ISO 8601 date or datetime into a naive UTC datetime."""
+    if 'T' in value:
+        value = aniso8601.parse_datetime(value)
+    else:
+        value = datetime.combine(aniso8601.parse_date(value), datetime.min.time())
+    if value.tzinfo is not None:
+        value = value.astimezone(pytz.utc).replace(tzinfo=None)
+    return value
+
+def list_parser():
+    parser = page_parser()
+    parser.add_argument('status', type = status_type, location = 'args')
+    parser.add_argument('order', type = str, location = 'args', choices = ('date', '-date'))
+    parser.add_argument('since', type = datetime_type, location = 'args')
+    parser.add_argument('until', type = datetime_type, location = 'args')
+    return parser
+
 def parser(required_status):
     parser = reqparse.RequestParser()
     parser.add_argument('title', type = str, location = 'json')
@@ -29,50 +129,174 @@ def parser(required_status):
     parser.add_argument('status', type = int, required = required_status, location = 'json')
     return parser
 
+_UNLOADED = object()
+
 class DocModel(ndb.Model):
+    '''A document. The body is stored separately and loaded on first use
+    of `content`, see doc_storage.py. content_generation is also the
+    number of the current revision.'''
     title = ndb.StringProperty()
-    content = ndb.StringProperty()
     date = ndb.DateTimeProperty(auto_now_add=True)
     status = ndb.IntegerProperty()
+    content_generation = ndb.IntegerProperty(default=0, indexed=False)
+    content_chunks = ndb.IntegerProperty(default=0, indexed=False)
+    # Bodies saved before the chunked storage. Cleared when rewritten.
+    legacy_content = ndb.TextProperty('content')
+
+    def __init__(self, *args, **kwargs):
+        content = kwargs.pop('content', _UNLOADED)
+        super(DocModel, self).__init__(*args, **kwargs)
+        self._content = _UNLOADED
+        self._content_dirty = False
+        if content is not _UNLOADED:
+            self.content = content
+
+    def populate(self, **kwargs):
+        if 'content' in kwargs:
+            self.content = kwargs.pop('content')
+        super(DocModel, self).populate(**kwargs)
+
+    @property
+    def content(self):
+        if self._content is _UNLOADED:
+            if self.content_chunks:
+                self._content = read_content(self.key, self.content_generation,
+                                             self.content_chunks)
+            else:
+                self._content = self.legacy_content
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._content_dirty = True
+
+    def _put_async(self, **ctx_options):
+        if not self._content_dirty:
+            return super(DocModel, self)._put_async(**ctx_options)
+        return self._put_content_async(**ctx_options)
+    put_async = _put_async
+
+    @ndb.tasklet
+    def _put_content_async(self, **ctx_options):
+        if self.key is None or self.key.id() is None:
+            # The chunks are children of the doc, so it needs its id first.
+            parent = self.key.parent() if self.key else None
+            first, _ = yield DocModel.allocate_ids_async(size=1, parent=parent)
+            self.key = ndb.Key(DocModel, first, parent=parent)
+        generation, count, entities, stale = yield prepare_content_async(
+            self.key, self.content_generation, self.content_chunks, self._content,
+            app.config['DOC_SNAPSHOT_INTERVAL'], app.config['DOC_CHUNK_SIZE'])
+        previous = (self.content_generation, self.content_chunks, self.legacy_content)
+        self.content_generation, self.content_chunks = generation, count
+        self.legacy_content = None
+        put = super(DocModel, self)._put_async
+        try:
+            if ndb.in_transaction():
+                # All of it commits at once, so it goes in one batch.
+                key, _, _ = yield (put(**ctx_options), ndb.put_multi_async(entities),
+                                   ndb.delete_multi_async(stale))
+            else:
+                yield ndb.put_multi_async(entities)
+                try:
+                    key = yield put(**ctx_options)
+                except Exception:
+                    # Nothing points to the new generation.
+                    yield ndb.delete_multi_async([e.key for e in entities])
+                    raise
+                yield ndb.delete_multi_async(stale)
+        except Exception:
+            self.content_generation, self.content_chunks, self.legacy_content = previous
+            raise
+        self._content_dirty = False
+        raise ndb.Return(key)
+
+    def _post_put_hook(self, future):
+        if future.get_exception() is None:
+            _forget_view(self.key)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        # The body is deleted by DocAPI.delete, or by kind in delete jobs.
+        _forget_view(key)
 
     @classmethod
-    def query_by_id(cls, user, doc_id):
-        doc_key = ndb.Key(UserModel, user.key.id(), DocModel, doc_id)
+    def query_by_id(cls, user_id, doc_id):
+        doc_key = ndb.Key(UserModel, user_id, DocModel, doc_id)
         return doc_key.get()
 
     @classmethod
-    def query_by_owner(cls, user):
-        return DocModel.query(ancestor=user.key).fetch()
+    def query_by_owner(cls, user_key):
+        return DocModel.query(ancestor=user_key).fetch()
+
+    @classmethod
+    def query_filtered(cls, user_key, status=None, since=None, until=None, order=None):
+        """Returns a query of the user's docs with the given status, dated
+        in [since, until), ordered by date ('date' or '-date').
+
+        Any filter orders the docs newest first by default, so that every
+        combination is served by an index in index.yaml.
+        """
+        query = cls.query(ancestor=user_key)
+        if status is not None:
+            query = query.filter(cls.status == status)
+        if since is not None:
+            query = query.filter(cls.date >= since)
+        if until is not None:
+            query = query.filter(cls.date < until)
+        if order is None and (status, since, until) != (None, None, None):
+            order = '-date'
+        if order == 'date':
+            query = query.order(cls.date)
+        elif order == '-date':
+            query = query.order(-cls.date)
+        return query
+
+# Bodies are children of their doc, so a delete job deletes them by kind
+# after the docs instead of with a query per doc.
+delete_children[DocModel._get_kind()] = [DocRevisionModel._get_kind(),
+                                         DocChunkModel._get_kind()]
 
 class DocListAPI(Resource):
     method_decorators = [user_required]
-    doc_list_fields = {'docs': fields.List(fields.Nested(doc_fields))}
+    # Fieldsets served by a projection, see index.yaml.
+    projections = (('title',), ('title', 'date', 'status'))
 
     def __init__(self):
         # TODO - Should we require a status from the front-end or default it to "Draft" if one is not provided?
         self.post_parser = parser(False)
+        self.get_parser = list_parser()
         super(DocListAPI, self).__init__()
         
-    @marshal_with(doc_list_fields)
+    # Lists leave out the bodies, so they are never loaded.
+    @versioned('DocModel')
+    @marshal_with_fieldset(doc_summary_fields, 'docs')
     def get(self):
-        user = current_user()
-        docs = DocModel.query_by_owner(user)
-        return {'docs': docs}
+        args = self.get_parser.parse_args()
+        if args.since and args.until and args.since >= args.until:
+            abort(400)
+        query = DocModel.query_filtered(current_user_key(), args.status,
+                                        args.since, args.until, args.order)
+        # The projection indexes only cover the unfiltered, unordered list.
+        fields = None
+        if (args.status, args.since, args.until, args.order) == (None, None, None, None):
+            fields = requested_fields(doc_summary_fields)
+        docs, next_cursor = fetch_page(query, args,
+                projection=projection(DocModel, fields, self.projections))
+        return {'docs': docs, 'next_cursor': next_cursor}
 
     @marshal_with(doc_fields)
     def post(self):
-        user = current_user()
         args = self.post_parser.parse_args()
-        doc = DocModel(parent=ndb.Key(UserModel, user.key.id()), **args)
+        doc = DocModel(parent=current_user_key(), **args)
         doc.put()
+        bump_version(doc.key.parent(), 'DocModel')
         return doc
 
-    @marshal_with(doc_list_fields)
+    @marshal_with(job_fields)
     def delete(self):
-        user = current_user()
-        ndb.delete_multi(DocModel.query(ancestor=user.key).fetch(keys_only=True))
-        docs = DocModel.query_by_owner(user)
-        return {'docs': docs}
+        # Deleting runs in the background, see job.py.
+        return start_delete_job(current_user_key(), DocModel), 202
 
 class DocAPI(Resource):
     method_decorators = [user_required]
@@ -81,30 +305,71 @@ class DocAPI(Resource):
         self.put_parser = parser(False)
         super(DocAPI, self).__init__()
 
-    @marshal_with(doc_fields)
+    @versioned('DocModel')
+    @marshal_with_fieldset(doc_fields)
     def get(self, key_id):
-        user = current_user()
-        doc = DocModel.query_by_id(user, key_id)
+        doc = DocModel.query_by_id(current_user_key().id(), key_id)
         if doc is None:
             abort(404)
         return doc
     
     @marshal_with(doc_fields)
     def put(self, key_id):
-        user = current_user()
-        doc = DocModel.query_by_id(user, key_id)
-        if doc is None:
-            abort(404)
         args = self.put_parser.parse_args()
         args = {k:v for (k, v) in args.items() if v is not None}  # Remove empty arguments
-        doc.populate(**args)
-        doc.put()
+
+        # Concurrent saves must not both write the same next revision.
+        @ndb.transactional
+        def txn():
+            doc = DocModel.query_by_id(current_user_key().id(), key_id)
+            if doc is None:
+                abort(404)
+            doc.populate(**args)
+            doc.put()
+            return doc
+        doc = txn()
+        bump_version(doc.key.parent(), 'DocModel')
         return doc
 
     def delete(self, key_id):
-        user = current_user()
-        doc = DocModel.query_by_id(user, key_id)
+        doc = DocModel.query_by_id(current_user_key().id(), key_id)
         if doc is None:
             abort(404)
         doc.key.delete()
+        delete_content(doc.key)
+        bump_version(doc.key.parent(), 'DocModel')
         return make_response("", 204)
+
+class DocRevisionListAPI(Resource):
+    method_decorators = [user_required]
+    revision_list_fields = list_fields('revisions', revision_fields)
+
+    def __init__(self):
+        self.get_parser = page_parser()
+        super(DocRevisionListAPI, self).__init__()
+
+    @versioned('DocModel')
+    @marshal_with(revision_list_fields)
+    def get(self, key_id):
+        doc = DocModel.query_by_id(current_user_key().id(), key_id)
+        if doc is None:
+            abort(404)
+        # Newest first, see index.yaml.
+        query = DocRevisionModel.query(ancestor=doc.key).order(-DocRevisionModel.number)
+        revisions, next_cursor = fetch_page(query, self.get_parser.parse_args(),
+                projection=[DocRevisionModel.number, DocRevisionModel.created,
+                            DocRevisionModel.size])
+        return {'revisions': revisions, 'next_cursor': next_cursor}
+
+class DocRevisionAPI(Resource):
+    method_decorators = [user_required]
+
+    @versioned('DocModel')
+    @marshal_with(dict(revision_fields, content=fields.String))
+    def get(self, key_id, number):
+        doc_key = ndb.Key(UserModel, current_user_key().id(), DocModel, key_id)
+        revision, content = read_revision(doc_key, number)
+        if revision is None:
+            abort(404)
+        return {'number': revision.number, 'created': revision.created,
+                'size': revision.size, 'content': content}
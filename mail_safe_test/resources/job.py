@@ -0,0 +1,159 @@
+"""
+job.py
+
+Background jobs that run as a chain of task queue tasks. Each task does
+one bounded batch of work and saves its progress on the JobModel, so a
+failed task is retried from the last saved cursor.
+
+"""
+
+from flask import abort, request
+from flask.ext.restful import Resource, fields
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from mail_safe_test import app
+from mail_safe_test.custom_fields import NDBUrl
+from mail_safe_test.fieldsets import marshal_with_fieldset
+from mail_safe_test.auth import current_user_key, user_required, task_required, UserModel
+from mail_safe_test.versioning import bump_version
+
+# Public exports
+job_fields = {
+    'type': fields.String(attribute='job_type'),
+    'status': fields.Integer,
+    'processed': fields.Integer,
+    'shards': fields.Integer,
+    'shards_done': fields.Integer,
+    'created': fields.DateTime,
+    'updated': fields.DateTime,
+    'uri': NDBUrl('/user/job/')
+}
+
+class JobStatus:
+    RUNNING = 0
+    DONE = 1
+
+class JobModel(ndb.Model):
+    job_type = ndb.StringProperty()
+    target_kind = ndb.StringProperty(indexed=False)
+    status = ndb.IntegerProperty(default=JobStatus.RUNNING)
+    cursor = ndb.StringProperty(indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+    # Sharded jobs: shards created, shards finished, and whether all of
+    # the shards have been created.
+    shards = ndb.IntegerProperty(default=0, indexed=False)
+    shards_done = ndb.IntegerProperty(default=0, indexed=False)
+    fanned_out = ndb.BooleanProperty(default=False, indexed=False)
+    # Send jobs: the doc sent, and the list sent to (None for all contacts).
+    doc = ndb.KeyProperty(kind='DocModel', indexed=False)
+    contact_list = ndb.KeyProperty(kind='ListModel', indexed=False)
+    # Sends to a list: its members when the send started.
+    contacts = ndb.KeyProperty(kind='ContactModel', repeated=True, indexed=False)
+    # Sweeps: what is older than cutoff is deleted, and the time spent in
+    # batches so far.
+    cutoff = ndb.DateTimeProperty(indexed=False)
+    elapsed_ms = ndb.IntegerProperty(default=0, indexed=False)
+    # Delete jobs: which of target_kind and its delete_children is being
+    # deleted.
+    kind_index = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def query_by_id(cls, user_id, key_id):
+        # Jobs have allocated ids, or names such as those of send jobs
+        # with an idempotency key.
+        try:
+            job_id = int(key_id)
+        except ValueError:
+            job_id = key_id
+        return ndb.Key(UserModel, user_id, JobModel, job_id).get()
+
+# Job type -> function(job), which fills in the progress of jobs that keep
+# it outside the job, e.g. send jobs (see mail.py).
+job_progress = {}
+
+def load_progress(job):
+    """Returns job, with its progress filled in if it is kept elsewhere."""
+    if job.job_type in job_progress:
+        job_progress[job.job_type](job)
+    return job
+
+def save_and_continue(job, url, queue_name='default', countdown=0):
+    """Saves job and, if it is still running, enqueues its next task to
+    run in countdown seconds.
+
+    Both happen in one transaction, so a task runs only for a saved job.
+    """
+    @ndb.transactional
+    def txn():
+        job.put()
+        if job.status == JobStatus.RUNNING:
+            params = {'job': job.key.urlsafe(), 'cursor': job.cursor or ''}
+            taskqueue.add(url=url, params=params, queue_name=queue_name,
+                          countdown=countdown, transactional=True)
+    txn()
+
+# Kind -> function(user_key, keys), called after keys of that kind are
+# deleted, e.g. to remove deleted contacts from lists (see list.py).
+delete_hooks = {}
+
+def run_delete_hooks(user_key, keys):
+    """Runs the delete hook of the kind of keys, if it has one."""
+    if keys and keys[0].kind() in delete_hooks:
+        delete_hooks[keys[0].kind()](user_key, keys)
+
+# Kind -> kinds of its descendants, which a delete job deletes after it,
+# e.g. the bodies of docs (see doc.py).
+delete_children = {}
+
+def start_delete_job(user_key, model):
+    """Starts deleting all of the user's entities of model. Returns the job."""
+    job = JobModel(parent=user_key, job_type='delete',
+                   target_kind=model._get_kind())
+    save_and_continue(job, '/tasks/delete/')
+    return job
+
+def run_delete_batch(job):
+    """Deletes the next batch of keys of a delete job."""
+    kinds = [job.target_kind] + delete_children.get(job.target_kind, [])
+    kind = kinds[job.kind_index]
+    query = ndb.Query(kind=kind, ancestor=job.key.parent())
+    start_cursor = ndb.Cursor(urlsafe=job.cursor) if job.cursor else None
+    keys, cursor, more = query.fetch_page(app.config['DELETE_BATCH_SIZE'],
+                                          start_cursor=start_cursor,
+                                          keys_only=True)
+    ndb.delete_multi(keys)
+    if kind == job.target_kind:
+        run_delete_hooks(job.key.parent(), keys)
+        bump_version(job.key.parent(), job.target_kind)
+        job.processed += len(keys)
+    if more and cursor:
+        job.cursor = cursor.urlsafe()
+    elif job.kind_index + 1 < len(kinds):
+        job.cursor = None
+        job.kind_index += 1
+    else:
+        job.cursor = None
+        job.status = JobStatus.DONE
+    save_and_continue(job, '/tasks/delete/')
+
+@task_required
+def delete_task():
+    job = ndb.Key(urlsafe=request.form['job']).get()
+    # Nothing to do if the job is gone or a duplicate task already ran
+    # this batch.
+    if (job and job.status == JobStatus.RUNNING and
+            (job.cursor or '') == request.form.get('cursor', '')):
+        run_delete_batch(job)
+    return ('', 200)
+
+class JobAPI(Resource):
+    method_decorators = [user_required]
+
+    @marshal_with_fieldset(job_fields)
+    def get(self, key_id):
+        job = JobModel.query_by_id(current_user_key().id(), key_id)
+        if job is None:
+            abort(404)
+        return load_progress(job)
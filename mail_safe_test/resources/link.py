@@ -1,13 +1,45 @@
 """
 link.py
 
+A link is what a recipient of a sent doc follows, see mail.py. Its doc
+is only shown for a code texted to the recipient's phone: GET
+/auth/<key_id>/ sends a code, and POST /link/<key_id> with the code
+returns the doc. See otp.py. Only then is the link marked clicked, in a
+transaction, so resolving a link never writes it.
+
+Expired links are deleted by a sweep that cron starts every hour, see
+cron.yaml. It is a job (see job.py) on the maintenance queue that deletes
+LINK_SWEEP_BATCH_SIZE keys per task, found with a keys-only query, and
+saves its cursor as a checkpoint after each batch. Each task is timed,
+and the next one waits at least as long as it took, so the sweep uses at
+most half of one instance's time.
+
+Links are resolved from memcache. On a miss the link is read, then its
+doc, contact and the doc's owner in one get_multi, and the facts needed to
+serve it are cached until it expires or for LINK_CACHE_TIME seconds. The
+doc itself is served from the per-doc view cache, see doc.doc_view().
 """
 
+import logging
+import time
+from datetime import datetime, timedelta
 from flask import request, Response, abort, make_response
 from flask.ext.restful import Resource, fields, marshal_with, reqparse
+from google.appengine.api import memcache
 from google.appengine.ext import ndb, blobstore
+from mail_safe_test import app
 from mail_safe_test.custom_fields import NDBUrl
-from mail_safe_test.auth import current_user, user_required, admin_required, UserModel
+from mail_safe_test.auth import current_user, user_required, admin_required, task_required, UserModel
+from mail_safe_test.otp import OTPResult, issue_otp, verify_otp
+from mail_safe_test.resources.doc import doc_view
+from mail_safe_test.resources.job import JobModel, JobStatus, save_and_continue
+from mail_safe_test.sms import SMSError
+
+LINK_PREFIX = 'link:'
+# Links with no expiry sort before this, and are never swept.
+EPOCH = datetime(1970, 1, 1)
+SWEEP_URL = '/tasks/links/sweep/'
+SWEEP_QUEUE = 'maintenance'
 
 class LinkModel(ndb.Model):
     contact = ndb.KeyProperty(kind='ContactModel')
@@ -16,7 +48,160 @@ class LinkModel(ndb.Model):
     expires = ndb.DateTimeProperty()
     otp = ndb.StringProperty()
     otp_expire = ndb.DateTimeProperty()
+    # When its message was sent, or why the transport rejected it.
+    sent = ndb.DateTimeProperty(indexed=False)
+    error = ndb.StringProperty(indexed=False)
+
+def sweep_key():
+    # Built when used, so it has the app id of the running app.
+    return ndb.Key(JobModel, 'sweep-links')
+
+def start_link_sweep(now):
+    """Starts a sweep of the links expired by now, or resumes one that
+    stopped making progress. Returns the sweep's job."""
+    job = sweep_key().get()
+    if job is not None and job.status == JobStatus.RUNNING:
+        stale = now - timedelta(seconds=app.config['LINK_SWEEP_STALE_TIME'])
+        if job.updated > stale:
+            return job  # Still running.
+        # Resumes from the saved cursor. A task of the old chain that
+        # still runs is skipped as a duplicate, see sweep_task().
+    else:
+        job = JobModel(key=sweep_key(), job_type='sweep',
+                       target_kind=LinkModel._get_kind(), cutoff=now)
+    save_and_continue(job, SWEEP_URL, SWEEP_QUEUE)
+    return job
+
+def run_sweep_batch(job):
+    """Deletes the next batch of links that expired before job.cutoff."""
+    start = time.time()
+    query = LinkModel.query(LinkModel.expires >= EPOCH,
+                            LinkModel.expires < job.cutoff)
+    start_cursor = ndb.Cursor(urlsafe=job.cursor) if job.cursor else None
+    keys, cursor, more = query.fetch_page(app.config['LINK_SWEEP_BATCH_SIZE'],
+                                          start_cursor=start_cursor,
+                                          keys_only=True)
+    ndb.delete_multi(keys)
+    elapsed = time.time() - start
+    job.processed += len(keys)
+    job.elapsed_ms += int(elapsed * 1000)
+    if more and cursor:
+        job.cursor = cursor.urlsafe()
+    else:
+        job.cursor = None
+        job.status = JobStatus.DONE
+    save_and_continue(job, SWEEP_URL, SWEEP_QUEUE,
+                      countdown=max(app.config['LINK_SWEEP_INTERVAL'], elapsed))
+
+@task_required
+def sweep_cron():
+    start_link_sweep(datetime.utcnow())
+    return ('', 200)
+
+@task_required
+def sweep_task():
+    job = ndb.Key(urlsafe=request.form['job']).get()
+    # Nothing to do if a duplicate task already ran this batch.
+    if (job and job.status == JobStatus.RUNNING and
+            (job.cursor or '') == request.form.get('cursor', '')):
+        run_sweep_batch(job)
+    return ('', 200)
+
+def sweep_stats():
+    """Returns the progress of the last link sweep."""
+    job = sweep_key().get()
+    if job is None:
+        return None
+    return {'status': job.status, 'processed': job.processed,
+            'elapsed_ms': job.elapsed_ms, 'cutoff': job.cutoff.isoformat(),
+            'updated': job.updated.isoformat()}
+
+def _cache_time(expires, now):
+    if expires is None:
+        return app.config['LINK_CACHE_TIME']
+    left = int((expires - now).total_seconds())
+    return max(1, min(app.config['LINK_CACHE_TIME'], left))
+
+def resolve_link(key_id):
+    """Returns a dict with the doc key, expiry and names of a link, or None
+    if the link, its doc or its contact is gone."""
+    cache_key = LINK_PREFIX + key_id
+    resolved = memcache.get(cache_key)
+    if resolved is not None:
+        return resolved
+    link = LinkModel.get_by_id(key_id)
+    if link is None:
+        return None
+    doc, contact, owner = ndb.get_multi([link.doc, link.contact, link.doc.parent()])
+    if doc is None or contact is None:
+        return None
+    resolved = {
+        'doc': doc.key,
+        'expires': link.expires,
+        'to_name': contact.first_name,
+        'phone': contact.phone,
+        'from_name': owner.first_name if owner else None,
+    }
+    memcache.set(cache_key, resolved, time=_cache_time(link.expires, datetime.utcnow()))
+    # The doc was read anyway, so have it ready for the view.
+    resolved = dict(resolved, _doc=doc)
+    return resolved
+
+@ndb.transactional
+def mark_clicked(link_key):
+    """Records that a link's doc was shown. Re-reads the link, so a code
+    issued meanwhile is kept."""
+    link = link_key.get()
+    if link is not None and not link.clicked:
+        link.clicked = True
+        link.put()
+
+otp_parser = reqparse.RequestParser()
+otp_parser.add_argument('otp', type=str, location='json', required=True)
+
+def _resolve_live(key_id):
+    resolved = resolve_link(key_id)
+    if resolved is None:
+        abort(404)
+    if resolved['expires'] is not None and resolved['expires'] <= datetime.utcnow():
+        abort(410)
+    return resolved
 
 class Link(Resource):
-    def get(self):
-        return "hi"
+    def get(self, key_id):
+        _resolve_live(key_id)
+        abort(403)
+
+    def post(self, key_id):
+        args = otp_parser.parse_args()
+        resolved = _resolve_live(key_id)
+        link = LinkModel.get_by_id(key_id)
+        if link is None:
+            abort(404)
+        result = verify_otp(link, args.otp)
+        if result == OTPResult.LOCKED:
+            abort(429)
+        if result != OTPResult.OK:
+            abort(403)
+        if not link.clicked:
+            mark_clicked(link.key)
+        view = doc_view(resolved['doc'], resolved.get('_doc'))
+        if view is None:
+            abort(404)
+        return dict(view, to_name=resolved['to_name'], from_name=resolved['from_name'])
+
+class LinkAuth(Resource):
+    '''Texts a code for a link to its recipient.'''
+    def get(self, key_id):
+        resolved = _resolve_live(key_id)
+        link = LinkModel.get_by_id(key_id)
+        if link is None or not resolved.get('phone'):
+            abort(404)
+        try:
+            issued = issue_otp(link, resolved['phone'])
+        except SMSError as e:
+            logging.error('could not text a code for link %s: %s', key_id, e)
+            abort(503)
+        if not issued:
+            abort(429)
+        return {'otp_expire': link.otp_expire.isoformat()}
@@ -0,0 +1,167 @@
+"""
+list.py
+
+Contact lists. Membership is stored on the list entity itself as an
+unindexed repeated key, so loading a page of the members of a list is a
+single get_multi and adding members writes no index rows. Deleted contacts are
+removed from the lists they were in.
+
+"""
+
+from flask import abort, make_response
+from flask.ext.restful import Resource, fields, marshal_with, reqparse
+from google.appengine.ext import ndb
+from mail_safe_test import app
+from mail_safe_test.custom_fields import NDBUrl
+from mail_safe_test.fieldsets import marshal_with_fieldset
+from mail_safe_test.pagination import fetch_page, list_fields, page_parser, slice_page
+from mail_safe_test.resources.contact import ContactModel, contact_fields
+from mail_safe_test.resources.job import delete_hooks, job_fields, start_delete_job
+from mail_safe_test.auth import current_user_key, user_required, UserModel
+
+# Public exports
+list_summary_fields = {
+    'name': fields.String,
+    'size': fields.Integer,
+    'uri': NDBUrl('/user/list/')
+}
+
+def parser(required_name):
+    parser = reqparse.RequestParser()
+    parser.add_argument('name', type = unicode, required = required_name, location = 'json')
+    parser.add_argument('contacts', type = list, location = 'json')
+    return parser
+
+class ListModel(ndb.Model):
+    name = ndb.StringProperty()
+    members = ndb.KeyProperty(kind='ContactModel', repeated=True, indexed=False)
+    size = ndb.ComputedProperty(lambda self: len(self.members))
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def query_by_id(cls, user_id, key_id):
+        try:
+            list_id = int(key_id)
+        except (TypeError, ValueError):
+            return None
+        return ndb.Key(UserModel, user_id, ListModel, list_id).get()
+
+def remove_members(user_key, keys):
+    """Removes the contacts with the given keys from all of the user's lists."""
+    removed = set(keys)
+
+    @ndb.transactional
+    def txn():
+        lists = ListModel.query(ancestor=user_key).fetch()
+        changed = [lst for lst in lists if removed.intersection(lst.members)]
+        for lst in changed:
+            lst.members = [k for k in lst.members if k not in removed]
+        ndb.put_multi(changed)
+    txn()
+
+delete_hooks[ContactModel._get_kind()] = remove_members
+
+def contact_keys(user_key, key_ids, check_exists=True):
+    """Returns the keys of the user's contacts with the given key ids.
+
+    Aborts with 400 if a key id is malformed or, with check_exists, if any
+    of the contacts does not exist.
+    """
+    key_ids = key_ids or []
+    if not all(isinstance(key_id, (int, long, basestring)) for key_id in key_ids):
+        abort(400)
+    keys = [ndb.Key(ContactModel, key_id, parent=user_key) for key_id in key_ids]
+    if check_exists and None in ndb.get_multi(keys):
+        abort(400)
+    return keys
+
+def set_members(lst, members):
+    # Keep the first occurrence of each contact.
+    unique = []
+    seen = set()
+    for key in members:
+        if key not in seen:
+            seen.add(key)
+            unique.append(key)
+    if len(unique) > app.config['MAX_LIST_SIZE']:
+        abort(400)
+    lst.members = unique
+
+class ListListAPI(Resource):
+    method_decorators = [user_required]
+    list_list_fields = list_fields('lists', list_summary_fields)
+
+    def __init__(self):
+        self.post_parser = parser(True)
+        self.get_parser = page_parser()
+        super(ListListAPI, self).__init__()
+
+    @marshal_with(list_list_fields)
+    def get(self):
+        # Project the summary so the members are not loaded, see index.yaml.
+        query = ListModel.query(ancestor=current_user_key())
+        lists, next_cursor = fetch_page(query, self.get_parser.parse_args(),
+                                        projection=[ListModel.name, ListModel.size])
+        return {'lists': lists, 'next_cursor': next_cursor}
+
+    @marshal_with(list_summary_fields)
+    def post(self):
+        user_key = current_user_key()
+        args = self.post_parser.parse_args()
+        lst = ListModel(parent=user_key, name=args.name)
+        set_members(lst, contact_keys(user_key, args.contacts))
+        lst.put()
+        return lst
+
+    @marshal_with(job_fields)
+    def delete(self):
+        return start_delete_job(current_user_key(), ListModel), 202
+
+class ListAPI(Resource):
+    method_decorators = [user_required]
+
+    def __init__(self):
+        self.put_parser = reqparse.RequestParser()
+        self.put_parser.add_argument('name', type = unicode, location = 'json')
+        self.put_parser.add_argument('add', type = list, location = 'json')
+        self.put_parser.add_argument('remove', type = list, location = 'json')
+        self.get_parser = page_parser()
+        super(ListAPI, self).__init__()
+
+    @marshal_with_fieldset(contact_fields, 'contacts', extra_fields=list_summary_fields)
+    def get(self, key_id):
+        lst = ListModel.query_by_id(current_user_key().id(), key_id)
+        if lst is None:
+            abort(404)
+        # A page of the members, with the ones that no longer exist left out.
+        keys, next_cursor = slice_page(lst.members, self.get_parser.parse_args())
+        return {'key': lst.key, 'name': lst.name, 'size': lst.size,
+                'contacts': [c for c in ndb.get_multi(keys) if c is not None],
+                'next_cursor': next_cursor}
+
+    @marshal_with(list_summary_fields)
+    def put(self, key_id):
+        user_key = current_user_key()
+        args = self.put_parser.parse_args()
+        add = contact_keys(user_key, args.add)
+        # Contacts that have since been deleted can still be removed.
+        remove = set(contact_keys(user_key, args.remove, check_exists=False))
+
+        @ndb.transactional
+        def txn():
+            lst = ListModel.query_by_id(user_key.id(), key_id)
+            if lst is None:
+                abort(404)
+            if args.name is not None:
+                lst.name = args.name
+            set_members(lst, [k for k in lst.members if k not in remove] + add)
+            lst.put()
+            return lst
+        return txn()
+
+    def delete(self, key_id):
+        lst = ListModel.query_by_id(current_user_key().id(), key_id)
+        if lst is None:
+            abort(404)
+        lst.key.delete()
+        return make_response("", 204)
@@ -1,60 +1,399 @@
 """
 mail.py
 
+Sending a doc runs as a send job (see job.py) on the `mail` queue. A chain
+of fan-out tasks splits the recipients into SendShardModel shards of
+MAIL_SHARD_SIZE contacts, and a shard task sends to each shard. A shard
+task that fails is retried by the queue on its own.
+
+A send to a list keeps the list's members on the job when it starts,
+and fans out over that copy, so editing the list during the send neither
+skips nor adds recipients.
+
+Shard tasks run in parallel, so they never write the job, whose entity
+group takes about one write a second. Each shard is a root entity, and
+it counts the contacts and shards done in one of COUNTERS counter
+entities, which are added up when the job is read (see send_progress).
+
+Sends can be retried safely. A send with an Idempotency-Key header gets
+a job named after the key, so a repeated request finds the job with one
+key lookup instead of starting another. Each (job, contact) pair has a
+fixed link id, and each link records whether its message was sent, so a
+retried shard task reuses the links it already made and skips those
+recipients. A memcache marker covers the moment between sending and
+recording. A recipient the transport rejects is logged, recorded on its
+link and skipped, so it can't fail the rest of the shard.
+
+Recipients on the suppression list (see suppression.py) are skipped
+before their links are created. Each message has a signed unsubscribe
+link, and bounces reported by the mail API suppress the address.
+
+Messages are delivered by the transport picked by MAIL_TRANSPORT (see
+mail_transport.py), one session per shard task.
+
+Sends are paced by token buckets for the app and each recipient domain
+(see rate_limit.py). Tokens are only taken for the recipients a shard
+task will actually send to, after skipping the ones already handled. A
+shard sends as many messages as the buckets allow and re-enqueues itself
+from its first held back recipient, with a countdown until the tokens are
+available.
+
 """
 
-from flask import abort, url_for
+import hashlib
+import hmac
+import logging
+from datetime import datetime, timedelta
+from flask import abort, request, url_for
 from flask.ext.restful import Resource, marshal_with, reqparse
-from google.appengine.api import mail
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb
 from mail_safe_test import app
-from mail_safe_test.auth import current_user, user_required
+from mail_safe_test.auth import current_user, task_required, user_required
+from mail_safe_test.email_templates import PreparedEmail, preview
+from mail_safe_test.mail_transport import RecipientError, get_transport
+from mail_safe_test.rate_limit import RateLimiter, TokenBucket
 from mail_safe_test.resources.contact import ContactModel
 from mail_safe_test.resources.doc import DocModel
+from mail_safe_test.resources.job import (JobModel, JobStatus, job_fields, job_progress,
+                                         load_progress, save_and_continue)
 from mail_safe_test.resources.link import LinkModel
-from uuid import uuid4
+from mail_safe_test.resources.list import ListModel
+from mail_safe_test.suppression import (SuppressionReason, normalize_email, suppress,
+                                        suppressed, unsubscribe_email, unsubscribe_token)
+
+QUEUE_NAME = 'mail'
+URL_PLACEHOLDER = 'URLVALUE'
+SENT_PREFIX = 'mail_sent:'
+# Long enough to outlast the retries of a shard, see queue.yaml.
+SENT_MARKER_TIME = 7 * 24 * 3600
+# Counter entities per send job, about one per concurrent shard task.
+COUNTERS = 20
 
 parser = reqparse.RequestParser()
 parser.add_argument('doc_id', type = int, location = 'json', required = True)
 parser.add_argument('list', type = str, location = 'json')
 
+class SendShardModel(ndb.Model):
+    '''The recipients of one shard of a send job, see shard_key().'''
+    job = ndb.KeyProperty(kind='JobModel', indexed=False)
+    contacts = ndb.KeyProperty(kind='ContactModel', repeated=True, indexed=False)
+    # How many of the contacts have been handled so far.
+    sent = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+
+class SendCounterModel(ndb.Model):
+    '''Part of the progress of a send job, see counter_key().'''
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    shards_done = ndb.IntegerProperty(default=0, indexed=False)
+
+def shard_key(job_key, number):
+    # A root entity, outside the job's entity group.
+    return ndb.Key(SendShardModel, '%s:%d' % (job_key.urlsafe(), number))
+
+def counter_key(job_key, number):
+    """Returns the key of the counter of shard `number` of a send job."""
+    return ndb.Key(SendCounterModel, '%s:%d' % (job_key.urlsafe(), number % COUNTERS))
+
+def send_progress(job):
+    """Sets processed, shards_done and status of a send job from its
+    counters."""
+    counters = ndb.get_multi([counter_key(job.key, i) for i in range(COUNTERS)])
+    counters = [c for c in counters if c is not None]
+    job.processed = sum(c.processed for c in counters)
+    job.shards_done = sum(c.shards_done for c in counters)
+    if job.fanned_out and job.shards_done == job.shards:
+        job.status = JobStatus.DONE
+
+job_progress['send'] = send_progress
+
+def _app_bucket():
+    return TokenBucket('mail', app.config['MAIL_RATE'], app.config['MAIL_BURST'])
+
+def mail_limiter(domain):
+    """Returns the rate limiter of messages to recipients at domain."""
+    return RateLimiter('mail', [
+        _app_bucket(),
+        TokenBucket('mail:' + domain, app.config['MAIL_DOMAIN_RATE'],
+                    app.config['MAIL_DOMAIN_BURST'])])
+
+def mail_stats():
+    """Returns the depth of the mail queue and the rate limiter counters."""
+    stats = taskqueue.Queue(QUEUE_NAME).fetch_statistics()
+    result = RateLimiter('mail', [_app_bucket()]).stats()
+    result['queue_depth'] = stats.tasks
+    result['oldest_eta_usec'] = stats.oldest_eta_usec
+    return result
+
+def _enqueue_shard(shard, countdown=0):
+    taskqueue.add(url='/tasks/mail/shard/',
+                  params={'shard': shard.key.urlsafe(), 'sent': shard.sent},
+                  queue_name=QUEUE_NAME, countdown=countdown, transactional=True)
+
+def contact_page(job, size):
+    """Returns (contact keys, next cursor) of the page of job's recipients
+    that starts at job.cursor."""
+    if job.contact_list:
+        # Paged over the members when the send started, so members removed
+        # meanwhile don't shift the rest past the cursor.
+        members = job.contacts
+        start = int(job.cursor or 0)
+        end = start + size
+        return members[start:end], str(end) if end < len(members) else None
+    query = ContactModel.query(ancestor=job.key.parent())
+    start_cursor = ndb.Cursor(urlsafe=job.cursor) if job.cursor else None
+    keys, cursor, more = query.fetch_page(size, start_cursor=start_cursor,
+                                          keys_only=True)
+    return keys, cursor.urlsafe() if more and cursor else None
+
+def run_fanout(job):
+    """Creates the next shard of a send job and enqueues its task."""
+    keys, next_cursor = contact_page(job, app.config['MAIL_SHARD_SIZE'])
+    cursor = job.cursor or ''
+
+    @ndb.transactional(xg=True)
+    def txn():
+        job_now = job.key.get()
+        if (job_now is None or job_now.status != JobStatus.RUNNING or
+                job_now.fanned_out or (job_now.cursor or '') != cursor):
+            return
+        if keys:
+            job_now.shards += 1
+            shard = SendShardModel(key=shard_key(job_now.key, job_now.shards),
+                                   job=job_now.key, contacts=keys)
+            shard.put()
+            _enqueue_shard(shard)
+        job_now.cursor = next_cursor
+        if next_cursor:
+            taskqueue.add(url='/tasks/mail/fanout/',
+                          params={'job': job_now.key.urlsafe(), 'cursor': next_cursor},
+                          queue_name=QUEUE_NAME, transactional=True)
+        else:
+            job_now.fanned_out = True
+        job_now.put()
+    txn()
+
+def link_id(job_key, contact_key):
+    """Returns the 32 digit hex id of the link of a contact in a send.
+
+    It is an HMAC with the app's secret key, so it is the same every time a
+    shard is retried but can't be guessed from the keys.
+    """
+    message = job_key.urlsafe() + ':' + contact_key.urlsafe()
+    return hmac.new(app.config['SECRET_KEY'], message, hashlib.sha256).hexdigest()[:32]
+
+def send_job_id(idempotency_key):
+    return 'send-' + hashlib.sha1(idempotency_key.encode('utf-8')).hexdigest()
+
+def url_template(endpoint, arg):
+    """Returns (prefix, suffix) such that prefix + value + suffix is
+    url_for(endpoint, arg=value), so url_for runs once per send."""
+    url = url_for(endpoint, **{arg: URL_PLACEHOLDER})
+    prefix, _, suffix = url.partition(URL_PLACEHOLDER)
+    return prefix, suffix
+
+def link_url_template():
+    return url_template('/link/', 'key_id')
+
+def create_links(contacts, job):
+    """Returns (links, futures) of the link to job's doc for each contact,
+    writing the new ones with one put_multi_async. The links expire
+    LINK_LIFETIME seconds after the job started.
+
+    Links made by an earlier try of the shard are kept as they are, so
+    their clicks and codes (see link.py) survive a retry.
+    """
+    keys = [ndb.Key(LinkModel, link_id(job.key, contact.key)) for contact in contacts]
+    expires = job.created + timedelta(seconds=app.config['LINK_LIFETIME'])
+    links, new = [], []
+    for key, link, contact in zip(keys, ndb.get_multi(keys), contacts):
+        if link is None:
+            link = LinkModel(key=key, contact=contact.key, doc=job.doc,
+                             expires=expires)
+            new.append(link)
+        links.append(link)
+    return links, ndb.put_multi_async(new)
+
+@ndb.transactional_tasklet
+def _record_send(link_key, sent=None, error=None):
+    # Re-read in a transaction, so a code issued meanwhile is kept.
+    link = yield link_key.get_async()
+    if link is not None:
+        link.populate(sent=sent, error=error)
+        yield link.put_async()
+
+def send_shard(shard):
+    """Sends the doc of a send job to the rest of the contacts of one
+    shard, or as many of them as the rate limits allow."""
+    job = shard.job.get()
+    user = job.key.parent().get() if job else None
+    if user is None:
+        return
+    sender = app.config.get('SERVER_EMAIL')
+    remaining = shard.contacts[shard.sent:]
+    contacts = ndb.get_multi(remaining)
+    found = [c for c in contacts if c is not None]
+    blocked = suppressed([c.email for c in found])
+    recipients = [c for c in found if normalize_email(c.email) not in blocked]
+    links, futures = create_links(recipients, job)
+    already_sent = memcache.get_multi([link.key.id() for link in links],
+                                      key_prefix=SENT_PREFIX)
+    # Recipients still to send to, with their place in remaining, by domain.
+    position = dict((key, i) for i, key in enumerate(remaining))
+    by_domain = {}
+    for link, contact in zip(links, recipients):
+        if link.sent or link.error or link.key.id() in already_sent:
+            continue  # Handled by an earlier try of this task.
+        domain = normalize_email(contact.email).rpartition('@')[2]
+        by_domain.setdefault(domain, []).append((position[contact.key], link, contact))
+    pending, held, wait = [], [], 0.0
+    for domain, items in by_domain.items():
+        allowed, domain_wait = mail_limiter(domain).acquire(len(items))
+        pending += items[:allowed]
+        if allowed < len(items):
+            held.append(items[allowed][0])
+            wait = max(wait, domain_wait)
+    pending.sort(key=lambda item: item[0])
+    # Recipients before the first held back one are done. Later ones that
+    # were sent anyway are skipped by the next try.
+    done = min(held) if held else len(remaining)
+
+    prefix, suffix = link_url_template()
+    unsubscribe_prefix, unsubscribe_suffix = url_template('/unsubscribe/', 'token')
+    email = PreparedEmail(from_name=user.first_name)
+    sent, failed = [], []
+    with get_transport().session() as session:
+        for _, link, contact in pending:
+            unsubscribe_url = (unsubscribe_prefix + unsubscribe_token(contact.email) +
+                               unsubscribe_suffix)
+            try:
+                session.send(email.message(sender, contact.email,
+                                           to_name=contact.first_name,
+                                           link_url=prefix + link.key.id() + suffix,
+                                           unsubscribe_url=unsubscribe_url))
+            except RecipientError as e:
+                logging.warning('not sending to %s: %s', contact.key, e)
+                failed.append((link.key, str(e)))
+                continue
+            memcache.set(SENT_PREFIX + link.key.id(), 1, time=SENT_MARKER_TIME)
+            sent.append(link.key)
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()  # Make sure the puts completed.
+    now = datetime.utcnow()
+    futures = ([_record_send(key, sent=now) for key in sent] +
+               [_record_send(key, error=error) for key, error in failed])
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+
+    number = int(shard.key.id().rpartition(':')[2])
+    @ndb.transactional(xg=True)
+    def txn():
+        shard_now, counter = ndb.get_multi([shard.key, counter_key(job.key, number)])
+        if shard_now is None or shard_now.done or shard_now.sent != shard.sent:
+            return
+        if counter is None:
+            counter = SendCounterModel(key=counter_key(job.key, number))
+        shard_now.sent += done
+        counter.processed += len([c for c in contacts[:done] if c is not None])
+        if shard_now.sent < len(shard_now.contacts):
+            _enqueue_shard(shard_now, countdown=wait)
+        else:
+            shard_now.done = True
+            counter.shards_done += 1
+        ndb.put_multi([shard_now, counter])
+    txn()
+
+@task_required
+def fanout_task():
+    job = ndb.Key(urlsafe=request.form['job']).get()
+    # Nothing to do if the job is gone or a duplicate task already ran
+    # this page.
+    if (job and job.status == JobStatus.RUNNING and not job.fanned_out and
+            (job.cursor or '') == request.form.get('cursor', '')):
+        run_fanout(job)
+    return ('', 200)
+
+@task_required
+def shard_task():
+    shard = ndb.Key(urlsafe=request.form['shard']).get()
+    # Skip duplicates of a task that has already run.
+    if (shard and not shard.done and
+            shard.sent == int(request.form.get('sent', 0))):
+        send_shard(shard)
+    return ('', 200)
+
+def bounce():
+    """Suppresses the recipient of a message the mail API reports as
+    bounced."""
+    suppress(request.form.get('original-to'), SuppressionReason.BOUNCE)
+    return ('', 200)
+
 class Mail(Resource):
     method_decorators = [user_required]
 
+    @marshal_with(job_fields)
     def post(self):
         user=current_user()
         args = parser.parse_args()
-        doc = DocModel.query_by_id(user, args.doc_id)
+        doc = DocModel.query_by_id(user.key.id(), args.doc_id)
         if not doc:
             print "doc not found"
             abort(404)
 
-        contacts = ContactModel.query_by_owner(user)
-        future_links = []
-        emails = []
-        for contact in contacts:
-            uid = uuid4().get_hex()
-            link = LinkModel(id=uid, contact=contact.key, doc=doc.key)
-            future_links.append(link.put_async())
-            url = url_for('/link/', key_id=link.key.id())
-            emails += self.generate_email(contact.email, contact.first_name,
-                                          user.first_name, url)
-
-        for email in emails:
-            mail.send_mail(**email)
-        for future in future_links:
-            future.get_result()  # Make sure the put completed.
-        return {'result': 'sent'}
-
-    def generate_email(self, to_email, to_name, from_name, link_url):
-        subject = "A MailSafe Message From %s" % from_name
-        message = """Dear %s,\n
-            you have received a message from %s through MailSafe.\n
-            Please click on the following link to view their message:\n
-            %s\n
-            The MailSafe Team""" % (to_name, from_name, link_url)
-        from_email = app.config.get('SERVER_EMAIL')
-        yield {'sender': from_email,
-               'subject': subject,
-               'body': message,
-               'to':to_email}
+        lst = None
+        if args.list:
+            lst = ListModel.query_by_id(user.key.id(), args.list)
+            if not lst:
+                abort(404)
+        job = JobModel(parent=user.key, job_type='send',
+                       target_kind=ContactModel._get_kind(), doc=doc.key,
+                       contact_list=lst.key if lst else None,
+                       contacts=lst.members if lst else [])
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if not idempotency_key:
+            save_and_continue(job, '/tasks/mail/fanout/', QUEUE_NAME)
+            return job, 202
+
+        job.key = ndb.Key(JobModel, send_job_id(idempotency_key), parent=user.key)
+        @ndb.transactional
+        def txn():
+            existing = job.key.get()
+            if existing:
+                return existing
+            save_and_continue(job, '/tasks/mail/fanout/', QUEUE_NAME)
+            return job
+        sent = txn()
+        # The same key can't be reused for a different send.
+        if (sent.doc, sent.contact_list) != (job.doc, job.contact_list):
+            abort(409)
+        return load_progress(sent), 202
+
+class MailPreview(Resource):
+    '''The message that sending a doc would send, for a sample recipient.'''
+    method_decorators = [user_required]
+
+    def get(self, doc_id):
+        user = current_user()
+        doc = DocModel.query_by_id(user.key.id(), doc_id)
+        if not doc:
+            abort(404)
+        return preview(user.first_name)
+
+class Unsubscribe(Resource):
+    '''Login not required: the token in the URL is signed.'''
+    def _email(self, token):
+        email = unsubscribe_email(token)
+        if not email:
+            abort(404)
+        return email
+
+    def get(self, token):
+        email = self._email(token)
+        return {'email': email, 'unsubscribed': bool(suppressed([email]))}
 
+    def post(self, token):
+        email = self._email(token)
+        suppress(email, SuppressionReason.UNSUBSCRIBE)
+        return {'email': email, 'unsubscribed': True}
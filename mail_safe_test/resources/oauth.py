@@ -6,7 +6,8 @@ oauth.py
 from flask import url_for, session, jsonify, abort, request
 from flask_oauthlib.client import OAuthException
 from mail_safe_test import app, google
-from oauth2client.client import verify_id_token
+from mail_safe_test.auth import verify_id_token
+from mail_safe_test.certs import CertFetchError
 from oauth2client.crypt import AppIdentityError
 
 def login():
@@ -36,9 +37,12 @@ def verify():
     if not id_token:
         abort(400)
     try:
-        jwt = verify_id_token(id_token, app.config.get('GOOGLE_ID'))
+        jwt = verify_id_token(id_token)
         return jsonify(jwt)
     except AppIdentityError as e:
         print "error", e
         abort(403)
+    except CertFetchError as e:
+        print "error", e
+        abort(503)
 
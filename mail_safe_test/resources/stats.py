@@ -0,0 +1,20 @@
+"""
+stats.py
+
+"""
+
+from flask.ext.restful import Resource
+from mail_safe_test.auth import admin_required, token_cache
+from mail_safe_test.resources.contact import backfill_stats
+from mail_safe_test.resources.link import sweep_stats
+from mail_safe_test.resources.mail import mail_stats
+
+class AdminStatsAPI(Resource):
+    '''Per-instance cache and queue counters.'''
+    method_decorators = [admin_required]
+
+    def get(self):
+        return {'token_cache': token_cache.stats(),
+                'mail': mail_stats(),
+                'link_sweep': sweep_stats(),
+                'contact_backfill': backfill_stats()}
@@ -7,7 +7,9 @@ from flask import request, Response, abort, make_response
 from flask.ext.restful import Resource, fields, marshal_with, reqparse
 from google.appengine.ext import ndb
 from mail_safe_test.custom_fields import NDBUrl
-from mail_safe_test.auth import current_user, user_required, current_user_token_info, admin_required, UserModel
+from mail_safe_test.fieldsets import marshal_with_fieldset, projection, requested_fields
+from mail_safe_test.pagination import fetch_page, list_fields, page_parser
+from mail_safe_test.auth import current_user, current_user_key, user_required, current_user_token_info, admin_required, UserModel
 
 # Public exports
 user_fields = {
@@ -38,7 +40,7 @@ class AdminUserAPI(Resource):
         self.put_parser = parser(False)
         super(AdminUserAPI, self).__init__()
 
-    @marshal_with(admin_user_fields)
+    @marshal_with_fieldset(admin_user_fields)
     def get(self, key_id):
         user = ndb.Key(UserModel, key_id).get()
         if not user:
@@ -65,12 +67,20 @@ class AdminUserAPI(Resource):
 
 class AdminUserListAPI(Resource):
     method_decorators = [admin_required]
-    user_list_fields = {'users': fields.List(fields.Nested(admin_user_fields))}
+    user_list_fields = list_fields('users', admin_user_fields)
+    # Fieldsets served by a projection, see index.yaml.
+    projections = (('email',), ('first_name', 'last_name', 'email'))
 
-    @marshal_with(user_list_fields)
+    def __init__(self):
+        self.get_parser = page_parser()
+        super(AdminUserListAPI, self).__init__()
+
+    @marshal_with_fieldset(admin_user_fields, 'users')
     def get(self):
-        users = UserModel.query().fetch()
-        return {'users': users}
+        fields = requested_fields(admin_user_fields)
+        users, next_cursor = fetch_page(UserModel.query(), self.get_parser.parse_args(),
+                projection=projection(UserModel, fields, self.projections))
+        return {'users': users, 'next_cursor': next_cursor}
 
     @marshal_with(user_list_fields)
     def delete(self):
@@ -84,7 +94,7 @@ class UserAPI(Resource):
         self.put_parser = parser(False)
         super(UserAPI, self).__init__()
 
-    @marshal_with(user_fields)
+    @marshal_with_fieldset(user_fields)
     @user_required
     def get(self):
         user = current_user()
@@ -120,6 +130,5 @@ class UserAPI(Resource):
 
     @user_required
     def delete(self):
-        user = current_user()
-        user.key.delete() # Delete a single user.
+        current_user_key().delete() # Delete a single user.
         return make_response("", 204)
@@ -20,15 +20,107 @@ class Config(object):
     CACHE_TYPE = 'gaememcached'
     # Email settings
     SERVER_EMAIL = 'admin@wisebold.com'
+    # Number of verified ID tokens kept in process (see token_cache.py)
+    TOKEN_CACHE_SIZE = 1024
+    # Seconds before expiry to refresh Google's signing certs (see certs.py)
+    CERT_REFRESH_MARGIN = 300
+    # Seconds between batched writes of UserModel.last_active (see activity.py)
+    ACTIVITY_FLUSH_INTERVAL = 60
+    # Page sizes of the list endpoints (see pagination.py)
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    # Contacts written per put_multi by the bulk import (see contact_import.py)
+    CONTACT_IMPORT_BATCH_SIZE = 500
+    # Contacts re-saved per task by the search backfill, each in its own
+    # transaction (see resources/contact.py)
+    CONTACT_BACKFILL_BATCH_SIZE = 100
+    # Keys deleted per task by background delete jobs (see resources/job.py)
+    DELETE_BATCH_SIZE = 500
+    # Most contacts returned by /user/contacts/search/
+    SEARCH_MAX_RESULTS = 20
+    # Most contacts in one contact list (see resources/list.py)
+    MAX_LIST_SIZE = 5000
+    # Bytes of compressed document body per chunk entity (see doc_storage.py)
+    DOC_CHUNK_SIZE = 900 * 1024
+    # Doc revisions between full snapshots; the rest are deltas (see doc_storage.py)
+    DOC_SNAPSHOT_INTERVAL = 10
+    # Recipients per task of a send job (see resources/mail.py)
+    MAIL_SHARD_SIZE = 100
+    # Messages per second and burst size, for the app and for each
+    # recipient domain (see rate_limit.py)
+    MAIL_RATE = 50
+    MAIL_BURST = 200
+    MAIL_DOMAIN_RATE = 20
+    MAIL_DOMAIN_BURST = 100
+    # How mail is delivered: appengine, smtp or memory (see mail_transport.py)
+    MAIL_TRANSPORT = 'appengine'
+    # SMTP relay used by the smtp transport
+    SMTP_HOST = 'localhost'
+    SMTP_PORT = 25
+    SMTP_USERNAME = None
+    SMTP_PASSWORD = None
+    SMTP_USE_TLS = False
+    # Idle relay connections kept per instance, and messages sent on a
+    # connection before it is replaced
+    SMTP_POOL_SIZE = 4
+    SMTP_MESSAGES_PER_CONNECTION = 100
+    # Size of the Bloom filter of suppressed addresses, about 440k addresses
+    # at a 1% false positive rate (see suppression.py)
+    SUPPRESSION_FILTER_BITS = 2 ** 22
+    SUPPRESSION_FILTER_HASHES = 7
+    # Most seconds an instance may miss an update of the filter
+    SUPPRESSION_VERSION_TIME = 60
+    # Least age in seconds of the addresses folded into the filter, so none
+    # still being written is skipped (see suppression.py)
+    SUPPRESSION_FOLD_DELAY = 60
+    # Most addresses suppressed since the last fold that are read when
+    # checking recipients. Past this every recipient is looked up instead
+    SUPPRESSION_PENDING_LIMIT = 1000
+    # Seconds a resolved /link/ is cached, at most until it expires
+    # (see resources/link.py)
+    LINK_CACHE_TIME = 3600
+    # Seconds a doc's recipient view is cached, seconds a request may hold
+    # the lock to render it, and seconds the others wait for it
+    # (see resources/doc.py)
+    DOC_VIEW_CACHE_TIME = 3600
+    DOC_VIEW_LOCK_TIME = 10
+    DOC_VIEW_WAIT_TIME = 1
+    # Digits and lifetime in seconds of link codes (see otp.py)
+    OTP_DIGITS = 6
+    OTP_TTL = 600
+    # Failed attempts before a link is locked, and for how many seconds
+    OTP_MAX_ATTEMPTS = 5
+    OTP_LOCKOUT_TIME = 900
+    # Codes a link can be sent per window of seconds
+    OTP_MAX_ISSUES = 5
+    OTP_ISSUE_WINDOW = 3600
+    # How text messages are sent: stub or twilio (see sms.py). There is
+    # no default outside Development and Testing
+    SMS_BACKEND = None
+    TWILIO_ACCOUNT_SID = None
+    TWILIO_AUTH_TOKEN = None
+    TWILIO_FROM_NUMBER = None
+    # Seconds the links of a send work for
+    LINK_LIFETIME = 30 * 24 * 3600
+    # Expired links deleted per task of the sweep, and the least seconds
+    # between its tasks; a task waits at least as long as the last one
+    # took (see resources/link.py)
+    LINK_SWEEP_BATCH_SIZE = 500
+    LINK_SWEEP_INTERVAL = 1
+    # Seconds without progress after which cron resumes a sweep from its
+    # checkpoint
+    LINK_SWEEP_STALE_TIME = 1800
 
 class Development(Config):
     DEBUG = True
+    SMS_BACKEND = 'stub'
     # Flask-DebugToolbar settings
     CSRF_ENABLED = True
 
 class Testing(Config):
     TESTING = True
     DEBUG = True
+    SMS_BACKEND = 'stub'
     CSRF_ENABLED = True
 
 class Production(Config):
@@ -0,0 +1,85 @@
+"""
+sms.py
+
+Ways of delivering text messages, such as the codes of otp.py.
+
+SMS_BACKEND picks the backend:
+  stub    keeps the messages in a list and sends nothing, for
+          development, tests and benchmarks. Only Development and
+          Testing use it by default.
+  twilio  the Twilio REST API, with the TWILIO_* settings.
+
+Production has no default, so texting a code fails with SMSError, before
+anything is saved, until a backend is configured.
+"""
+
+import base64
+import logging
+import threading
+from urllib import urlencode
+from google.appengine.api import urlfetch
+from mail_safe_test import app
+
+class SMSError(Exception):
+    pass
+
+class SMSBackend(object):
+    def send(self, to, body):
+        raise NotImplementedError
+
+class StubSMSBackend(SMSBackend):
+    def __init__(self):
+        self.outbox = []
+        self._lock = threading.Lock()
+
+    def send(self, to, body):
+        # Not the body, which holds a live code.
+        logging.info('stub SMS to %s not sent', to)
+        with self._lock:
+            self.outbox.append((to, body))
+
+class TwilioSMSBackend(SMSBackend):
+    URL = 'https://api.twilio.com/2010-04-01/Accounts/%s/Messages.json'
+
+    def __init__(self, account_sid, auth_token, from_number):
+        self.url = self.URL % account_sid
+        self.auth = 'Basic ' + base64.b64encode('%s:%s' % (account_sid, auth_token))
+        self.from_number = from_number
+
+    def send(self, to, body):
+        try:
+            rv = urlfetch.fetch(self.url, method=urlfetch.POST,
+                                payload=urlencode({'From': self.from_number, 'To': to,
+                                                   'Body': body}),
+                                headers={'Authorization': self.auth},
+                                validate_certificate=True)
+        except urlfetch.Error as e:
+            raise SMSError('twilio request failed: %s' % e)
+        if rv.status_code >= 300:
+            raise SMSError('twilio returned %d: %s' % (rv.status_code, rv.content))
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def _create(name):
+    if name == 'stub':
+        return StubSMSBackend()
+    if name == 'twilio':
+        if not all(app.config.get(k) for k in ('TWILIO_ACCOUNT_SID', 'TWILIO_AUTH_TOKEN',
+                                               'TWILIO_FROM_NUMBER')):
+            raise SMSError('the twilio SMS backend needs the TWILIO_* settings')
+        return TwilioSMSBackend(app.config['TWILIO_ACCOUNT_SID'],
+                                app.config['TWILIO_AUTH_TOKEN'],
+                                app.config['TWILIO_FROM_NUMBER'])
+    raise SMSError('unknown SMS backend %r' % name)
+
+def get_sms_backend():
+    """Returns this instance's backend for SMS_BACKEND. Raises SMSError if
+    there is none."""
+    name = app.config.get('SMS_BACKEND')
+    if not name:
+        raise SMSError('SMS_BACKEND is not set')
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = _create(name)
+        return _backends[name]
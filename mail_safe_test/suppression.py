@@ -0,0 +1,233 @@
+"""
+suppression.py
+
+Addresses that must not be mailed again, because mail to them bounced or
+their owner unsubscribed.
+
+Each address is a SuppressionModel named after the address, and
+suppressing one writes only that entity. A cron task folds the addresses
+suppressed since its last run into a Bloom filter, stored as one entity
+and kept in memory by each instance, so checking a recipient is a few bit
+tests. Only addresses the filter matches are looked up in the datastore,
+with a single get_multi, to rule out false positives. Addresses not folded
+yet are found with a keys-only query on their creation time, which reads
+at most SUPPRESSION_PENDING_LIMIT keys. Before the first fold, or when
+more are pending, every address is looked up instead.
+
+The filter entity records the size and number of hashes it was built
+with. When SUPPRESSION_FILTER_BITS or SUPPRESSION_FILTER_HASHES change,
+the next fold rebuilds it from every SuppressionModel, and until then the
+old filter is still used.
+
+A fold that adds nothing writes nothing. Otherwise it bumps the filter's
+version, which is mirrored in memcache. An
+instance reloads its copy when the version it sees in memcache differs,
+and the memcache copy expires every SUPPRESSION_VERSION_TIME seconds, so
+a missed update is picked up within that time.
+"""
+
+import hashlib
+import struct
+import threading
+from datetime import datetime, timedelta
+from itsdangerous import BadSignature, URLSafeSerializer
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from mail_safe_test import app
+from mail_safe_test.auth import task_required
+
+VERSION_KEY = 'suppression_filter_version'
+
+class SuppressionReason:
+    BOUNCE = 'bounce'
+    UNSUBSCRIBE = 'unsubscribe'
+
+class SuppressionModel(ndb.Model):
+    '''A suppressed address, named after the normalized address.'''
+    reason = ndb.StringProperty(indexed=False, choices=[
+        SuppressionReason.BOUNCE, SuppressionReason.UNSUBSCRIBE])
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+class SuppressionFilterModel(ndb.Model):
+    '''The Bloom filter of the SuppressionModels created before
+    folded_until.'''
+    data = ndb.BlobProperty(compressed=True)
+    bits = ndb.IntegerProperty(indexed=False)
+    hashes = ndb.IntegerProperty(indexed=False)
+    folded_until = ndb.DateTimeProperty(indexed=False)
+    version = ndb.IntegerProperty(default=0, indexed=False)
+
+def filter_key():
+    # Built when used, so it has the app id of the running app.
+    return ndb.Key(SuppressionFilterModel, 'filter')
+
+class BloomFilter(object):
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        if data is None:
+            self.data = bytearray(bits // 8)
+        elif len(data) * 8 == bits:
+            self.data = bytearray(data)
+        else:
+            raise ValueError('%d bytes of filter data for %d bits' % (len(data), bits))
+
+    def _positions(self, value):
+        # Double hashing: position i is h1 + i * h2.
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(value).digest())
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        for p in self._positions(value):
+            self.data[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, value):
+        data = self.data
+        for p in self._positions(value):
+            if not data[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def serialize(self):
+        return str(self.data)
+
+def normalize_email(email):
+    return (email or u'').strip().lower().encode('utf-8')
+
+def _load(entity):
+    """Returns the filter stored in entity, or an empty one if it has none."""
+    if entity.data is None:
+        return BloomFilter(app.config['SUPPRESSION_FILTER_BITS'],
+                           app.config['SUPPRESSION_FILTER_HASHES'])
+    # Filters saved before they recorded their settings were built with
+    # the settings of the time.
+    return BloomFilter(entity.bits or app.config['SUPPRESSION_FILTER_BITS'],
+                       entity.hashes or app.config['SUPPRESSION_FILTER_HASHES'],
+                       entity.data)
+
+_cached = None  # (version, BloomFilter, folded_until)
+_cached_lock = threading.Lock()
+
+def suppression_filter():
+    """Returns (filter, folded_until) of this instance's copy of the
+    filter, reloaded if it changed."""
+    global _cached
+    version = memcache.get(VERSION_KEY)
+    cached = _cached
+    if cached is not None and version is not None and cached[0] == version:
+        return cached[1:]
+    entity = filter_key().get() or SuppressionFilterModel(key=filter_key())
+    memcache.set(VERSION_KEY, entity.version,
+                 time=app.config['SUPPRESSION_VERSION_TIME'])
+    cached = (entity.version, _load(entity), entity.folded_until)
+    with _cached_lock:
+        _cached = cached
+    return cached[1:]
+
+def _created_since(since):
+    query = SuppressionModel.query()
+    if since is not None:
+        query = query.filter(SuppressionModel.created >= since)
+    return query
+
+def suppressed(emails):
+    """Returns the set of the normalized addresses in emails that are
+    suppressed."""
+    bloom, folded_until = suppression_filter()
+    emails = set(normalize_email(e) for e in emails)
+    emails.discard('')
+    if not emails:
+        return set()
+    pending = None
+    if folded_until is not None:
+        # Suppressed since the last fold, so not in the filter yet.
+        limit = app.config['SUPPRESSION_PENDING_LIMIT']
+        keys = _created_since(folded_until).fetch(limit + 1, keys_only=True)
+        if len(keys) <= limit:
+            pending = set(key.id() for key in keys)
+    if pending is None:
+        # No filter yet, or too far behind it.
+        pending = set()
+        maybe = list(emails)
+    else:
+        maybe = [e for e in emails if e not in pending and e in bloom]
+    found = ndb.get_multi([ndb.Key(SuppressionModel, e) for e in maybe])
+    return (emails & pending) | set(e for e, entity in zip(maybe, found)
+                                    if entity is not None)
+
+def suppress(email, reason):
+    """Adds email to the suppression list. Returns False if it was already
+    there."""
+    email = normalize_email(email)
+    if not email:
+        return False
+
+    @ndb.transactional
+    def txn():
+        key = ndb.Key(SuppressionModel, email)
+        if key.get() is not None:
+            return False
+        SuppressionModel(key=key, reason=reason).put()
+        return True
+    return txn()
+
+def fold_suppressions(now):
+    """Adds the addresses suppressed until SUPPRESSION_FOLD_DELAY seconds
+    before now to the filter, rebuilding it if it was built with other
+    settings. Returns how many addresses were added, or None if another
+    fold changed the filter meanwhile. Writes nothing if no address was
+    added and the filter needs no rebuild."""
+    # Later suppressions may still be committing with an earlier time.
+    cutoff = now - timedelta(seconds=app.config['SUPPRESSION_FOLD_DELAY'])
+    bits = app.config['SUPPRESSION_FILTER_BITS']
+    hashes = app.config['SUPPRESSION_FILTER_HASHES']
+    entity = filter_key().get() or SuppressionFilterModel(key=filter_key())
+    rebuild = entity.data is None or (entity.bits, entity.hashes) != (bits, hashes)
+    if rebuild:
+        bloom, since = BloomFilter(bits, hashes), None
+    else:
+        bloom, since = _load(entity), entity.folded_until
+    query = _created_since(since).filter(SuppressionModel.created < cutoff)
+    count = 0
+    for key in query.iter(keys_only=True):
+        bloom.add(key.id())
+        count += 1
+    if count == 0 and not rebuild:
+        # folded_until stays behind, which only widens an empty range of
+        # the pending query.
+        return 0
+
+    @ndb.transactional
+    def txn():
+        current = filter_key().get() or SuppressionFilterModel(key=filter_key())
+        if current.version != entity.version:
+            return None
+        current.populate(data=bloom.serialize(), bits=bits, hashes=hashes,
+                         folded_until=cutoff, version=current.version + 1)
+        current.put()
+        return current.version
+    version = txn()
+    if version is None:
+        return None
+    memcache.set(VERSION_KEY, version, time=app.config['SUPPRESSION_VERSION_TIME'])
+    return count
+
+@task_required
+def fold_cron():
+    fold_suppressions(datetime.utcnow())
+    return ('', 200)
+
+def _serializer():
+    return URLSafeSerializer(app.config['SECRET_KEY'], salt='unsubscribe')
+
+def unsubscribe_token(email):
+    """Returns the signed token of email's unsubscribe link."""
+    return _serializer().dumps(normalize_email(email))
+
+def unsubscribe_email(token):
+    """Returns the address of an unsubscribe token, or None if the token
+    is not valid."""
+    try:
+        return _serializer().loads(token)
+    except BadSignature:
+        return None
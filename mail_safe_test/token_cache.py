@@ -0,0 +1,79 @@
+"""
+token_cache.py
+
+Cache of verified ID tokens. Clients send the same ID token on many
+requests before it expires, so the result of the signature check is kept
+in an in-process LRU backed by memcache, keyed by a hash of the token and
+evicted at the token's `exp`.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from google.appengine.api import memcache
+
+MEMCACHE_PREFIX = 'id_token:'
+
+class TokenCache(object):
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.memcache_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def token_hash(id_token):
+        """Returns the cache key for an ID token. The raw token is never stored."""
+        return hashlib.sha256(id_token).hexdigest()
+
+    def get(self, id_token):
+        """Returns the verified token info, or None if it must be verified."""
+        key = self.token_hash(id_token)
+        now = time.time()
+        with self._lock:
+            jwt = self._entries.pop(key, None)
+            if jwt is not None and jwt['exp'] > now:
+                self._entries[key] = jwt  # Re-insert as most recently used.
+                self.hits += 1
+                return jwt
+
+        jwt = memcache.get(MEMCACHE_PREFIX + key)
+        with self._lock:
+            if jwt is not None and jwt['exp'] > now:
+                self._store(key, jwt)
+                self.memcache_hits += 1
+                return jwt
+            self.misses += 1
+        return None
+
+    def set(self, id_token, jwt):
+        """Caches verified token info until the token's `exp`."""
+        ttl = int(jwt.get('exp', 0) - time.time())
+        if ttl <= 0:
+            return
+        key = self.token_hash(id_token)
+        with self._lock:
+            self._store(key, jwt)
+        memcache.set(MEMCACHE_PREFIX + key, jwt, time=ttl)
+
+    def clear(self):
+        """Drops the in-process entries. Memcache entries expire on their own."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'memcache_hits': self.memcache_hits,
+                    'misses': self.misses,
+                    'size': len(self._entries)}
+
+    def _store(self, key, jwt):
+        # Caller must hold self._lock.
+        self._entries.pop(key, None)
+        self._entries[key] = jwt
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
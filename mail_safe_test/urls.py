@@ -6,37 +6,67 @@ URL dispatch, route mappings
 
 from flask.ext import restful
 from mail_safe_test import app
+from mail_safe_test.auth import activity_task
 from mail_safe_test.resources.oauth import login, oauth_callback, logout, verify
 from mail_safe_test.resources.user import UserAPI, AdminUserAPI, AdminUserListAPI
-from mail_safe_test.resources.contact import ContactListAPI, ContactAPI
-from mail_safe_test.resources.doc import DocListAPI, DocAPI
-from mail_safe_test.resources.link import Link
-from mail_safe_test.resources.mail import Mail
+from mail_safe_test.resources.contact import (ContactListAPI, ContactAPI, ContactImportAPI, ContactSearchAPI,
+                                             AdminContactBackfillAPI, backfill_task)
+from mail_safe_test.resources.doc import DocListAPI, DocAPI, DocRevisionListAPI, DocRevisionAPI
+from mail_safe_test.resources.job import JobAPI, delete_task
+from mail_safe_test.resources.link import Link, LinkAuth, sweep_cron, sweep_task
+from mail_safe_test.resources.list import ListAPI, ListListAPI
+from mail_safe_test.resources.mail import Mail, MailPreview, Unsubscribe, bounce, fanout_task, shard_task
+from mail_safe_test.resources.stats import AdminStatsAPI
+from mail_safe_test.suppression import fold_cron
 
 app.add_url_rule('/login/', endpoint='login', view_func = login, methods=['GET'])
 app.add_url_rule('/login/oauth2callback/', endpoint='authorized', view_func = oauth_callback, methods=['GET', 'POST'])
 app.add_url_rule('/logout/', endpoint='logout', view_func=logout, methods=['GET'])
 app.add_url_rule('/verify/', endpoint='verify', view_func=verify, methods=['GET'])
 
+# Task queue handlers.
+app.add_url_rule('/tasks/activity/', endpoint='tasks_activity', view_func=activity_task, methods=['POST'])
+app.add_url_rule('/tasks/delete/', endpoint='tasks_delete', view_func=delete_task, methods=['POST'])
+app.add_url_rule('/tasks/mail/fanout/', endpoint='tasks_mail_fanout', view_func=fanout_task, methods=['POST'])
+app.add_url_rule('/tasks/mail/shard/', endpoint='tasks_mail_shard', view_func=shard_task, methods=['POST'])
+# Cron starts the sweep with a GET, and its tasks POST.
+app.add_url_rule('/tasks/links/sweep/', endpoint='tasks_links_sweep_cron', view_func=sweep_cron, methods=['GET'])
+app.add_url_rule('/tasks/links/sweep/', endpoint='tasks_links_sweep', view_func=sweep_task, methods=['POST'])
+app.add_url_rule('/tasks/contacts/backfill/', endpoint='tasks_contacts_backfill', view_func=backfill_task, methods=['POST'])
+app.add_url_rule('/tasks/suppression/fold/', endpoint='tasks_suppression_fold', view_func=fold_cron, methods=['GET'])
+
+# Bounce notifications from the mail API.
+app.add_url_rule('/_ah/bounce', endpoint='bounce', view_func=bounce, methods=['POST'])
+
 app.api = restful.Api(app)
 app.api.add_resource(AdminUserAPI, '/admin/user/<string:key_id>/', endpoint='/admin/user/')
 app.api.add_resource(AdminUserListAPI, '/admin/users/', endpoint='/admin/users/')
+app.api.add_resource(AdminStatsAPI, '/admin/stats/', endpoint='/admin/stats/')
+app.api.add_resource(AdminContactBackfillAPI, '/admin/contacts/backfill/',
+                     endpoint='/admin/contacts/backfill/')
 
 app.api.add_resource(DocAPI, '/user/doc/<string:key_id>/', endpoint='/user/doc/')
 app.api.add_resource(DocListAPI, '/user/docs/', endpoint='/user/docs/')
+app.api.add_resource(DocRevisionListAPI, '/user/doc/<string:key_id>/revisions/',
+                     endpoint='/user/doc/revisions/')
+app.api.add_resource(DocRevisionAPI, '/user/doc/<string:key_id>/revision/<int:number>/',
+                     endpoint='/user/doc/revision/')
 
 # Login requied.
-# TODO(gdb): Add contact list for users.
 app.api.add_resource(UserAPI, '/user/', endpoint='/user/')
+app.api.add_resource(JobAPI, '/user/job/<string:key_id>/', endpoint='/user/job/')
 app.api.add_resource(ContactAPI, '/user/contact/<string:key_id>/', endpoint='/user/contact/')
 #PUT add, remove list 
 app.api.add_resource(ContactListAPI, '/user/contacts/', endpoint='/user/contacts/')
+app.api.add_resource(ContactImportAPI, '/user/contacts/import/', endpoint='/user/contacts/import/')
+app.api.add_resource(ContactSearchAPI, '/user/contacts/search/', endpoint='/user/contacts/search/')
 #POST with list
 
-#app.api.add_resource(ListAPI, '/user/list/<string:key_id>', endpoint='/user/list/')
+app.api.add_resource(ListAPI, '/user/list/<string:key_id>/', endpoint='/user/list/')
 # GET contacts in this list
+# PUT rename, add and remove contacts
 # DELETE a list
-#app.api.add_resource(ListListAPI, '/user/lists/', endpoint='/user/lists/')
+app.api.add_resource(ListListAPI, '/user/lists/', endpoint='/user/lists/')
 # GET all lists
 # POST a new list
 # DELETE all lists
@@ -45,12 +75,17 @@ app.api.add_resource(ContactListAPI, '/user/contacts/', endpoint='/user/contacts
 #### MAIL ####
 app.api.add_resource(Mail, '/user/mail/', endpoint='/user/mail')
 # POST to send mail (doc, list/all)
+app.api.add_resource(MailPreview, '/user/mail/preview/<int:doc_id>/', endpoint='/user/mail/preview/')
+# GET the message a doc would be sent as
 
 # Login not required.
-app.api.add_resource(Link,     '/auth/<string:key_id>/', endpoint='/auth/')
+app.api.add_resource(LinkAuth, '/auth/<string:key_id>/', endpoint='/auth/')
 # GET sends text message
 app.api.add_resource(Link,     '/link/<string:key_id>', endpoint='/link/')
 # GET - 403's
 # POST with OTP
 # TODO(gdb): support oauth.
 # POST with oauth header
+app.api.add_resource(Unsubscribe, '/unsubscribe/<string:token>', endpoint='/unsubscribe/')
+# GET whether the address is unsubscribed
+# POST to unsubscribe
@@ -0,0 +1,74 @@
+"""
+versioning.py
+
+Per-user collection versions for conditional GETs.
+
+Each user has a version counter in memcache for each collection, keyed by
+the model's kind. Every write to the collection bumps the counter, and the
+GETs of the collection send an ETag derived from it, so a client polling
+with If-None-Match gets a 304 without the query being run.
+
+An evicted counter is recreated from the clock rather than from zero, so
+it does not go back to a value that an old ETag was built from.
+"""
+
+import hashlib
+import time
+from functools import wraps
+from flask import Response, make_response, request
+from google.appengine.api import memcache
+from mail_safe_test.auth import current_user_key
+
+MEMCACHE_PREFIX = 'collection_version:'
+
+def _version_key(user_key, kind):
+    return '%s%s:%s' % (MEMCACHE_PREFIX, user_key.urlsafe(), kind)
+
+def _initial_version():
+    return int(time.time() * 1000000)
+
+def collection_version(user_key, kind):
+    """Returns the current version of the user's collection of kind."""
+    key = _version_key(user_key, kind)
+    version = memcache.get(key)
+    if version is None:
+        version = _initial_version()
+        if not memcache.add(key, version):
+            # Another request created it first.
+            version = memcache.get(key) or version
+    return version
+
+def bump_version(user_key, kind):
+    """Marks the user's collection of kind as changed. Call after the write."""
+    memcache.incr(_version_key(user_key, kind), initial_value=_initial_version())
+
+def collection_etag(user_key, kind):
+    """Returns the ETag of the current request for the user's collection."""
+    version = collection_version(user_key, kind)
+    tag = '%s:%s:%s:%s' % (user_key.urlsafe(), kind, version, request.full_path)
+    return hashlib.sha1(tag).hexdigest()
+
+def versioned(kind):
+    """Adds an ETag to a GET of the current user's collection of kind, and
+    answers 304 without calling the method if If-None-Match matches it."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            # Read the version before the query, so a write that races with
+            # it leaves the response with an older ETag, never a newer one.
+            etag = collection_etag(current_user_key(), kind)
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+            rv = func(*args, **kwargs)
+            if isinstance(rv, Response):
+                return rv
+            if not isinstance(rv, tuple):
+                rv = (rv,)
+            data, code, headers = rv + (200, None)[len(rv) - 1:]
+            headers = dict(headers or {})
+            headers['ETag'] = '"%s"' % etag
+            return data, code, headers
+        return wrapper
+    return decorator
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_auth.py
+
+"""
+
+import os
+import time
+from datetime import timedelta
+from google.appengine.ext import testbed
+from json import loads
+from unittest import TestCase
+from mail_safe_test import app
+from mail_safe_test.activity import ActivityTracker
+from mail_safe_test.auth import UserModel, current_user, current_user_key
+from mail_safe_test.certs import CertStore, StaticCertSource, parse_max_age
+from mail_safe_test.token_cache import TokenCache
+
+def common_setUp(self):
+    app.config['TESTING'] = True
+    app.config['CSRF_ENABLED'] = False
+    self.app = app.test_client()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_user_stub()
+    self.testbed.init_memcache_stub()
+
+class TokenCacheTestCases(TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        self.cache = TokenCache(max_size=2)
+        self.jwt = {'sub': '1', 'exp': time.time() + 3600}
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_token_cache_miss(self):
+        self.assertEqual(None, self.cache.get('token'))
+        self.assertEqual(1, self.cache.stats()['misses'])
+
+    def test_token_cache_hit(self):
+        self.cache.set('token', self.jwt)
+        self.assertEqual(self.jwt, self.cache.get('token'))
+        self.assertEqual(1, self.cache.stats()['hits'])
+        self.assertEqual(0, self.cache.stats()['misses'])
+
+    def test_token_cache_memcache_hit(self):
+        self.cache.set('token', self.jwt)
+        self.cache.clear()
+        self.assertEqual(self.jwt['sub'], self.cache.get('token')['sub'])
+        self.assertEqual(1, self.cache.stats()['memcache_hits'])
+        # Now promoted back into the local tier.
+        self.cache.get('token')
+        self.assertEqual(1, self.cache.stats()['hits'])
+
+    def test_token_cache_expired(self):
+        jwt = {'sub': '1', 'exp': time.time() - 1}
+        self.cache.set('token', jwt)
+        self.assertEqual(None, self.cache.get('token'))
+
+    def test_token_cache_lru_eviction(self):
+        self.cache.set('token1', self.jwt)
+        self.cache.set('token2', self.jwt)
+        self.cache.get('token1')
+        self.cache.set('token3', self.jwt)
+        self.assertEqual(2, self.cache.stats()['size'])
+        self.cache.get('token2')
+        # token2 was least recently used, so it came back from memcache.
+        self.assertEqual(1, self.cache.stats()['memcache_hits'])
+
+class CertStoreTestCases(TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        self.certs = {'kid1': '-----BEGIN CERTIFICATE-----'}
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_parse_max_age(self):
+        self.assertEqual(22345, parse_max_age('public, max-age=22345, must-revalidate'))
+        self.assertEqual(60, parse_max_age('no-cache', default=60))
+        self.assertEqual(60, parse_max_age(None, default=60))
+
+    def test_cert_store_fetches_once(self):
+        source = StaticCertSource(self.certs)
+        store = CertStore(source)
+        self.assertEqual(self.certs, store.get_certs())
+        self.assertEqual(self.certs, store.get_certs())
+        self.assertEqual(1, source.fetch_count)
+
+    def test_cert_store_memcache_shared(self):
+        source = StaticCertSource(self.certs)
+        CertStore(source).get_certs()
+        # A second instance picks the certs up from memcache.
+        self.assertEqual(self.certs, CertStore(source).get_certs())
+        self.assertEqual(1, source.fetch_count)
+
+    def test_cert_store_refresh_ahead(self):
+        source = StaticCertSource(self.certs, max_age=100)
+        store = CertStore(source, refresh_margin=200)
+        store.get_certs()
+        # Within the refresh margin one request refreshes the certs.
+        self.assertEqual(self.certs, store.get_certs())
+        self.assertEqual(2, source.fetch_count)
+        # The others, here or on other instances, use the current ones.
+        self.assertEqual(self.certs, store.get_certs())
+        self.assertEqual(self.certs, CertStore(source, refresh_margin=200).get_certs())
+        self.assertEqual(2, source.fetch_count)
+
+    def test_cert_store_expired(self):
+        source = StaticCertSource(self.certs, max_age=0)
+        store = CertStore(source, refresh_margin=0)
+        store.get_certs()
+        store.get_certs()
+        self.assertEqual(2, source.fetch_count)
+
+class UserContextTestCases(TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        UserModel(id='1', email='user@example.com').put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_current_user_loaded_once(self):
+        with app.test_request_context(headers={'Authorization': 'valid_user'}):
+            user = current_user()
+            self.assertEqual('user@example.com', user.email)
+            # A second lookup reuses the request-scoped entity.
+            UserModel(id='1', email='changed@example.com').put()
+            self.assertTrue(current_user() is user)
+
+    def test_current_user_key(self):
+        with app.test_request_context(headers={'Authorization': 'valid_user2'}):
+            # The key is derived from the token, the entity is not loaded.
+            self.assertEqual('2', current_user_key().id())
+            self.assertEqual(None, current_user())
+
+    def test_current_user_no_auth(self):
+        with app.test_request_context():
+            self.assertEqual(None, current_user_key())
+            self.assertEqual(None, current_user())
+
+class ActivityTrackerTestCases(TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        self.tracker = ActivityTracker(flush_interval=3600)
+        self.user_key = UserModel(id='1', email='user@example.com').put()
+        self.created = self.user_key.get().last_active
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_activity_buffered(self):
+        self.tracker.touch(self.user_key)
+        self.assertEqual(self.created, self.user_key.get(use_cache=False).last_active)
+
+    def test_activity_flush_coalesces(self):
+        later = self.created + timedelta(minutes=5)
+        self.tracker.touch(self.user_key, self.created + timedelta(minutes=1))
+        self.tracker.touch(self.user_key, later)
+        self.assertEqual(1, self.tracker.flush())
+        self.assertEqual(later, self.user_key.get(use_cache=False).last_active)
+        # Nothing left to write.
+        self.assertEqual(0, self.tracker.flush())
+
+    def test_activity_flush_deleted_user(self):
+        self.tracker.touch(self.user_key)
+        self.user_key.delete()
+        self.assertEqual(0, self.tracker.flush())
+        self.assertEqual(None, self.user_key.get(use_cache=False))
+
+    def test_activity_flush_keeps_edits(self):
+        self.tracker.touch(self.user_key, self.created + timedelta(minutes=1))
+        user = self.user_key.get()
+        user.email = 'changed@example.com'
+        user.put()
+        self.assertEqual(1, self.tracker.flush())
+        user = self.user_key.get(use_cache=False)
+        self.assertEqual('changed@example.com', user.email)
+        self.assertEqual(self.created + timedelta(minutes=1), user.last_active)
+
+    def test_activity_enqueued_on_interval(self):
+        self.testbed.init_taskqueue_stub()
+        taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tracker = ActivityTracker(flush_interval=0)
+        tracker.touch(self.user_key, self.created + timedelta(minutes=1))
+        # The request only enqueued the write.
+        self.assertEqual(self.created, self.user_key.get(use_cache=False).last_active)
+        tasks = taskqueue_stub.get_filtered_tasks(queue_names=['default'])
+        self.assertEqual(1, len(tasks))
+        rv = self.app.post(tasks[0].url, data=tasks[0].payload,
+                headers={'X-AppEngine-QueueName': 'default'})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(self.created + timedelta(minutes=1),
+                         self.user_key.get(use_cache=False).last_active)
+
+class AdminStatsTestCases(TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        # The mail queue is declared in queue.yaml.
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.join(os.path.dirname(__file__), '..'))
+        UserModel(id='3', email='admin@example.com', admin=True).put()
+        UserModel(id='1', email='user@example.com').put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_admin_stats_get(self):
+        rv = self.app.get('/admin/stats/',
+            headers = {'Authorization': 'valid_admin'})
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertTrue('misses' in data['token_cache'])
+        self.assertEqual(0, data['mail']['queue_depth'])
+        self.assertEqual(0, data['mail']['throttled'])
+        self.assertEqual(None, data['link_sweep'])
+
+    def test_admin_stats_get_non_admin(self):
+        rv = self.app.get('/admin/stats/',
+            headers = {'Authorization': 'valid_user'})
+        self.assertEqual(403, rv.status_code)
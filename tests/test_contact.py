@@ -5,13 +5,17 @@ test_contact.py
 
 """
 
+import os
+from google.appengine.api import datastore
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from json import loads, dumps
 from unittest import TestCase
 from mail_safe_test import app
 from mail_safe_test.auth import UserModel
-from mail_safe_test.resources.contact import ContactListAPI, ContactAPI, ContactModel
+from mail_safe_test.resources.job import JobStatus
+from mail_safe_test.fieldsets import projection
+from mail_safe_test.resources.contact import ContactListAPI, ContactAPI, ContactModel, backfill_key
 
 def common_setUp(self):
     # Flask apps testing. See: http://flask.pocoo.org/docs/testing/
@@ -25,6 +29,21 @@ def common_setUp(self):
     self.testbed.init_datastore_v3_stub()
     self.testbed.init_user_stub()
     self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+    self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+def run_tasks(self, queue_name='default'):
+    # Runs queued tasks, including the ones they enqueue, until none are left.
+    while True:
+        tasks = self.taskqueue_stub.get_filtered_tasks(queue_names=[queue_name])
+        if not tasks:
+            break
+        self.taskqueue_stub.FlushQueue(queue_name)
+        for task in tasks:
+            rv = self.app.post(task.url, data=task.payload,
+                    content_type='application/x-www-form-urlencoded',
+                    headers={'X-AppEngine-QueueName': queue_name})
+            self.assertEqual(200, rv.status_code)
 
 def setup_contacts(self):
         # Provision two valid users
@@ -274,6 +293,53 @@ class UserAuthContactTestCases(TestCase):
         verify_contact_count(self, 2)
         verify_user_contact_count(self, self.user1_id, 1)
 
+    def test_contact_post_dedup_email(self):
+        for email in ('Dedup@Test.com', ' dedup@test.com'):
+            post_data = dict(self.post_data, email=email)
+            rv = self.app.post('/user/contacts/?dedup=email',
+                    data=dumps(post_data),
+                    content_type='application/json',
+                    headers = {'Authorization': self.user1_token})
+            self.assertEqual(200, rv.status_code)
+        verify_user_contact_count(self, self.user1_id, 2)
+        self.assertEqual(' dedup@test.com', loads(rv.data)['email'])
+
+    def test_contact_post_dedup_phone(self):
+        for phone in ('+1 (555) 123-4567', '+15551234567'):
+            post_data = dict(self.post_data, phone=phone)
+            rv = self.app.post('/user/contacts/?dedup=phone',
+                    data=dumps(post_data),
+                    content_type='application/json',
+                    headers = {'Authorization': self.user1_token})
+            self.assertEqual(200, rv.status_code)
+        verify_user_contact_count(self, self.user1_id, 2)
+
+    def test_contact_put_dedup_field(self):
+        rv = self.app.post('/user/contacts/?dedup=email',
+                data=dumps({'email': 'dedup@test.com', 'phone': '1234567890'}),
+                content_type='application/json',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        uri = loads(rv.data)['uri']
+        # Its key comes from the email, which can't change.
+        rv = self.app.put(uri, data=dumps({'email': 'moved@test.com'}),
+                content_type='application/json',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(409, rv.status_code)
+        rv = self.app.put(uri, data=dumps({'email': 'DEDUP@test.com', 'phone': '5550001111'}),
+                content_type='application/json',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('DEDUP@test.com', loads(rv.data)['email'])
+
+    def test_contact_post_dedup_invalid(self):
+        rv = self.app.post('/user/contacts/?dedup=name',
+                data=dumps(self.post_data),
+                content_type='application/json',
+                headers = {'Authorization': self.user1_token})
+        self.assertEqual(400, rv.status_code)
+        verify_user_contact_count(self, self.user1_id, 1)
+
     def test_contact_post_missing_email(self):
         verify_contact_count(self, self.c_num)
         verify_user_contact_count(self, self.user1_id, 1)
@@ -354,6 +420,143 @@ class UserAuthContactTestCases(TestCase):
         self.assertEqual('contact2@example.com', data['contacts'][0]['email'])
         self.assertEqual('1234567890', data['contacts'][0]['phone'])
     
+    def test_contact_list_get_paged(self):
+        for i in range(4):
+            ContactModel(parent=ndb.Key(UserModel, self.user1_id),
+                         email="paged%d@example.com" % i).put()
+        seen = []
+        cursor = None
+        while True:
+            url = '/user/contacts/?limit=2'
+            if cursor:
+                url += '&cursor=' + cursor
+            rv = self.app.get(url, headers={'Authorization': self.user1_token})
+            self.assertEqual(200, rv.status_code)
+            data = loads(rv.data)
+            self.assertTrue(len(data['contacts']) <= 2)
+            seen += [c['email'] for c in data['contacts']]
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(5, len(seen))
+        self.assertEqual(5, len(set(seen)))
+
+    def test_contact_list_get_max_page_size(self):
+        max_page_size = app.config['MAX_PAGE_SIZE']
+        app.config['MAX_PAGE_SIZE'] = 1
+        try:
+            ContactModel(parent=ndb.Key(UserModel, self.user1_id),
+                         email="another@example.com").put()
+            rv = self.app.get('/user/contacts/?limit=100',
+                    headers={'Authorization': self.user1_token})
+        finally:
+            app.config['MAX_PAGE_SIZE'] = max_page_size
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual(1, len(data['contacts']))
+        self.assertNotEqual(None, data['next_cursor'])
+
+    def test_contact_list_get_invalid_page(self):
+        rv = self.app.get('/user/contacts/?limit=0',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(400, rv.status_code)
+        rv = self.app.get('/user/contacts/?cursor=notacursor',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(400, rv.status_code)
+
+    def test_contact_list_get_not_modified(self):
+        auth = {'Authorization': self.user1_token}
+        rv = self.app.get('/user/contacts/', headers=auth)
+        self.assertEqual(200, rv.status_code)
+        etag = rv.headers['ETag']
+
+        rv = self.app.get('/user/contacts/', headers=dict(auth, **{'If-None-Match': etag}))
+        self.assertEqual(304, rv.status_code)
+        self.assertEqual(etag, rv.headers['ETag'])
+
+        # Another page of the same collection has its own ETag.
+        rv = self.app.get('/user/contacts/?limit=1', headers=dict(auth, **{'If-None-Match': etag}))
+        self.assertEqual(200, rv.status_code)
+
+        # Another user's copy of the ETag does not match.
+        rv = self.app.get('/user/contacts/', headers={'Authorization': self.user2_token,
+                                                      'If-None-Match': etag})
+        self.assertEqual(200, rv.status_code)
+
+        rv = self.app.post('/user/contacts/', data=dumps(self.post_data),
+                content_type='application/json', headers=auth)
+        self.assertEqual(200, rv.status_code)
+        rv = self.app.get('/user/contacts/', headers=dict(auth, **{'If-None-Match': etag}))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(2, len(loads(rv.data)['contacts']))
+        self.assertNotEqual(etag, rv.headers['ETag'])
+
+    def test_contact_id_get_not_modified(self):
+        auth = {'Authorization': self.user1_token}
+        rv = self.app.get('/user/contact/12345/', headers=auth)
+        etag = rv.headers['ETag']
+        rv = self.app.get('/user/contact/12345/', headers=dict(auth, **{'If-None-Match': etag}))
+        self.assertEqual(304, rv.status_code)
+
+        rv = self.app.put('/user/contact/12345/', data=dumps(self.put_data),
+                content_type='application/json', headers=auth)
+        self.assertEqual(200, rv.status_code)
+        rv = self.app.get('/user/contact/12345/', headers=dict(auth, **{'If-None-Match': etag}))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('Changed', loads(rv.data)['first_name'])
+
+    def test_contact_list_get_fields(self):
+        rv = self.app.get('/user/contacts/?fields=email,uri',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual([{'email': self.c_email, 'uri': '/user/contact/12345/'}],
+                         data['contacts'])
+
+        rv = self.app.get('/user/contacts/?fields=first_name,phone',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([{'first_name': self.c_fname, 'phone': self.c_phone}],
+                         loads(rv.data)['contacts'])
+
+    def test_contact_list_get_unknown_field(self):
+        rv = self.app.get('/user/contacts/?fields=email,password',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(400, rv.status_code)
+
+    def test_contact_fields_projection(self):
+        projections = ContactListAPI.projections
+        self.assertEqual(['email'], projection(ContactModel,
+                frozenset(['email', 'uri']), projections))
+        # No index covers phone, so the entities are loaded.
+        self.assertEqual(None, projection(ContactModel,
+                frozenset(['email', 'phone']), projections))
+        self.assertEqual(None, projection(ContactModel, None, projections))
+        # In the order of the index, whatever the order asked for.
+        self.assertEqual(['first_name', 'last_name', 'email'], projection(ContactModel,
+                frozenset(['email', 'last_name', 'first_name']), projections))
+
+    def test_contact_list_get_fields_cursor(self):
+        ContactModel(parent=ndb.Key(UserModel, self.user1_id),
+                     email="paged@example.com").put()
+        auth = {'Authorization': self.user1_token}
+        rv = self.app.get('/user/contacts/?limit=1&fields=email', headers=auth)
+        self.assertEqual(200, rv.status_code)
+        cursor = loads(rv.data)['next_cursor']
+        rv = self.app.get('/user/contacts/?limit=1&fields=email&cursor=' + cursor,
+                          headers=auth)
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(1, len(loads(rv.data)['contacts']))
+        # The cursor of a projection does not continue another query.
+        rv = self.app.get('/user/contacts/?limit=1&cursor=' + cursor, headers=auth)
+        self.assertEqual(400, rv.status_code)
+
+    def test_contact_id_get_fields(self):
+        rv = self.app.get('/user/contact/12345/?fields=last_name',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual({'last_name': self.c_lname}, loads(rv.data))
+
     def test_contact_list_delete(self):
         verify_contact_count(self, 2)
         verify_user_contact_count(self, self.user1_id, 1)
@@ -361,11 +564,220 @@ class UserAuthContactTestCases(TestCase):
 
         rv = self.app.delete('/user/contacts/',
                 headers={'Authorization': self.user1_token})
-        self.assertEqual(200, rv.status_code)
+        self.assertEqual(202, rv.status_code)
+        job_uri = loads(rv.data)['uri']
+
+        run_tasks(self)
 
+        rv = self.app.get(job_uri, headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
         data = loads(rv.data)
-        self.assertEqual([], data['contacts'])
+        self.assertEqual(JobStatus.DONE, data['status'])
+        self.assertEqual(1, data['processed'])
         
         verify_contact_count(self, 1)
         verify_user_contact_count(self, self.user1_id, 0)
         verify_user_contact_count(self, self.user2_id, 1)
+
+    def test_contact_list_delete_batches(self):
+        for i in range(2):
+            ContactModel(parent=ndb.Key(UserModel, self.user1_id),
+                         email="batch%d@example.com" % i).put()
+        batch_size = app.config['DELETE_BATCH_SIZE']
+        app.config['DELETE_BATCH_SIZE'] = 1
+        try:
+            rv = self.app.delete('/user/contacts/',
+                    headers={'Authorization': self.user1_token})
+            self.assertEqual(202, rv.status_code)
+            run_tasks(self)
+        finally:
+            app.config['DELETE_BATCH_SIZE'] = batch_size
+        rv = self.app.get(loads(rv.data)['uri'],
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(3, loads(rv.data)['processed'])
+        verify_user_contact_count(self, self.user1_id, 0)
+        verify_user_contact_count(self, self.user2_id, 1)
+
+    def test_delete_task_no_queue_header(self):
+        rv = self.app.post('/tasks/delete/', data={'job': 'x'},
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(403, rv.status_code)
+
+class ContactImportTestCases(TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        setup_contacts(self)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_contact_import_csv(self):
+        data = ("First Name,Last Name,Email,Phone\r\n"
+                "Ada,Lovelace,ada@example.com,5551234567\r\n"
+                "No,Phone,nophone@example.com,\r\n"
+                "\r\n"
+                "Bad,Email,bad-email,5551234567\r\n"
+                "Alan,Turing,alan@example.com,5557654321\r\n")
+        rv = self.app.post('/user/contacts/import/', data=data,
+                content_type='text/csv',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        result = loads(rv.data)
+        self.assertEqual(2, result['imported'])
+        self.assertEqual([{'row': 3, 'error': 'missing phone'},
+                          {'row': 5, 'error': 'invalid email'}], result['errors'])
+        verify_user_contact_count(self, self.user1_id, 3)
+        contact = ContactModel.query(ContactModel.email == 'ada@example.com').get()
+        self.assertEqual('Lovelace', contact.last_name)
+        self.assertEqual(ndb.Key(UserModel, self.user1_id), contact.key.parent())
+
+    def test_contact_import_batches(self):
+        batch_size = app.config['CONTACT_IMPORT_BATCH_SIZE']
+        app.config['CONTACT_IMPORT_BATCH_SIZE'] = 2
+        data = "email,phone\n" + "".join(
+            "import%d@example.com,555000000%d\n" % (i, i) for i in range(5))
+        try:
+            rv = self.app.post('/user/contacts/import/?format=csv', data=data,
+                    headers={'Authorization': self.user1_token})
+        finally:
+            app.config['CONTACT_IMPORT_BATCH_SIZE'] = batch_size
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(5, loads(rv.data)['imported'])
+        verify_user_contact_count(self, self.user1_id, 6)
+
+    def test_contact_import_dedup(self):
+        data = "email,phone\nada@example.com,5551234567\n"
+        for i in range(2):
+            rv = self.app.post('/user/contacts/import/?format=csv&dedup=email',
+                    data=data, headers={'Authorization': self.user1_token})
+            self.assertEqual(200, rv.status_code)
+            self.assertEqual(1, loads(rv.data)['imported'])
+        verify_user_contact_count(self, self.user1_id, 2)
+
+    def test_contact_import_dedup_merges(self):
+        rv = self.app.post('/user/contacts/?dedup=email',
+                data=dumps({'email': 'ada@example.com', 'phone': '5551234567',
+                            'first_name': 'Ada'}),
+                content_type='application/json',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        created = ContactModel.query(ContactModel.email == 'ada@example.com').get().created
+        # Two rows for the same contact in one batch, neither with a first name.
+        data = ("email,phone,last name\n"
+                "ada@example.com,5551234567,Byron\n"
+                "ADA@example.com,5559999999,Lovelace\n")
+        rv = self.app.post('/user/contacts/import/?format=csv&dedup=email',
+                data=data, headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(1, loads(rv.data)['imported'])
+        verify_user_contact_count(self, self.user1_id, 2)
+        contact = ContactModel.query(ContactModel.last_name == 'Lovelace').get()
+        self.assertEqual('Ada', contact.first_name)
+        self.assertEqual('5559999999', contact.phone)
+        self.assertEqual(created, contact.created)
+
+    def test_contact_import_vcard(self):
+        data = ("BEGIN:VCARD\r\n"
+                "VERSION:3.0\r\n"
+                "N:Hopper;Grace;;;\r\n"
+                "FN:Grace Hopper\r\n"
+                "EMAIL;TYPE=INTERNET:grace@exam\r\n"
+                " ple.com\r\n"
+                "TEL;TYPE=CELL:5551112222\r\n"
+                "END:VCARD\r\n"
+                "BEGIN:VCARD\r\n"
+                "FN:Nobody\r\n"
+                "END:VCARD\r\n")
+        rv = self.app.post('/user/contacts/import/', data=data,
+                content_type='text/vcard',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        result = loads(rv.data)
+        self.assertEqual(1, result['imported'])
+        self.assertEqual([{'row': 9, 'error': 'missing email'}], result['errors'])
+        contact = ContactModel.query(ContactModel.email == 'grace@example.com').get()
+        self.assertEqual('Grace', contact.first_name)
+        self.assertEqual('Hopper', contact.last_name)
+        self.assertEqual('5551112222', contact.phone)
+
+    def test_contact_import_no_auth(self):
+        rv = self.app.post('/user/contacts/import/', data="email,phone\n")
+        self.assertEqual(403, rv.status_code)
+
+class ContactSearchTestCases(TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        setup_contacts(self)
+        parent = ndb.Key(UserModel, self.user1_id)
+        ContactModel(parent=parent, first_name="Firmin", last_name="Zed",
+                     email="zed@example.com").put()
+        ContactModel(parent=parent, first_name="Ann", last_name="First",
+                     email="ann@example.com").put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def search(self, query, token=None):
+        rv = self.app.get('/user/contacts/search/?' + query,
+                headers={'Authorization': token or self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        return sorted(c['email'] for c in loads(rv.data)['contacts'])
+
+    def test_contact_search_first_name(self):
+        self.assertEqual(['zed@example.com'], self.search('q=firm'))
+
+    def test_contact_search_any_field(self):
+        # "Firstname", "Firmin" and last name "First" all match.
+        self.assertEqual(['ann@example.com', 'contact1@example.com', 'zed@example.com'],
+                         self.search('q=FIR'))
+
+    def test_contact_search_email(self):
+        self.assertEqual(['zed@example.com'], self.search('q=zed@'))
+
+    def test_contact_search_no_match(self):
+        self.assertEqual([], self.search('q=nobody'))
+
+    def test_contact_search_other_user(self):
+        self.assertEqual(['contact2@example.com'], self.search('q=f', self.user2_token))
+
+    def test_contact_search_limit(self):
+        self.assertEqual(1, len(self.search('q=fir&limit=1')))
+        for limit in ('0', '-1'):
+            rv = self.app.get('/user/contacts/search/?q=fir&limit=' + limit,
+                    headers={'Authorization': self.user1_token})
+            self.assertEqual(400, rv.status_code)
+
+    def test_contact_search_backfill(self):
+        # Saved before the search properties existed.
+        entity = datastore.Entity('ContactModel',
+                                  parent=ndb.Key(UserModel, self.user1_id).to_old_key())
+        entity.update({'first_name': u'Old', 'email': u'old@example.com'})
+        datastore.Put(entity)
+        self.assertEqual([], self.search('q=old'))
+        UserModel(id='3', email='admin@example.com', admin=True).put()
+        # The maintenance queue is declared in queue.yaml.
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.join(os.path.dirname(__file__), '..'))
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        rv = self.app.post('/admin/contacts/backfill/', headers={'Authorization': 'valid_admin'})
+        self.assertEqual(202, rv.status_code)
+        run_tasks(self, 'maintenance')
+        self.assertEqual(['old@example.com'], self.search('q=old'))
+        job = backfill_key().get()
+        self.assertEqual(JobStatus.DONE, job.status)
+        self.assertEqual(ContactModel.query().count(), job.processed)
+        rv = self.app.post('/admin/contacts/backfill/', headers={'Authorization': self.user1_token})
+        self.assertEqual(403, rv.status_code)
+
+    def test_contact_search_fields(self):
+        rv = self.app.get('/user/contacts/search/?q=firm&fields=email',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual({'contacts': [{'email': 'zed@example.com'}]}, loads(rv.data))
+
+    def test_contact_search_missing_query(self):
+        rv = self.app.get('/user/contacts/search/',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(400, rv.status_code)
@@ -5,13 +5,18 @@ test_doc.py
 
 """
 
+from datetime import datetime
+from random import Random
+from string import ascii_letters
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from json import loads, dumps
 from unittest import TestCase
 from mail_safe_test import app
 from mail_safe_test.auth import UserModel
-from mail_safe_test.resources.doc import DocListAPI, DocAPI, DocModel
+from mail_safe_test.resources.job import JobStatus
+from mail_safe_test.doc_storage import DocChunkModel, DocRevisionModel
+from mail_safe_test.resources.doc import DocListAPI, DocAPI, DocModel, DocStatus
 
 def common_setUp(self):
     # Flask apps testing. See: http://flask.pocoo.org/docs/testing/
@@ -23,6 +28,21 @@ def common_setUp(self):
     self.testbed.init_datastore_v3_stub()
     self.testbed.init_user_stub()
     self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+    self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+def run_tasks(self):
+    # Runs queued tasks, including the ones they enqueue, until none are left.
+    while True:
+        tasks = self.taskqueue_stub.get_filtered_tasks(queue_names=['default'])
+        if not tasks:
+            break
+        self.taskqueue_stub.FlushQueue('default')
+        for task in tasks:
+            rv = self.app.post(task.url, data=task.payload,
+                    content_type='application/x-www-form-urlencoded',
+                    headers={'X-AppEngine-QueueName': 'default'})
+            self.assertEqual(200, rv.status_code)
 
 def setup_documents(self):
         # Provision two valid users
@@ -371,8 +391,9 @@ class AuthUserDocTestCases(TestCase):
         self.assertEqual(200, rv.status_code)
         data = loads(rv.data)
         self.assertEqual(self.d_title, data['docs'][0]['title'])
-        self.assertEqual(self.d_content, data['docs'][0]['content'])
         self.assertEqual(self.d_status, data['docs'][0]['status'])
+        # Lists leave out the bodies.
+        self.assertNotIn('content', data['docs'][0])
 
         rv = self.app.get('/user/docs/',
                 headers={'Authorization': self.user2_token})
@@ -380,9 +401,21 @@ class AuthUserDocTestCases(TestCase):
 
         data = loads(rv.data)
         self.assertEqual("Another Title", data['docs'][0]['title'])
-        self.assertEqual("Howdy. This is a different test document. With other content. And exclamation points!", data['docs'][0]['content'])
         self.assertEqual(1, data['docs'][0]['status'])
 
+    def test_document_list_get_not_modified(self):
+        auth = {'Authorization': self.user1_token}
+        rv = self.app.get('/user/docs/', headers=auth)
+        etag = rv.headers['ETag']
+        rv = self.app.get('/user/docs/', headers=dict(auth, **{'If-None-Match': etag}))
+        self.assertEqual(304, rv.status_code)
+
+        rv = self.app.delete('/user/doc/12345/', headers=auth)
+        self.assertEqual(204, rv.status_code)
+        rv = self.app.get('/user/docs/', headers=dict(auth, **{'If-None-Match': etag}))
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([], loads(rv.data)['docs'])
+
     def test_document_list_delete(self):
         verify_document_count(self, 2)
         verify_user_document_count(self, self.user1_id, 1)
@@ -390,11 +423,201 @@ class AuthUserDocTestCases(TestCase):
 
         rv = self.app.delete('/user/docs/',
                 headers={'Authorization': self.user1_token})
-        self.assertEqual(200, rv.status_code)
+        self.assertEqual(202, rv.status_code)
+        job_uri = loads(rv.data)['uri']
+
+        run_tasks(self)
 
+        rv = self.app.get(job_uri, headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
         data = loads(rv.data)
-        self.assertEqual([], data['docs'])
+        self.assertEqual(JobStatus.DONE, data['status'])
+        self.assertEqual(1, data['processed'])
 
         verify_document_count(self, 1)
         verify_user_document_count(self, self.user1_id, 0)
         verify_user_document_count(self, self.user2_id, 1)
+        # The bodies went by kind, after the docs.
+        user1 = ndb.Key(UserModel, self.user1_id)
+        self.assertEqual(0, DocChunkModel.query(ancestor=user1).count())
+        self.assertEqual(0, DocRevisionModel.query(ancestor=user1).count())
+        user2 = ndb.Key(UserModel, self.user2_id)
+        self.assertTrue(DocChunkModel.query(ancestor=user2).count() > 0)
+
+class DocFilterTestCases(TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        setup_documents(self)
+        self.auth = {'Authorization': self.user1_token}
+        parent = ndb.Key(UserModel, self.user1_id)
+        for day, status in ((1, DocStatus.DRAFT), (2, DocStatus.SENT),
+                            (3, DocStatus.SENT), (4, DocStatus.DRAFT)):
+            DocModel(parent=parent, title='Day %d' % day, status=status,
+                     date=datetime(2014, 8, day, 12)).put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def get_titles(self, query):
+        rv = self.app.get('/user/docs/?' + query, headers=self.auth)
+        self.assertEqual(200, rv.status_code)
+        return [d['title'] for d in loads(rv.data)['docs']]
+
+    def test_document_list_status(self):
+        self.assertEqual(['Day 3', 'Day 2'], self.get_titles('status=sent'))
+        self.assertEqual(['Day 3', 'Day 2'], self.get_titles('status=1'))
+
+    def test_document_list_order(self):
+        self.assertEqual(['Day 1', 'Day 2', 'Day 3', 'Day 4', self.d_title],
+                         self.get_titles('order=date'))
+        self.assertEqual(['Day 1', 'Day 4', self.d_title],
+                         self.get_titles('status=draft&order=date'))
+
+    def test_document_list_date_range(self):
+        self.assertEqual(['Day 3', 'Day 2'],
+                         self.get_titles('since=2014-08-02&until=2014-08-04'))
+        self.assertEqual(['Day 2'],
+                         self.get_titles('since=2014-08-02T14:00:00%2B02:00&until=2014-08-03&order=date'))
+        self.assertEqual(['Day 3'],
+                         self.get_titles('status=sent&since=2014-08-03'))
+
+    def test_document_list_bad_filters(self):
+        for query in ('status=published', 'order=title', 'since=yesterday',
+                      'since=2014-08-04&until=2014-08-02'):
+            rv = self.app.get('/user/docs/?' + query, headers=self.auth)
+            self.assertEqual(400, rv.status_code, query)
+
+class DocStorageTestCases(TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        setup_documents(self)
+        self.chunk_size = app.config['DOC_CHUNK_SIZE']
+        app.config['DOC_CHUNK_SIZE'] = 64
+
+    def tearDown(self):
+        app.config['DOC_CHUNK_SIZE'] = self.chunk_size
+        self.testbed.deactivate()
+
+    def test_large_document(self):
+        # Well past the 1500 bytes of an indexed string, and not very
+        # compressible, so it spans several chunks.
+        rng = Random(7919)
+        content = u''.join(rng.choice(ascii_letters) for i in range(4000))
+        rv = self.app.post('/user/docs/',
+                data=dumps({'title': 'Big', 'content': content, 'status': 0}),
+                content_type='application/json',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(content, loads(rv.data)['content'])
+
+        doc = DocModel.query(DocModel.title == 'Big').get()
+        self.assertTrue(doc.content_chunks > 1)
+        self.assertEqual(content, doc.content)
+
+    def test_update_replaces_chunks(self):
+        doc = DocModel.query_by_id(self.user1_id, self.d_id)
+        snapshot_chunks = DocChunkModel.query(ancestor=doc.key).fetch(keys_only=True)
+        for content in ('Rewritten', 'Rewritten again'):
+            rv = self.app.put('/user/doc/12345/',
+                    data=dumps({'content': content}),
+                    content_type='application/json',
+                    headers={'Authorization': self.user1_token})
+            self.assertEqual(200, rv.status_code)
+            self.assertEqual(content, loads(rv.data)['content'])
+        # The first revision is a snapshot and keeps its chunks, the
+        # second is a delta and its chunks went when it was replaced.
+        chunks = DocChunkModel.query(ancestor=doc.key).fetch(keys_only=True)
+        self.assertEqual(2, len(chunks))
+        self.assertTrue(set(snapshot_chunks) < set(chunks))
+
+    def test_update_in_transaction(self):
+        doc_key = ndb.Key(UserModel, self.user1_id, DocModel, self.d_id)
+
+        @ndb.transactional
+        def txn():
+            doc = doc_key.get()
+            doc.content = u'Rewritten in a transaction'
+            doc.put()
+        txn()
+        doc = doc_key.get()
+        self.assertEqual(2, doc.content_generation)
+        self.assertEqual(u'Rewritten in a transaction', doc.content)
+
+    def test_legacy_content(self):
+        # A body saved inline before the chunked storage is still served.
+        doc = DocModel(parent=ndb.Key(UserModel, self.user1_id), id='legacy',
+                       title='Old', legacy_content=u'Inline body', status=0)
+        doc.put()
+        rv = self.app.get('/user/doc/legacy/',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('Inline body', loads(rv.data)['content'])
+
+    def test_delete_removes_chunks(self):
+        rv = self.app.delete('/user/doc/12345/',
+                headers={'Authorization': self.user1_token})
+        self.assertEqual(204, rv.status_code)
+        parent = ndb.Key(UserModel, self.user1_id)
+        self.assertEqual(0, DocChunkModel.query(ancestor=parent).count())
+
+class DocRevisionTestCases(TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        setup_documents(self)
+        self.snapshot_interval = app.config['DOC_SNAPSHOT_INTERVAL']
+        app.config['DOC_SNAPSHOT_INTERVAL'] = 3
+        self.auth = {'Authorization': self.user1_token}
+        # Revision 1 is the document from setup_documents.
+        self.contents = [self.d_content]
+        lines = [u'line %d\n' % i for i in range(20)]
+        for i in range(6):
+            lines[i * 3] = u'edit %d\n' % i
+            lines.append(u'added %d\n' % i)
+            self.contents.append(u''.join(lines))
+            rv = self.app.put('/user/doc/12345/',
+                    data=dumps({'content': self.contents[-1]}),
+                    content_type='application/json', headers=self.auth)
+            self.assertEqual(200, rv.status_code)
+            self.assertEqual(i + 2, loads(rv.data)['revision'])
+
+    def tearDown(self):
+        app.config['DOC_SNAPSHOT_INTERVAL'] = self.snapshot_interval
+        self.testbed.deactivate()
+
+    def test_revision_get(self):
+        for number, content in enumerate(self.contents, 1):
+            rv = self.app.get('/user/doc/12345/revision/%d/' % number, headers=self.auth)
+            self.assertEqual(200, rv.status_code)
+            data = loads(rv.data)
+            self.assertEqual(number, data['number'])
+            self.assertEqual(content, data['content'])
+
+    def test_revision_snapshots(self):
+        doc_key = ndb.Key(UserModel, self.user1_id, DocModel, self.d_id)
+        revisions = DocRevisionModel.query(ancestor=doc_key).fetch()
+        snapshots = [r.number for r in revisions if r.delta is None]
+        self.assertEqual([1, 4, 7], sorted(snapshots))
+
+    def test_revision_list(self):
+        rv = self.app.get('/user/doc/12345/revisions/?limit=3', headers=self.auth)
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual([7, 6, 5], [r['number'] for r in data['revisions']])
+        self.assertEqual(len(self.contents[-1]), data['revisions'][0]['size'])
+
+    def test_revision_missing(self):
+        rv = self.app.get('/user/doc/12345/revision/99/', headers=self.auth)
+        self.assertEqual(404, rv.status_code)
+        rv = self.app.get('/user/doc/67890/revision/1/', headers=self.auth)
+        self.assertEqual(404, rv.status_code)
+        rv = self.app.get('/user/doc/67890/revisions/', headers=self.auth)
+        self.assertEqual(404, rv.status_code)
+
+    def test_delete_removes_revisions(self):
+        rv = self.app.delete('/user/doc/12345/', headers=self.auth)
+        self.assertEqual(204, rv.status_code)
+        doc_key = ndb.Key(UserModel, self.user1_id, DocModel, self.d_id)
+        self.assertEqual(0, DocRevisionModel.query(ancestor=doc_key).count())
@@ -3,15 +3,34 @@ test_link.py
 
 """
 
+import asyncore
+import os
+import smtpd
+import threading
+from datetime import datetime, timedelta
+from email import message_from_string
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from json import loads, dumps
 from unittest import TestCase
 from mail_safe_test import app
 from mail_safe_test.auth import UserModel
+from mail_safe_test.email_templates import PreparedEmail, preview
+from mail_safe_test.mail_transport import (MemoryTransport, RecipientError, SMTPTransport,
+                                           get_transport)
+from mail_safe_test.rate_limit import TokenBucket
 from mail_safe_test.resources.contact import ContactModel
 from mail_safe_test.resources.doc import DocModel, DocStatus
-from mail_safe_test.resources.link import LinkModel
+from mail_safe_test.resources.job import JobModel, JobStatus, load_progress
+from mail_safe_test.resources.link import LinkModel, start_link_sweep, sweep_key
+from mail_safe_test.resources.list import ListModel
+from mail_safe_test.resources.mail import SendShardModel
+from mail_safe_test.otp import issue_otp
+from mail_safe_test.sms import SMSError, get_sms_backend
+from mail_safe_test.suppression import (BloomFilter, SuppressionModel, SuppressionReason,
+                                        filter_key, fold_suppressions, suppress, suppressed,
+                                        suppression_filter)
 
 def common_setUp(self):
     app.config['TESTING'] = True
@@ -24,6 +43,43 @@ def common_setUp(self):
     self.testbed.init_memcache_stub()
     self.testbed.init_mail_stub()
     self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+    # The root path has queue.yaml, which declares the mail queue.
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.join(os.path.dirname(__file__), '..'))
+    self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+def run_tasks(self, queue_name='mail'):
+    # Runs queued tasks, including the ones they enqueue, until none are left.
+    while True:
+        tasks = self.taskqueue_stub.get_filtered_tasks(queue_names=[queue_name])
+        if not tasks:
+            break
+        self.taskqueue_stub.FlushQueue(queue_name)
+        for task in tasks:
+            rv = self.app.post(task.url, data=task.payload,
+                    content_type='application/x-www-form-urlencoded',
+                    headers={'X-AppEngine-QueueName': queue_name})
+            self.assertEqual(200, rv.status_code)
+
+class SinkServer(smtpd.SMTPServer):
+    # A stand-in SMTP relay that keeps what it receives.
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+        thread.daemon = True
+        thread.start()
 
 
 class MailTest(TestCase):
@@ -54,6 +110,15 @@ class MailTest(TestCase):
         contact = ContactModel(parent=user.key, **self.contact_args)
         contact.put()
 
+        # A second contact that is in a list of its own
+        self.listed_args = {'email': 'contact2@test.com',
+                            'phone': '1231231235'}
+        listed = ContactModel(parent=user.key, **self.listed_args)
+        listed.put()
+        lst = ListModel(parent=user.key, name='Listed', members=[listed.key])
+        lst.put()
+        self.list_id = str(lst.key.id())
+
     def tearDown(self):
         self.testbed.deactivate()
 
@@ -68,8 +133,11 @@ class MailTest(TestCase):
                 content_type='application/json',
                 headers={'Authorization': self.user_token}
                 )
-        self.assertEqual(200, rv.status_code)
-        num_users = 1
+        self.assertEqual(202, rv.status_code)
+        # Nothing is sent until the tasks run.
+        self.assertEqual(0, len(self.mail_stub.get_sent_messages()))
+        run_tasks(self)
+        num_users = 2
         # Correct number of links
         num_links_after = LinkModel.query().count()
         self.assertEqual(num_links_before + num_users, num_links_after)
@@ -78,3 +146,603 @@ class MailTest(TestCase):
         self.assertEqual(1, len(messages))
         self.assertEqual(self.contact_args['email'], messages[0].to)
 
+    def test_send_mail_list(self):
+        data = {'doc_id': self.doc_id, 'list': self.list_id}
+        rv = self.app.post('/user/mail/', data=dumps(data),
+                content_type='application/json',
+                headers={'Authorization': self.user_token}
+                )
+        self.assertEqual(202, rv.status_code)
+        run_tasks(self)
+        self.assertEqual(1, LinkModel.query().count())
+        # Only the list member was sent the message.
+        self.assertEqual(1, len(self.mail_stub.get_sent_messages()))
+        messages = self.mail_stub.get_sent_messages(to=self.listed_args['email'])
+        self.assertEqual(1, len(messages))
+
+    def test_send_mail_list_edited_during_send(self):
+        lst = ListModel.get_by_id(int(self.list_id), parent=ndb.Key(UserModel, self.user_id))
+        contact = ContactModel.query(ContactModel.email == self.contact_args['email']).get()
+        lst.members = [contact.key] + lst.members
+        lst.put()
+        shard_size = app.config['MAIL_SHARD_SIZE']
+        app.config['MAIL_SHARD_SIZE'] = 1
+        try:
+            data = {'doc_id': self.doc_id, 'list': self.list_id}
+            rv = self.app.post('/user/mail/', data=dumps(data),
+                    content_type='application/json',
+                    headers={'Authorization': self.user_token})
+            self.assertEqual(202, rv.status_code)
+            # Removing a member doesn't shift the rest past the cursor.
+            lst.members = lst.members[1:]
+            lst.put()
+            run_tasks(self)
+        finally:
+            app.config['MAIL_SHARD_SIZE'] = shard_size
+        self.assertEqual(2, len(self.mail_stub.get_sent_messages()))
+
+    def test_send_mail_missing_list(self):
+        data = {'doc_id': self.doc_id, 'list': '999'}
+        rv = self.app.post('/user/mail/', data=dumps(data),
+                content_type='application/json',
+                headers={'Authorization': self.user_token}
+                )
+        self.assertEqual(404, rv.status_code)
+        self.assertEqual(0, len(self.mail_stub.get_sent_messages()))
+
+    def test_send_mail_shards(self):
+        shard_size = app.config['MAIL_SHARD_SIZE']
+        app.config['MAIL_SHARD_SIZE'] = 1
+        try:
+            rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                    content_type='application/json',
+                    headers={'Authorization': self.user_token})
+            self.assertEqual(202, rv.status_code)
+            job_uri = loads(rv.data)['uri']
+            run_tasks(self)
+        finally:
+            app.config['MAIL_SHARD_SIZE'] = shard_size
+
+        rv = self.app.get(job_uri + '?fields=status,processed',
+                headers={'Authorization': self.user_token})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual({'status': JobStatus.DONE, 'processed': 2}, loads(rv.data))
+        rv = self.app.get(job_uri, headers={'Authorization': self.user_token})
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual('send', data['type'])
+        self.assertEqual(JobStatus.DONE, data['status'])
+        self.assertEqual(2, data['shards'])
+        self.assertEqual(2, data['shards_done'])
+        self.assertEqual(2, data['processed'])
+        self.assertEqual(2, len(self.mail_stub.get_sent_messages()))
+
+    def test_send_mail_shard_retry(self):
+        rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                content_type='application/json',
+                headers={'Authorization': self.user_token})
+        self.assertEqual(202, rv.status_code)
+        run_tasks(self)
+        # A repeat of a finished shard's task sends nothing.
+        shard = SendShardModel.query().get()
+        rv = self.app.post('/tasks/mail/shard/', data={'shard': shard.key.urlsafe()},
+                headers={'X-AppEngine-QueueName': 'mail'})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(2, len(self.mail_stub.get_sent_messages()))
+        self.assertEqual(2, load_progress(JobModel.query().get()).processed)
+
+    def test_send_mail_idempotency_key(self):
+        headers = {'Authorization': self.user_token, 'Idempotency-Key': 'send-1'}
+        rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                content_type='application/json', headers=headers)
+        self.assertEqual(202, rv.status_code)
+        job_uri = loads(rv.data)['uri']
+        # A retry of the request returns the same job and starts nothing.
+        rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                content_type='application/json', headers=headers)
+        self.assertEqual(202, rv.status_code)
+        self.assertEqual(job_uri, loads(rv.data)['uri'])
+        run_tasks(self)
+        self.assertEqual(1, JobModel.query().count())
+        self.assertEqual(2, LinkModel.query().count())
+        self.assertEqual(2, len(self.mail_stub.get_sent_messages()))
+
+        rv = self.app.get(job_uri, headers={'Authorization': self.user_token})
+        self.assertEqual(200, rv.status_code)
+        # The key can't be reused for another send.
+        data = {'doc_id': self.doc_id, 'list': self.list_id}
+        rv = self.app.post('/user/mail/', data=dumps(data),
+                content_type='application/json', headers=headers)
+        self.assertEqual(409, rv.status_code)
+
+    def test_send_mail_shard_rerun(self):
+        rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                content_type='application/json',
+                headers={'Authorization': self.user_token})
+        self.assertEqual(202, rv.status_code)
+        run_tasks(self)
+        links = sorted(link.key.id() for link in LinkModel.query())
+        # A shard that sent its messages but failed before recording it.
+        shard = SendShardModel.query().get()
+        shard.populate(sent=0, done=False)
+        shard.put()
+        rv = self.app.post('/tasks/mail/shard/', data={'shard': shard.key.urlsafe()},
+                headers={'X-AppEngine-QueueName': 'mail'})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(2, len(self.mail_stub.get_sent_messages()))
+        self.assertEqual(links, sorted(link.key.id() for link in LinkModel.query()))
+
+    def test_send_mail_shard_rerun_keeps_links(self):
+        rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                content_type='application/json',
+                headers={'Authorization': self.user_token})
+        self.assertEqual(202, rv.status_code)
+        run_tasks(self)
+        # A code is issued before a retry of the shard runs.
+        link = LinkModel.query().get()
+        link.populate(otp='hash', otp_expire=datetime.utcnow() + timedelta(minutes=5))
+        link.put()
+        shard = SendShardModel.query().get()
+        shard.populate(sent=0, done=False)
+        shard.put()
+        rv = self.app.post('/tasks/mail/shard/', data={'shard': shard.key.urlsafe()},
+                headers={'X-AppEngine-QueueName': 'mail'})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('hash', link.key.get().otp)
+
+    def test_send_mail_memory_transport(self):
+        app.config['MAIL_TRANSPORT'] = 'memory'
+        try:
+            outbox = get_transport().outbox
+            del outbox[:]
+            rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                    content_type='application/json',
+                    headers={'Authorization': self.user_token})
+            self.assertEqual(202, rv.status_code)
+            run_tasks(self)
+        finally:
+            app.config['MAIL_TRANSPORT'] = 'appengine'
+        self.assertEqual(0, len(self.mail_stub.get_sent_messages()))
+        self.assertEqual(sorted([self.contact_args['email'], self.listed_args['email']]),
+                         sorted(message['to'] for message in outbox))
+        self.assertEqual('A MailSafe Message From Testy', outbox[0]['subject'])
+
+    def test_send_mail_rejected_recipient(self):
+        app.config['MAIL_TRANSPORT'] = 'memory'
+        transport = get_transport()
+        del transport.outbox[:]
+        rejected = self.contact_args['email']
+        def send(message):
+            if message['to'] == rejected:
+                raise RecipientError('no such mailbox')
+            MemoryTransport.send(transport, message)
+        transport.send = send
+        try:
+            rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                    content_type='application/json',
+                    headers={'Authorization': self.user_token})
+            self.assertEqual(202, rv.status_code)
+            run_tasks(self)
+        finally:
+            del transport.send
+            app.config['MAIL_TRANSPORT'] = 'appengine'
+        # The rest of the shard was sent, and the job finished.
+        self.assertEqual([self.listed_args['email']],
+                         [message['to'] for message in transport.outbox])
+        self.assertEqual(JobStatus.DONE, load_progress(JobModel.query().get()).status)
+        errors = [link.error for link in LinkModel.query() if link.error]
+        self.assertEqual(['no such mailbox'], errors)
+
+    def test_smtp_transport_pools_connections(self):
+        server = SinkServer()
+        server.start()
+        transport = SMTPTransport('127.0.0.1', server.port, messages_per_connection=2)
+        message = PreparedEmail(from_name=u'Testy').message(
+            'test@example.com', 'contact1@test.com', to_name=u'Contact',
+            link_url=u'/link/abc')
+        try:
+            # Three messages need two connections.
+            with transport.session() as session:
+                for i in range(3):
+                    session.send(message)
+            self.assertEqual(2, server.connections)
+            # The second connection is reused from the pool.
+            transport.send(message)
+            self.assertEqual(2, server.connections)
+        finally:
+            transport.close()
+            server.close()
+        self.assertEqual(4, len(server.messages))
+        mailfrom, rcpttos, data = server.messages[0]
+        self.assertEqual(['contact1@test.com'], rcpttos)
+        parts = message_from_string(data).get_payload()
+        self.assertEqual(['text/plain', 'text/html'],
+                         [part.get_content_type() for part in parts])
+        self.assertIn('/link/abc', parts[1].get_payload(decode=True))
+
+    def test_send_mail_skips_suppressed(self):
+        suppress(' Contact1@Test.com', SuppressionReason.BOUNCE)
+        rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                content_type='application/json',
+                headers={'Authorization': self.user_token})
+        self.assertEqual(202, rv.status_code)
+        run_tasks(self)
+        self.assertEqual(0, len(self.mail_stub.get_sent_messages(to=self.contact_args['email'])))
+        self.assertEqual(1, len(self.mail_stub.get_sent_messages(to=self.listed_args['email'])))
+        self.assertEqual(1, LinkModel.query().count())
+
+    def test_bounce(self):
+        rv = self.app.post('/_ah/bounce', data={'original-to': self.contact_args['email'],
+                                                'original-from': 'admin@wisebold.com'})
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(set([self.contact_args['email']]),
+                         suppressed([self.contact_args['email'], self.listed_args['email']]))
+
+    def test_unsubscribe(self):
+        rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                content_type='application/json',
+                headers={'Authorization': self.user_token})
+        self.assertEqual(202, rv.status_code)
+        run_tasks(self)
+        message = self.mail_stub.get_sent_messages(to=self.contact_args['email'])[0]
+        url = message.body.decode().split('visit ')[1].split()[0]
+        self.assertTrue(url.startswith('/unsubscribe/'))
+        rv = self.app.get(url)
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual({'email': self.contact_args['email'], 'unsubscribed': False},
+                         loads(rv.data))
+        rv = self.app.post(url)
+        self.assertEqual(200, rv.status_code)
+        self.assertTrue(loads(rv.data)['unsubscribed'])
+        self.assertEqual(set([self.contact_args['email']]),
+                         suppressed([self.contact_args['email']]))
+        # A token that was not signed by the app.
+        rv = self.app.post('/unsubscribe/' + url.split('.')[0][len('/unsubscribe/'):] + '.x')
+        self.assertEqual(404, rv.status_code)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1024, 7)
+        for i in range(50):
+            bloom.add('user%d@example.com' % i)
+        copy = BloomFilter(1024, 7, bloom.serialize())
+        for i in range(50):
+            self.assertIn('user%d@example.com' % i, copy)
+        misses = sum(1 for i in range(1000) if 'other%d@example.com' % i in copy)
+        self.assertLess(misses, 50)
+        # Data of another size is not silently dropped.
+        self.assertRaises(ValueError, BloomFilter, 2048, 7, bloom.serialize())
+
+    def test_fold_suppressions(self):
+        suppress('a@example.com', SuppressionReason.BOUNCE)
+        suppress('b@example.com', SuppressionReason.UNSUBSCRIBE)
+        later = datetime.utcnow() + timedelta(seconds=app.config['SUPPRESSION_FOLD_DELAY'] + 1)
+        self.assertEqual(2, fold_suppressions(later))
+        bloom, folded_until = suppression_filter()
+        self.assertIn('a@example.com', bloom)
+        self.assertEqual(set(['b@example.com']), suppressed(['b@example.com', 'c@example.com']))
+        # Nothing new to fold, so the filter is not written.
+        version = filter_key().get().version
+        self.assertEqual(0, fold_suppressions(later))
+        self.assertEqual(version, filter_key().get().version)
+        # Pending addresses past the limit are looked up directly.
+        for email in ('c@example.com', 'd@example.com'):
+            SuppressionModel(id=email, created=later).put()
+        limit = app.config['SUPPRESSION_PENDING_LIMIT']
+        app.config['SUPPRESSION_PENDING_LIMIT'] = 1
+        try:
+            self.assertEqual(set(['b@example.com', 'c@example.com']),
+                             suppressed(['b@example.com', 'c@example.com', 'e@example.com']))
+        finally:
+            app.config['SUPPRESSION_PENDING_LIMIT'] = limit
+
+        # Other settings rebuild the filter from every address.
+        bits = app.config['SUPPRESSION_FILTER_BITS']
+        app.config['SUPPRESSION_FILTER_BITS'] = 4096
+        try:
+            self.assertEqual(2, fold_suppressions(later))
+            self.assertEqual(4096, filter_key().get().bits)
+        finally:
+            app.config['SUPPRESSION_FILTER_BITS'] = bits
+        self.assertEqual(set(['a@example.com']), suppressed(['a@example.com']))
+
+    def make_link(self, **kwargs):
+        contact = ContactModel.query(ContactModel.email == self.contact_args['email']).get()
+        doc = DocModel.query().get()
+        link = LinkModel(id='a' * 32, contact=contact.key, doc=doc.key, **kwargs)
+        link.put()
+        return link
+
+    def send_code(self, key_id):
+        outbox = get_sms_backend().outbox
+        del outbox[:]
+        rv = self.app.get('/auth/%s/' % key_id)
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(1, len(outbox))
+        to, body = outbox[0]
+        self.assertEqual(self.contact_args['phone'], to)
+        return body.split()[-1]
+
+    def view_link(self, key_id, code=None):
+        if code is None:
+            code = self.send_code(key_id)
+        return self.app.post('/link/' + key_id, data=dumps({'otp': code}),
+                content_type='application/json')
+
+    def test_link_view(self):
+        link = self.make_link()
+        rv = self.app.get('/link/' + link.key.id())
+        self.assertEqual(403, rv.status_code)
+        code = self.send_code(link.key.id())
+        wrong = '%06d' % ((int(code) + 1) % 10 ** 6)
+        self.assertEqual(403, self.view_link(link.key.id(), wrong).status_code)
+        # Not clicked until the doc is shown.
+        self.assertFalse(link.key.get().clicked)
+        rv = self.view_link(link.key.id(), code)
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual('Test content', data['content'])
+        self.assertEqual('Testy', data['from_name'])
+        self.assertTrue(link.key.get().clicked)
+        rv = self.app.get('/link/' + 'b' * 32)
+        self.assertEqual(404, rv.status_code)
+
+    def test_link_otp(self):
+        link = self.make_link()
+        code = self.send_code(link.key.id())
+        self.assertEqual(6, len(code))
+        self.assertNotEqual(code, link.key.get().otp)
+        wrong = '%06d' % ((int(code) + 1) % 10 ** 6)
+        self.assertEqual(403, self.view_link(link.key.id(), wrong).status_code)
+        self.assertEqual(200, self.view_link(link.key.id(), code).status_code)
+        # A code works once.
+        self.assertEqual(403, self.view_link(link.key.id(), code).status_code)
+        # And not after it expires.
+        code = self.send_code(link.key.id())
+        link = link.key.get()
+        link.otp_expire = datetime.utcnow() - timedelta(seconds=1)
+        link.put()
+        self.assertEqual(403, self.view_link(link.key.id(), code).status_code)
+
+    def test_link_otp_lockout(self):
+        link = self.make_link()
+        code = self.send_code(link.key.id())
+        wrong = '%06d' % ((int(code) + 1) % 10 ** 6)
+        for i in range(app.config['OTP_MAX_ATTEMPTS']):
+            self.assertEqual(403, self.view_link(link.key.id(), wrong).status_code)
+        # Even the right code is refused once the link is locked.
+        self.assertEqual(429, self.view_link(link.key.id(), code).status_code)
+        # The failures are only counted in memcache.
+        memcache.flush_all()
+        self.assertEqual(200, self.view_link(link.key.id(), code).status_code)
+
+    def test_link_otp_needs_sms_backend(self):
+        link = self.make_link()
+        backend = app.config['SMS_BACKEND']
+        app.config['SMS_BACKEND'] = None
+        try:
+            self.assertRaises(SMSError, issue_otp, link, self.contact_args['phone'])
+        finally:
+            app.config['SMS_BACKEND'] = backend
+        # Nothing was saved.
+        self.assertEqual(None, link.key.get().otp)
+
+    def test_link_otp_send_fails(self):
+        link = self.make_link()
+        code = self.send_code(link.key.id())
+        backend = get_sms_backend()
+        def fail(to, body):
+            raise SMSError('down')
+        backend.send = fail
+        try:
+            rv = self.app.get('/auth/%s/' % link.key.id())
+        finally:
+            del backend.send
+        self.assertEqual(503, rv.status_code)
+        # The failed issue is not counted, and the last code still works.
+        self.assertEqual(1, memcache.get('otp_issues:' + link.key.id()))
+        self.assertEqual(200, self.view_link(link.key.id(), code).status_code)
+
+    def test_link_otp_keeps_other_fields(self):
+        link = self.make_link()
+        # Sent after this copy of the link was read.
+        stored = link.key.get()
+        stored.sent = datetime.utcnow()
+        stored.put()
+        self.assertTrue(issue_otp(link, self.contact_args['phone']))
+        stored = link.key.get()
+        self.assertIsNotNone(stored.sent)
+        self.assertEqual(link.otp, stored.otp)
+
+    def test_link_view_cached(self):
+        link = self.make_link()
+        rv = self.view_link(link.key.id())
+        self.assertEqual(200, rv.status_code)
+        # Served from memcache once resolved.
+        ndb.delete_multi([link.contact])
+        rv = self.view_link(link.key.id())
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('Test content', loads(rv.data)['content'])
+        # A change to the doc replaces its cached view.
+        doc = link.doc.get()
+        doc.content = 'New content'
+        doc.put()
+        rv = self.view_link(link.key.id())
+        self.assertEqual('New content', loads(rv.data)['content'])
+        # As does deleting it.
+        link.doc.delete()
+        rv = self.view_link(link.key.id())
+        self.assertEqual(404, rv.status_code)
+
+    def test_link_expired(self):
+        link = self.make_link(expires=datetime.utcnow() - timedelta(minutes=1))
+        rv = self.app.get('/link/' + link.key.id())
+        self.assertEqual(410, rv.status_code)
+
+    def make_expiring_links(self):
+        contact = ContactModel.query().get()
+        doc = DocModel.query().get()
+        now = datetime.utcnow()
+        expires = [now - timedelta(days=2), now - timedelta(days=1),
+                   now - timedelta(hours=1), now + timedelta(days=1), None]
+        ndb.put_multi([LinkModel(contact=contact.key, doc=doc.key, expires=e)
+                       for e in expires])
+
+    def test_link_sweep(self):
+        self.make_expiring_links()
+        batch_size = app.config['LINK_SWEEP_BATCH_SIZE']
+        app.config['LINK_SWEEP_BATCH_SIZE'] = 2
+        try:
+            rv = self.app.get('/tasks/links/sweep/',
+                    headers={'X-AppEngine-Cron': 'true'})
+            self.assertEqual(200, rv.status_code)
+            run_tasks(self, 'maintenance')
+        finally:
+            app.config['LINK_SWEEP_BATCH_SIZE'] = batch_size
+        # Only the live links are left.
+        links = LinkModel.query().fetch()
+        self.assertEqual(2, len(links))
+        self.assertTrue(all(l.expires is None or l.expires > datetime.utcnow()
+                            for l in links))
+        job = sweep_key().get()
+        self.assertEqual(JobStatus.DONE, job.status)
+        self.assertEqual(3, job.processed)
+        # Only cron and the task queue may start it.
+        rv = self.app.get('/tasks/links/sweep/')
+        self.assertEqual(403, rv.status_code)
+
+    def test_link_sweep_resume(self):
+        self.make_expiring_links()
+        now = datetime.utcnow()
+        job = start_link_sweep(now)
+        # A running sweep is left alone until it stops making progress.
+        self.assertEqual(job.updated, start_link_sweep(now).updated)
+        self.assertEqual(1, len(self.taskqueue_stub.get_filtered_tasks(
+            queue_names=['maintenance'])))
+        later = now + timedelta(seconds=app.config['LINK_SWEEP_STALE_TIME'] + 1)
+        start_link_sweep(later)
+        # The old task and the resumed one only delete the links once.
+        run_tasks(self, 'maintenance')
+        self.assertEqual(3, sweep_key().get().processed)
+        self.assertEqual(2, LinkModel.query().count())
+
+    def test_send_mail_link_urls(self):
+        rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                content_type='application/json',
+                headers={'Authorization': self.user_token})
+        self.assertEqual(202, rv.status_code)
+        run_tasks(self)
+        for link in LinkModel.query():
+            self.assertEqual(32, len(link.key.id()))
+            contact = link.contact.get()
+            message = self.mail_stub.get_sent_messages(to=contact.email)[0]
+            self.assertIn('/link/' + link.key.id(), message.body.decode())
+
+    def test_send_mail_multipart(self):
+        rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                content_type='application/json',
+                headers={'Authorization': self.user_token})
+        self.assertEqual(202, rv.status_code)
+        run_tasks(self)
+        message = self.mail_stub.get_sent_messages(to=self.contact_args['email'])[0]
+        self.assertEqual('A MailSafe Message From Testy', message.subject)
+        self.assertIn('through MailSafe', message.body.decode())
+        self.assertIn('<a href="/link/', message.html.decode())
+
+    def test_prepared_email_escapes_html(self):
+        email = PreparedEmail(from_name=u'<Testy>')
+        message = email.message('from@example.com', 'to@example.com',
+                                to_name=u'Ann & Bob', link_url=u'/link/abc')
+        self.assertEqual('to@example.com', message['to'])
+        self.assertIn(u'Dear Ann & Bob,', message['body'])
+        self.assertIn(u'Dear Ann &amp; Bob,', message['html'])
+        self.assertIn(u'from &lt;Testy&gt; through', message['html'])
+        self.assertEqual(u'A MailSafe Message From <Testy>', message['subject'])
+        # Values for one recipient do not leak into the next.
+        message = email.message('from@example.com', 'to2@example.com')
+        self.assertIn(u'Dear ,', message['body'])
+
+    def test_mail_preview(self):
+        rv = self.app.get('/user/mail/preview/%s/' % self.doc_id,
+                headers={'Authorization': self.user_token})
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertIn('Dear Recipient,', data['body'])
+        self.assertIn('Dear Recipient,', data['html'])
+        rv = self.app.get('/user/mail/preview/999/',
+                headers={'Authorization': self.user_token})
+        self.assertEqual(404, rv.status_code)
+        # Memoized per sender name only.
+        with app.test_request_context('/user/mail/'):
+            self.assertIs(preview(u'Testy'), preview(u'Testy'))
+            self.assertIn(u'Other', preview(u'Other')['subject'])
+
+    def test_send_mail_rate_limited(self):
+        burst = app.config['MAIL_DOMAIN_BURST']
+        app.config['MAIL_DOMAIN_BURST'] = 1
+        try:
+            rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                    content_type='application/json',
+                    headers={'Authorization': self.user_token})
+            self.assertEqual(202, rv.status_code)
+            # Fan out, then run the shard once.
+            for i in range(2):
+                tasks = self.taskqueue_stub.get_filtered_tasks(queue_names=['mail'])
+                self.taskqueue_stub.FlushQueue('mail')
+                for task in tasks:
+                    self.app.post(task.url, data=task.payload,
+                            content_type='application/x-www-form-urlencoded',
+                            headers={'X-AppEngine-QueueName': 'mail'})
+        finally:
+            app.config['MAIL_DOMAIN_BURST'] = burst
+
+        # One message went out and the shard is waiting for a token.
+        self.assertEqual(1, len(self.mail_stub.get_sent_messages()))
+        shard = SendShardModel.query().get()
+        self.assertEqual(1, shard.sent)
+        self.assertFalse(shard.done)
+        tasks = self.taskqueue_stub.get_filtered_tasks(queue_names=['mail'])
+        self.assertEqual(1, len(tasks))
+
+        # The throttled send is finished once the bucket refills.
+        memcache.flush_all()
+        run_tasks(self)
+        self.assertEqual(2, len(self.mail_stub.get_sent_messages()))
+        self.assertEqual(JobStatus.DONE, load_progress(JobModel.query().get()).status)
+
+    def test_send_mail_rate_limited_per_recipient_domain(self):
+        listed = ContactModel.query(ContactModel.email == self.listed_args['email']).get()
+        listed.email = 'contact2@other.com'
+        listed.put()
+        burst = app.config['MAIL_DOMAIN_BURST']
+        app.config['MAIL_DOMAIN_BURST'] = 1
+        try:
+            rv = self.app.post('/user/mail/', data=dumps({'doc_id': self.doc_id}),
+                    content_type='application/json',
+                    headers={'Authorization': self.user_token})
+            self.assertEqual(202, rv.status_code)
+            run_tasks(self)
+            # Each domain had a token.
+            self.assertEqual(2, len(self.mail_stub.get_sent_messages()))
+            shard = SendShardModel.query().get()
+            self.assertTrue(shard.done)
+
+            # A rerun spends no tokens on recipients already sent to.
+            app.config['MAIL_DOMAIN_BURST'] = 0
+            shard.sent = 0
+            shard.done = False
+            shard.put()
+            self.app.post('/tasks/mail/shard/', data={'shard': shard.key.urlsafe(), 'sent': 0},
+                    headers={'X-AppEngine-QueueName': 'mail'})
+        finally:
+            app.config['MAIL_DOMAIN_BURST'] = burst
+        self.assertEqual(2, len(self.mail_stub.get_sent_messages()))
+        self.assertTrue(shard.key.get().done)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket('test', rate=1, capacity=3)
+        self.assertEqual(3, bucket.take(2)[0] + bucket.take(2)[0])
+        taken, wait = bucket.take(2)
+        self.assertEqual(0, taken)
+        self.assertTrue(0 < wait <= 2)
+        bucket.give_back(2)
+        self.assertEqual(2, bucket.take(5)[0])
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_list.py
+
+"""
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from json import loads, dumps
+from unittest import TestCase
+from mail_safe_test import app
+from mail_safe_test.auth import UserModel
+from mail_safe_test.resources.contact import ContactModel
+from mail_safe_test.resources.list import ListModel
+
+def common_setUp(self):
+    app.config['TESTING'] = True
+    app.config['CSRF_ENABLED'] = False
+    self.app = app.test_client()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_user_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub()
+
+def setup_lists(self):
+    self.user1_id = '1'
+    self.user1_token = "valid_user"
+    self.user2_id = '2'
+    self.user2_token = "valid_user2"
+    user1 = UserModel(id=self.user1_id, first_name="Testy", email="user@example.com")
+    user1.put()
+    user2 = UserModel(id=self.user2_id, first_name="Other", email="user2@example.com")
+    user2.put()
+
+    self.contact_ids = []
+    for i in range(3):
+        contact = ContactModel(parent=user1.key, email="c%d@example.com" % i,
+                               phone="1234567890")
+        contact.put()
+        self.contact_ids.append(contact.key.id())
+    self.other_contact = ContactModel(parent=user2.key, email="other@example.com",
+                                      phone="1234567890")
+    self.other_contact.put()
+
+    lst = ListModel(parent=user1.key, name="Friends",
+                    members=[ndb.Key(ContactModel, self.contact_ids[0], parent=user1.key)])
+    lst.put()
+    self.list_id = str(lst.key.id())
+
+class ListTestCases(TestCase):
+
+    def setUp(self):
+        common_setUp(self)
+        setup_lists(self)
+        self.auth = {'Authorization': self.user1_token}
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_list_no_auth(self):
+        rv = self.app.get('/user/lists/')
+        self.assertEqual(403, rv.status_code)
+        rv = self.app.get('/user/list/' + self.list_id + '/')
+        self.assertEqual(403, rv.status_code)
+
+    def test_list_get(self):
+        rv = self.app.get('/user/list/' + self.list_id + '/', headers=self.auth)
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual('Friends', data['name'])
+        self.assertEqual(1, data['size'])
+        self.assertEqual(['c0@example.com'], [c['email'] for c in data['contacts']])
+
+    def test_list_get_paged(self):
+        lst = ListModel.get_by_id(int(self.list_id), parent=ndb.Key(UserModel, self.user1_id))
+        lst.members = [ndb.Key(ContactModel, i, parent=lst.key.parent())
+                       for i in self.contact_ids]
+        lst.put()
+        emails = []
+        cursor = ''
+        while True:
+            rv = self.app.get('/user/list/%s/?limit=2&cursor=%s' % (self.list_id, cursor),
+                    headers=self.auth)
+            self.assertEqual(200, rv.status_code)
+            data = loads(rv.data)
+            self.assertTrue(len(data['contacts']) <= 2)
+            emails += [c['email'] for c in data['contacts']]
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(['c0@example.com', 'c1@example.com', 'c2@example.com'], emails)
+        rv = self.app.get('/user/list/%s/?cursor=abc' % self.list_id, headers=self.auth)
+        self.assertEqual(400, rv.status_code)
+
+    def test_list_get_fields(self):
+        rv = self.app.get('/user/list/' + self.list_id + '/?fields=email', headers=self.auth)
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual('Friends', data['name'])
+        self.assertEqual([{'email': 'c0@example.com'}], data['contacts'])
+        rv = self.app.get('/user/list/' + self.list_id + '/?fields=password', headers=self.auth)
+        self.assertEqual(400, rv.status_code)
+
+    def test_list_get_other_user(self):
+        rv = self.app.get('/user/list/' + self.list_id + '/',
+                headers={'Authorization': self.user2_token})
+        self.assertEqual(404, rv.status_code)
+
+    def test_list_list_get(self):
+        rv = self.app.get('/user/lists/', headers=self.auth)
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual(1, len(data['lists']))
+        self.assertEqual('Friends', data['lists'][0]['name'])
+        self.assertEqual(1, data['lists'][0]['size'])
+
+    def test_list_post(self):
+        rv = self.app.post('/user/lists/',
+                data=dumps({'name': 'Family', 'contacts': self.contact_ids[1:]}),
+                content_type='application/json', headers=self.auth)
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual('Family', data['name'])
+        self.assertEqual(2, data['size'])
+        self.assertEqual(2, ListModel.query().count())
+
+    def test_list_post_other_users_contact(self):
+        rv = self.app.post('/user/lists/',
+                data=dumps({'name': 'Bad', 'contacts': [self.other_contact.key.id()]}),
+                content_type='application/json', headers=self.auth)
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual(1, ListModel.query().count())
+
+    def test_list_put(self):
+        rv = self.app.put('/user/list/' + self.list_id + '/',
+                data=dumps({'name': 'Best friends',
+                            'add': self.contact_ids[1:],
+                            'remove': self.contact_ids[:1]}),
+                content_type='application/json', headers=self.auth)
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual('Best friends', data['name'])
+        self.assertEqual(2, data['size'])
+
+    def test_list_put_duplicate_members(self):
+        rv = self.app.put('/user/list/' + self.list_id + '/',
+                data=dumps({'add': self.contact_ids[:1] * 2}),
+                content_type='application/json', headers=self.auth)
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual(1, loads(rv.data)['size'])
+
+    def test_list_put_max_size(self):
+        max_list_size = app.config['MAX_LIST_SIZE']
+        app.config['MAX_LIST_SIZE'] = 2
+        try:
+            rv = self.app.put('/user/list/' + self.list_id + '/',
+                    data=dumps({'add': self.contact_ids}),
+                    content_type='application/json', headers=self.auth)
+        finally:
+            app.config['MAX_LIST_SIZE'] = max_list_size
+        self.assertEqual(400, rv.status_code)
+
+    def test_list_delete(self):
+        rv = self.app.delete('/user/list/' + self.list_id + '/', headers=self.auth)
+        self.assertEqual(204, rv.status_code)
+        self.assertEqual(0, ListModel.query().count())
+        # The contacts themselves are kept.
+        self.assertEqual(4, ContactModel.query().count())
+
+    def test_list_contact_deleted(self):
+        user_key = ndb.Key(UserModel, self.user1_id)
+        contact_key = ContactModel(id='named', parent=user_key, email='named@example.com',
+                                   phone='1234567890').put()
+        lst = ListModel.query().get()
+        lst.members.append(contact_key)
+        lst.put()
+        rv = self.app.delete('/user/contact/named/', headers=self.auth)
+        self.assertEqual(204, rv.status_code)
+        lst = lst.key.get()
+        self.assertNotIn(contact_key, lst.members)
+        self.assertEqual(1, lst.size)
+
+    def test_list_deleted_member(self):
+        ndb.Key(UserModel, self.user1_id, ContactModel, self.contact_ids[0]).delete()
+        rv = self.app.get('/user/list/' + self.list_id + '/', headers=self.auth)
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual([], loads(rv.data)['contacts'])
@@ -356,6 +356,20 @@ class AdminAuthUserTestCases(TestCase):
         self.assertEqual('McAdmin', data['users'][1]['last_name'])
         self.assertEqual('admin@example.com', data['users'][1]['email'])
 
+    def test_admin_users_get_paged(self):
+        rv = self.app.get('/admin/users/?limit=1',
+            headers = {'Authorization': self.admin_token})
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual(1, len(data['users']))
+        self.assertEqual('Testy', data['users'][0]['first_name'])
+
+        rv = self.app.get('/admin/users/?limit=1&cursor=' + data['next_cursor'],
+            headers = {'Authorization': self.admin_token})
+        self.assertEqual(200, rv.status_code)
+        data = loads(rv.data)
+        self.assertEqual('Admin', data['users'][0]['first_name'])
+
     def test_admin_users_delete(self):
         verify_user_count(self, 2)
         rv = self.app.delete('/admin/users/',